@@ -49,6 +49,7 @@ ACTION_NAME_FRAME_EXTRACTION = 'frame_extraction'
 ACTION_NAME_TRACKING = 'tracking'
 ACTION_NAME_DATASET_PRODUCE = 'dataset_produce'
 ACTION_NAME_DATASET_PRODUCE_RECORD = 'dataset_produce_record'
+ACTION_NAME_DATASET_PRODUCE_VIDEO_RECORDS = 'dataset_produce_video_records'
 ACTION_NAME_DELETE_DATASET_RECORD_WRITERS = 'delete_dataset_record_writers'
 ACTION_NAME_DATASET_ZIP = 'dataset_zip'
 ACTION_NAME_DATASET_ZIP_PARTITION = 'dataset_zip_partition'
@@ -59,6 +59,7 @@ import team_info
 import test_routes
 import tflite_creator
 import tracking
+import tracking_metrics
 import util
 from wrappers import handle_exceptions
 from wrappers import redirect_to_login_if_needed
@@ -354,6 +355,7 @@ def __strip_video_entity(video_entity):
         'fps',
         'frame_count',
         'frame_extraction_active_time_ms',
+        'frame_extraction_done',
         'frame_extraction_error_message',
         'frame_extraction_failed',
         'frame_extraction_triggered_time_ms',
@@ -615,6 +617,19 @@ def admin():
     return flask.render_template('admin.html', config=config.config, max_mins=constants.TOTAL_TRAINING_MINUTES_PER_TEAM)
 
 
+@app.route('/retrieveTrackingLatency', methods=['POST'])
+@handle_exceptions
+@login_required
+@roles_accepted(roles.Role.GLOBAL_ADMIN, roles.Role.ML_DEVELOPER)
+def retrieve_tracking_latency():
+    # Add the latency counts from this instance before reading the histograms.
+    tracking_metrics.flush()
+    response = {
+        'tracking_latency': tracking_metrics.retrieve_latency_summary(),
+    }
+    return flask.jsonify(__sanitize(response))
+
+
 @app.route('/refreshConfig', methods=['POST'])
 @handle_exceptions
 @login_required
@@ -949,6 +964,27 @@ def store_video_frame_bboxes_text():
     storage.store_video_frame_bboxes_text(team_uuid, video_uuid, frame_number, bboxes_text)
     return 'OK'
 
+@app.route('/interpolateVideoFrameBboxesText', methods=['POST'])
+@handle_exceptions
+@login_required
+def interpolate_video_frame_bboxes_text():
+    team_uuid = team_info.retrieve_team_uuid(flask.session, flask.request)
+    data = validate_keys(flask.request.form.to_dict(flat=True),
+        ['video_uuid', 'start_frame_number', 'end_frame_number'])
+    video_uuid = storage.validate_uuid(data.get('video_uuid'))
+    start_frame_number = validate_frame_number(data.get('start_frame_number'))
+    end_frame_number = validate_int(data.get('end_frame_number'), min=start_frame_number + 2)
+    # storage.store_interpolated_video_frame_bboxes_text will raise HttpErrorNotFound
+    # if the team_uuid/video_uuid/frame_number is not found.
+    # storage.store_interpolated_video_frame_bboxes_text will raise HttpErrorConflict
+    # if the bboxes of a keyframe are changed while the frames are interpolated.
+    bboxes_texts = storage.store_interpolated_video_frame_bboxes_text(
+        team_uuid, video_uuid, start_frame_number, end_frame_number)
+    response = {
+        'bboxes_texts': bboxes_texts,
+    }
+    return flask.jsonify(__sanitize(response))
+
 @app.route('/storeVideoFrameIncludeInDataset', methods=['POST'])
 @handle_exceptions
 @login_required
@@ -1030,6 +1066,7 @@ def retrieve_tracked_bboxes():
 @handle_exceptions
 @login_required
 def continue_tracking():
+    start_time = time.monotonic()
     time_limit = datetime.now(timezone.utc) + timedelta(seconds=15)
     team_uuid = team_info.retrieve_team_uuid(flask.session, flask.request)
     data = validate_keys(flask.request.form.to_dict(flat=True),
@@ -1042,12 +1079,13 @@ def continue_tracking():
     # if the video_uuid/tracker_uuid is not found.
     storage.continue_tracking(team_uuid, video_uuid, tracker_uuid, frame_number, bboxes_text)
     if 'retrieve_frame_number' in data:
-        time.sleep(0.2)
         retrieve_frame_number = validate_frame_number(data.get('retrieve_frame_number'))
         # storage.retrieve_tracked_bboxes returns True for tracker_failed
         # if the video_uuid/tracker_uuid is not found.
         tracker_failed, frame_number, bboxes_text = storage.retrieve_tracked_bboxes(
             video_uuid, tracker_uuid, retrieve_frame_number, time_limit)
+        storage.record_tracking_latency(video_uuid, tracker_uuid, tracking_metrics.SPAN_CONTINUE_TRACKING,
+            (time.monotonic() - start_time) * 1000)
         response = {
             'tracker_failed': tracker_failed,
             'frame_number': frame_number,
@@ -1056,6 +1094,30 @@ def continue_tracking():
         return flask.jsonify(__sanitize(response))
     return 'OK'
 
+@app.route('/continueTrackingBatch', methods=['POST'])
+@handle_exceptions
+@login_required
+def continue_tracking_batch():
+    team_uuid = team_info.retrieve_team_uuid(flask.session, flask.request)
+    data = validate_keys(flask.request.form.to_dict(flat=True),
+        ['video_uuid', 'tracker_uuid', 'min_frame_number', 'bboxes_texts'])
+    video_uuid = storage.validate_uuid(data.get('video_uuid'))
+    tracker_uuid = storage.validate_uuid(data.get('tracker_uuid'))
+    min_frame_number = validate_frame_number(data.get('min_frame_number'))
+    bboxes_texts = bbox_writer.validate_bboxes_texts_json(data.get('bboxes_texts'))
+    # storage.continue_tracking_batch does nothing
+    # if the video_uuid/tracker_uuid is not found.
+    # storage.continue_tracking_batch will raise HttpErrorBadRequest
+    # if the frames don't start after the approved frame or go past the tracked frames.
+    storage.continue_tracking_batch(team_uuid, video_uuid, tracker_uuid, min_frame_number, bboxes_texts)
+    # Return the bboxes that the tracker has already tracked after the approved frames, so the
+    # client can show them and approve them in the next batch.
+    response = {
+        'frame_number': min_frame_number + len(bboxes_texts),
+        'bboxes_texts': storage.retrieve_lookahead_bboxes(video_uuid, tracker_uuid),
+    }
+    return flask.jsonify(__sanitize(response))
+
 @app.route('/trackingClientStillAlive', methods=['POST'])
 @handle_exceptions
 @login_required
@@ -1212,15 +1274,22 @@ def prepare_to_zip_dataset():
     dataset_uuid = storage.validate_uuid(data.get('dataset_uuid'))
     # dataset_zipper.prepare_to_zip_dataset will raise HttpErrorNotFound
     # if the team_uuid/dataset_uuid is not found.
-    dataset_zip_uuid, partition_count = dataset_zipper.prepare_to_zip_dataset(
+    dataset_zip_uuid, partition_lists, cached, cacheable = dataset_zipper.prepare_to_zip_dataset(
         team_uuid, dataset_uuid)
-    action_parameters = dataset_zipper.make_action_parameters(
-        team_uuid, dataset_uuid, dataset_zip_uuid, partition_count)
-    action.trigger_action_via_blob(action_parameters)
+    if not cached:
+        action_parameters = dataset_zipper.make_action_parameters(
+            team_uuid, dataset_uuid, dataset_zip_uuid, partition_lists)
+        action.trigger_action_via_blob(action_parameters)
     response = {
         'dataset_zip_uuid': dataset_zip_uuid,
-        'partition_count': partition_count,
+        'partition_count': len(partition_lists),
+        'cached': cached,
+        # The client deletes the zips after downloading them, unless they are kept for reuse.
+        'cacheable': cacheable,
     }
+    if cached:
+        # Include the status, so the client can start downloading the zips right away.
+        response.update(__get_dataset_zip_status(team_uuid, dataset_zip_uuid, len(partition_lists)))
     return flask.jsonify(__sanitize(response))
 
 @app.route('/getDatasetZipStatus', methods=['POST'])
@@ -1232,20 +1301,23 @@ def get_dataset_zip_status():
         ['dataset_zip_uuid', 'partition_count'])
     dataset_zip_uuid = storage.validate_uuid(data.get('dataset_zip_uuid'))
     partition_count = validate_positive_int(data.get('partition_count'))
+    response = __get_dataset_zip_status(team_uuid, dataset_zip_uuid, partition_count)
+    return flask.jsonify(__sanitize(response))
+
+def __get_dataset_zip_status(team_uuid, dataset_zip_uuid, partition_count):
     # storage.retrieve_dataset_zipper_files_written will raise HttpErrorNotFound
     # if none of the partitions for team_uuid/dataset_zipper_uuid is found.
     file_count_array, files_written_array = storage.retrieve_dataset_zipper_files_written(
         team_uuid, dataset_zip_uuid, partition_count)
     exists_array, download_url_array = blob_storage.get_dataset_zip_download_url(
         team_uuid, dataset_zip_uuid, partition_count)
-    response = {
+    blob_storage.set_cors_policy_for_get()
+    return {
         'file_count_array': file_count_array,
         'files_written_array': files_written_array,
         'is_ready_array': exists_array,
         'download_url_array': download_url_array,
     }
-    blob_storage.set_cors_policy_for_get()
-    return flask.jsonify(__sanitize(response))
 
 @app.route('/deleteDatasetZip', methods=['POST'])
 @handle_exceptions
@@ -1256,14 +1328,38 @@ def delete_dataset_zip():
         ['dataset_zip_uuid', 'partition_index'])
     dataset_zip_uuid = storage.validate_uuid(data.get('dataset_zip_uuid'))
     partition_index = validate_int(data.get('partition_index'), min=0)
-    # blob_storage.delete_dataset_zip does nothing
-    # if the team_uuid/dataset_zip_uuid/partition_index is not found
-    blob_storage.delete_dataset_zip(team_uuid, dataset_zip_uuid, partition_index)
-    # storage.delete_dataset_zipper does nothing
-    # if the team_uuid/dataset_zip_uuid/partition_index is not found
-    storage.delete_dataset_zipper(team_uuid, dataset_zip_uuid, partition_index)
+    # storage.delete_dataset_zipper returns False, without deleting anything,
+    # if the zip is kept for reuse.
+    if storage.delete_dataset_zipper(team_uuid, dataset_zip_uuid, partition_index):
+        # blob_storage.delete_dataset_zip does nothing
+        # if the team_uuid/dataset_zip_uuid/partition_index is not found
+        blob_storage.delete_dataset_zip(team_uuid, dataset_zip_uuid, partition_index)
     return 'OK'
 
+@app.route('/downloadDatasetZip', methods=['GET'])
+@handle_exceptions
+@login_required
+def download_dataset_zip():
+    if not constants.STREAMING_RESPONSES:
+        message = 'Error: Streaming dataset downloads are only available in the container deployment.'
+        logging.critical(message)
+        raise exceptions.HttpErrorNotFound(message)
+    team_uuid = team_info.retrieve_team_uuid(flask.session, flask.request)
+    # This is a get request, so we use flask.request.args.
+    data = validate_keys(flask.request.args.to_dict(flat=True),
+        ['dataset_uuid'])
+    dataset_uuid = storage.validate_uuid(data.get('dataset_uuid'))
+    # dataset_zipper.open_dataset_blobs_for_zip will raise HttpErrorNotFound
+    # if the team_uuid/dataset_uuid is not found, and HttpErrorUnprocessableEntity
+    # if the dataset is not completed.
+    blob_readers = dataset_zipper.open_dataset_blobs_for_zip(team_uuid, dataset_uuid)
+    storage.increment_datasets_downloaded_today(team_uuid)
+    # The zip is built while it is sent, so the response has no Content-Length and is sent with
+    # chunked transfer encoding.
+    return flask.Response(dataset_zipper.generate_dataset_zip(dataset_uuid, blob_readers),
+        mimetype='application/zip',
+        headers={'Content-Disposition': 'attachment; filename=dataset_%s.zip' % dataset_uuid})
+
 @app.route('/startTrainingModel', methods=['POST'])
 @handle_exceptions
 @login_required
@@ -18,7 +18,10 @@ __author__ = "lizlooney@google.com (Liz Looney)"
 # https://github.com/google/ftc-object-detection/tree/46197ce4ecaee954c2164d257d7dc24e85678285/training/training/bbox_writer.py
 
 # Python Standard Library
+import collections
+import json
 import logging
+import re
 
 # Other Modules
 import numpy as np
@@ -28,146 +31,165 @@ import constants
 import exceptions
 
 
-def __convert_bbox_to_text(bbox, scale, x_max, y_max):
-    # Scale the bbox
-    p0 = bbox[:2].astype(float)
-    p1 = p0 + bbox[2:].astype(float)
+# Each line of bboxes text is x1,y1,x2,y2,label. The label may contain commas.
+__NUMBER_PATTERN = r'\s*[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?\s*'
+__LINE_REGEX = re.compile(r'(%s),(%s),(%s),(%s),(.*)' % ((__NUMBER_PATTERN,) * 4))
+
+# NamedTuple for parsed bboxes text. There is one entry for each non-empty line.
+# rects is an N x 4 int32 numpy array of x1, y1, x2, y2. Rows for malformed lines are zero.
+# labels is a list of N labels. Labels for malformed lines are ''.
+# well_formed is an N element bool numpy array, True for lines that could be parsed.
+# valid is an N element bool numpy array, True for lines that could be parsed and have a label.
+ParsedBboxesText = collections.namedtuple('ParsedBboxesText', [
+    'rects', 'labels', 'well_formed', 'valid'])
+
+
+def parse_text(bboxes_text):
+    numbers = []
+    labels = []
+    well_formed = []
+    for line in bboxes_text.split("\n"):
+        if len(line) == 0:
+            continue
+        match = __LINE_REGEX.fullmatch(line.strip())
+        if match is None:
+            numbers.extend(('0', '0', '0', '0'))
+            labels.append('')
+            well_formed.append(False)
+        else:
+            numbers.extend(match.group(1, 2, 3, 4))
+            labels.append(match.group(5))
+            well_formed.append(True)
+    # Convert all the numbers at once.
+    rects = np.array(numbers, dtype=float).astype(np.int32).reshape(-1, 4)
+    well_formed = np.array(well_formed, dtype=bool)
+    # Ignore boxes with empty labels.
+    valid = well_formed & np.array([label != '' for label in labels], dtype=bool)
+    return ParsedBboxesText(rects, labels, well_formed, valid)
+
+
+def __scale_bboxes_array(bboxes, scale):
+    # bboxes is an N x 4 array of x, y, width, height. Scale each bbox around its center.
+    p0 = bboxes[:, :2].astype(float)
+    p1 = p0 + bboxes[:, 2:].astype(float)
     size = p1 - p0
     center = p0 + (size / 2)
     new_size = scale * size
     p0 = center - new_size / 2
     p1 = center + new_size / 2
-    scaled_bbox = np.array([p0, p1 - p0]).reshape(-1)
-    # Convert the scaled bbox to rect to match format x1, y1, x2, y2
-    p0 = scaled_bbox[:2]
-    size = scaled_bbox[2:]
-    p1 = p0 + size
-    return "%d,%d,%d,%d" % (
-        int(max(p0[0], 0)),
-        int(max(p0[1], 0)),
-        int(min(p1[0], x_max)),
-        int(min(p1[1], y_max)))
-
-
-def __convert_bboxes_and_labels_to_text(bboxes, scale, max_x, max_y, labels):
+    return np.concatenate((p0, p1 - p0), axis=1)
+
+
+def __convert_bboxes_and_labels_to_text(bboxes, scale, max_x, max_y, labels, frame_scale=1):
     assert(len(bboxes) == len(labels))
+    indices = [i for i in range(len(bboxes)) if bboxes[i] is not None and labels[i] is not None]
+    if len(indices) == 0:
+        return ""
+    bboxes_array = np.array([np.asarray(bboxes[i], dtype=float).reshape(-1) for i in indices])
+    if frame_scale != 1:
+        # Map the bboxes from the resized frame back to the source frame.
+        bboxes_array = bboxes_array / frame_scale
+    scaled_bboxes = __scale_bboxes_array(bboxes_array, scale)
+    # Convert the scaled bboxes to rects to match format x1, y1, x2, y2, clipped to the frame.
+    p0 = np.maximum(scaled_bboxes[:, :2], 0)
+    p1 = np.minimum(scaled_bboxes[:, :2] + scaled_bboxes[:, 2:], (max_x, max_y))
+    rects = np.trunc(np.concatenate((p0, p1), axis=1)).astype(np.int64)
     bboxes_text = ""
-    for i in range(len(bboxes)):
-        bbox = bboxes[i]
-        label = labels[i]
-        if bbox is None or label is None:
-            continue
-        bboxes_text += "%s,%s\n" % (__convert_bbox_to_text(bbox, scale, max_x, max_y), label)
+    for rect, i in zip(rects, indices):
+        bboxes_text += "%d,%d,%d,%d,%s\n" % (rect[0], rect[1], rect[2], rect[3], labels[i])
     return bboxes_text
 
 
-def __convert_rects_to_bboxes(rects):
-    bboxes = []
-    for rect in rects:
-        p0 = rect[:2]
-        p1 = rect[2:]
-        size = p1 - p0
-        bbox = np.array([p0, size]).reshape(-1)
-        bboxes.append(bbox)
-    return bboxes
-
-
 def validate_bboxes_text(s):
-    lines = s.split("\n")
-    count = 0
-    for line in lines:
-        if len(line) > 0:
-            try:
-                *rect, label = line.strip().split(",", 4)
-                assert(len(rect) == 4)
-                rect = np.array(rect, dtype=float).astype(int)
-                count += 1
-            except:
-                message = "Error: '%s' is not a valid argument." % s
-                logging.critical(message)
-                raise exceptions.HttpErrorBadRequest(message)
-    if count > constants.MAX_BOUNDING_BOX_PER_FRAME:
+    parsed = parse_text(s)
+    if not np.all(parsed.well_formed):
+        message = "Error: '%s' is not a valid argument." % s
+        logging.critical(message)
+        raise exceptions.HttpErrorBadRequest(message)
+    if len(parsed.labels) > constants.MAX_BOUNDING_BOX_PER_FRAME:
         message = "Error: '%s' contains too many bounding boxes." % s
         logging.critical(message)
         raise exceptions.HttpErrorBadRequest(message)
     return s
 
+def validate_bboxes_texts_json(s):
+    try:
+        l = json.loads(s)
+        valid = isinstance(l, list) and 0 < len(l) <= constants.MAX_FRAMES_PER_VIDEO
+        if valid:
+            for bboxes_text in l:
+                if not isinstance(bboxes_text, str):
+                    valid = False
+                    break
+    except:
+        valid = False
+    if not valid:
+        message = "Error: '%s' is not a valid argument." % s
+        logging.critical(message)
+        raise exceptions.HttpErrorBadRequest(message)
+    for bboxes_text in l:
+        validate_bboxes_text(bboxes_text)
+    return l
+
 def convert_text_to_rects_and_labels(bboxes_text):
-    rects = []
-    labels = []
-    lines = bboxes_text.split("\n")
-    for line in lines:
-        try:
-            *rect, label = line.strip().split(",", 4)
-            assert(len(rect) == 4)
-            # Ignore boxes with empty labels.
-            if label != '':
-                rect = np.array(rect, dtype=float).astype(int)
-                rects.append(rect)
-                labels.append(label)
-        except Exception as e:
-            continue
-    return rects, labels
+    # Returns an N x 4 int32 array of x1, y1, x2, y2 and a list of N labels.
+    parsed = parse_text(bboxes_text)
+    return parsed.rects[parsed.valid], __select_labels(parsed)
 
 
 def count_boxes(bboxes_text):
-    count = 0
-    lines = bboxes_text.split("\n")
-    for line in lines:
-        try:
-            *rect, label = line.strip().split(",", 4)
-            assert(len(rect) == 4)
-            # Ignore boxes with empty labels.
-            if label != '':
-                count += 1
-        except Exception as e:
-            continue
-    return count
+    return int(np.count_nonzero(parse_text(bboxes_text).valid))
 
 
-def __convert_text_to_bboxes_and_labels(bboxes_text):
+def parse_bboxes_text(bboxes_text, scale=1, frame_scale=1):
+    # Returns an N x 4 float array of x, y, width, height and a list of N labels.
+    # If frame_scale is not 1, the bboxes are mapped to a frame that was resized by frame_scale.
     rects, labels = convert_text_to_rects_and_labels(bboxes_text)
-    bboxes = __convert_rects_to_bboxes(rects)
-    return bboxes, labels
-
-
-def __scale_bboxes(bboxes, scale):
-    scaled_bboxes = []
-    for bbox in bboxes:
-        if bbox is None:
-            scaled_bboxes.append(None)
-        else:
-            p0 = bbox[:2].astype(float)
-            p1 = p0 + bbox[2:].astype(float)
-            size = p1 - p0
-            center = p0 + (size / 2)
-            new_size = scale * size
-            p0 = center - new_size / 2
-            p1 = center + new_size / 2
-            scaled_bboxes.append(np.array([p0, p1 - p0]).reshape(-1))
-    return scaled_bboxes
-
-
-def parse_bboxes_text(bboxes_text, scale=1):
-    bboxes_, labels = __convert_text_to_bboxes_and_labels(bboxes_text)
-    bboxes = __scale_bboxes(bboxes_, scale)
+    bboxes = np.concatenate((rects[:, :2], rects[:, 2:] - rects[:, :2]), axis=1)
+    bboxes = __scale_bboxes_array(bboxes, scale)
+    if frame_scale != 1:
+        bboxes = bboxes * frame_scale
     return bboxes, labels
 
 
 def extract_labels(bboxes_text):
-    labels = []
-    lines = bboxes_text.split("\n")
-    for line in lines:
-        try:
-            *rect, label = line.strip().split(",", 4)
-            assert(len(rect) == 4)
-            # Ignore boxes with empty labels.
-            if label != '':
-                labels.append(label)
-        except Exception as e:
-            continue
-    return labels
-
-
-def format_bboxes_text(bboxes, labels, scale, max_x, max_y):
-    return __convert_bboxes_and_labels_to_text(bboxes, 1 / scale, max_x, max_y, labels)
+    return __select_labels(parse_text(bboxes_text))
+
+
+def __select_labels(parsed):
+    return [label for label, valid in zip(parsed.labels, parsed.valid) if valid]
+
+
+def format_bboxes_text(bboxes, labels, scale, max_x, max_y, frame_scale=1):
+    # If frame_scale is not 1, the bboxes are in a frame that was resized by frame_scale, and max_x
+    # and max_y are the size of the source frame.
+    return __convert_bboxes_and_labels_to_text(bboxes, 1 / scale, max_x, max_y, labels, frame_scale)
+
+
+def interpolate_bboxes_texts(start_bboxes_text, end_bboxes_text, frame_count):
+    # Returns the bboxes text for the frame_count frames between two keyframes. Objects are matched
+    # by label. If a label occurs more than once, the occurrences are matched in order. Objects that
+    # aren't in both keyframes are left out.
+    start = parse_text(start_bboxes_text)
+    end = parse_text(end_bboxes_text)
+    dict_label_to_end_indices = collections.defaultdict(list)
+    for i in np.flatnonzero(end.valid):
+        dict_label_to_end_indices[end.labels[i]].append(i)
+    start_indices = []
+    end_indices = []
+    for i in np.flatnonzero(start.valid):
+        if len(dict_label_to_end_indices[start.labels[i]]) > 0:
+            start_indices.append(i)
+            end_indices.append(dict_label_to_end_indices[start.labels[i]].pop(0))
+    labels = [start.labels[i] for i in start_indices]
+    start_rects = start.rects[start_indices].astype(float)
+    end_rects = end.rects[end_indices].astype(float)
+    bboxes_texts = []
+    for n in range(1, frame_count + 1):
+        t = n / (frame_count + 1)
+        rects = np.rint(start_rects + t * (end_rects - start_rects)).astype(np.int64)
+        bboxes_text = ""
+        for rect, label in zip(rects, labels):
+            bboxes_text += "%d,%d,%d,%d,%s\n" % (rect[0], rect[1], rect[2], rect[3], label)
+        bboxes_texts.append(bboxes_text)
+    return bboxes_texts
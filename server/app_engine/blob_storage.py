@@ -21,6 +21,9 @@ import re
 import time
 import traceback
 
+# Other Modules
+import requests
+
 # My Modules
 import action
 import constants
@@ -30,6 +33,10 @@ BUCKET_BLOBS = ('%s-blobs' % constants.PROJECT_ID)
 
 CURRENT_SEASON = '2023_2024'
 
+# The size of each ranged download and each resumable upload chunk when streaming blobs. Resumable
+# upload chunks must be a multiple of 256 KiB.
+STREAMING_CHUNK_SIZE = 8 * 1024 * 1024
+
 # blob storage
 
 def __retrieve_blob(blob_name):
@@ -71,6 +78,125 @@ def __write_string_to_blob(blob_name, s, content_type):
             else:
                 raise
 
+class BlobReader():
+    # A read-only file object that downloads the blob in ranged chunks, so the whole blob is never
+    # held in memory.
+
+    def __init__(self, blob_name):
+        self.blob = util.storage_client().bucket(BUCKET_BLOBS).blob(blob_name)
+        # Reloading sets the size and generation. Setting the generation makes each ranged download
+        # read from the same version of the blob.
+        self.blob.reload()
+        self.size = self.blob.size
+        self.position = 0
+
+    def read(self, size=-1):
+        if self.position >= self.size:
+            return b''
+        if size is None or size < 0:
+            end = self.size
+        else:
+            end = min(self.size, self.position + size)
+        # Retry up to 5 times.
+        retry = 0
+        while True:
+            try:
+                data = self.blob.download_as_bytes(start=self.position, end=end - 1)
+                break
+            except:
+                if retry < 5:
+                    retry += 1
+                else:
+                    raise
+        self.position += len(data)
+        return data
+
+class BlobWriter():
+    # A write-only, non-seekable file object that uploads the blob with a resumable upload, one
+    # STREAMING_CHUNK_SIZE chunk at a time, so the whole blob is never held in memory. Call close()
+    # to upload the last chunk and finish the blob.
+
+    def __init__(self, blob_name, content_type, custom_time=None):
+        blob = util.storage_client().bucket(BUCKET_BLOBS).blob(blob_name)
+        if custom_time is not None:
+            blob.custom_time = custom_time
+        # The session URL identifies and authorizes the upload, so the chunks are sent to it without
+        # credentials.
+        self.session_url = blob.create_resumable_upload_session(content_type=content_type)
+        self.session = requests.Session()
+        # The bytes that have been written but not yet received by the server.
+        self.buffer = bytearray()
+        # The upload offset of self.buffer[0].
+        self.base = 0
+        self.bytes_written = 0
+        self.finished = False
+
+    def write(self, b):
+        self.buffer.extend(b)
+        self.bytes_written += len(b)
+        # Only send full chunks here. A chunk with the total size tells the server that the upload
+        # is finished.
+        while len(self.buffer) >= STREAMING_CHUNK_SIZE:
+            self.__transmit_next_chunk(False)
+        return len(b)
+
+    def tell(self):
+        return self.bytes_written
+
+    def flush(self):
+        pass
+
+    def close(self):
+        while not self.finished:
+            self.__transmit_next_chunk(True)
+
+    def __transmit_next_chunk(self, final):
+        if final:
+            chunk = bytes(self.buffer)
+            total = str(self.bytes_written)
+        else:
+            chunk = bytes(self.buffer[:STREAMING_CHUNK_SIZE])
+            total = '*'
+        if len(chunk) == 0:
+            content_range = 'bytes */%s' % total
+        else:
+            content_range = 'bytes %d-%d/%s' % (self.base, self.base + len(chunk) - 1, total)
+        # Retry up to 5 times. After a failure, ask the server how many bytes it has received, so the
+        # next chunk starts from there.
+        retry = 0
+        while True:
+            try:
+                if retry == 0:
+                    response = self.session.put(self.session_url, data=chunk,
+                        headers={'Content-Range': content_range})
+                else:
+                    response = self.session.put(self.session_url,
+                        headers={'Content-Range': 'bytes */*'})
+                self.__process_response(response)
+                return
+            except:
+                if retry < 5:
+                    retry += 1
+                else:
+                    raise
+
+    def __process_response(self, response):
+        if response.status_code in (200, 201):
+            self.finished = True
+            self.base += len(self.buffer)
+            self.buffer.clear()
+            return
+        if response.status_code != 308:
+            response.raise_for_status()
+            raise RuntimeError('Unexpected status %d from resumable upload' % response.status_code)
+        # The server has received the bytes in the range, if there is one. If it received only part
+        # of the chunk, the rest is sent again with the next chunk.
+        match = re.match(r'bytes=0-(\d+)$', response.headers.get('Range', ''))
+        received = int(match.group(1)) + 1 if match else 0
+        if received > self.base:
+            del self.buffer[:received - self.base]
+            self.base = received
+
 def __get_path(blob_name_or_folder):
     return 'gs://%s/%s' % (BUCKET_BLOBS, blob_name_or_folder)
 
@@ -138,8 +264,34 @@ def retrieve_video(video_blob_name):
 def write_video_to_file(video_blob_name, filename):
     return __write_blob_to_file(video_blob_name, filename)
 
+def get_video_blob_generation(video_blob_name):
+    blob = util.storage_client().get_bucket(BUCKET_BLOBS).get_blob(video_blob_name)
+    if blob is None:
+        return None
+    return blob.generation
+
+def write_video_generation_to_file(video_blob_name, generation, filename):
+    blob = util.storage_client().get_bucket(BUCKET_BLOBS).blob(video_blob_name, generation=generation)
+    blob.download_to_filename(filename)
+
 def delete_video_blob(video_blob_name):
     __delete_blob(video_blob_name)
+    __delete_blob(__get_video_index_blob_name(video_blob_name))
+
+# video seek index
+
+def __get_video_index_blob_name(video_blob_name):
+    # The seek index is stored next to the video blob.
+    return '%s.index' % video_blob_name
+
+def store_video_index(video_blob_name, video_index_json):
+    __write_string_to_blob(__get_video_index_blob_name(video_blob_name), video_index_json, 'application/json')
+
+def retrieve_video_index(video_blob_name):
+    blob = util.storage_client().get_bucket(BUCKET_BLOBS).blob(__get_video_index_blob_name(video_blob_name))
+    if blob.exists():
+        return blob.download_as_string()
+    return None
 
 # video frame images
 
@@ -183,8 +335,19 @@ def store_dataset_record(team_uuid, dataset_uuid, record_id, temp_record_filenam
     __write_file_to_blob(tf_record_blob_name, temp_record_filename, 'application/octet-stream')
     return tf_record_blob_name
 
-def retrieve_dataset_blob(blob_name):
-    return __retrieve_blob(blob_name)
+def get_dataset_blob_sizes(blob_names):
+    # Returns a dict mapping blob name to size, listing each folder once instead of getting each
+    # blob.
+    client = util.storage_client()
+    folders = set([blob_name[:blob_name.rfind('/')] for blob_name in blob_names])
+    dict_blob_name_to_size = {}
+    for folder in folders:
+        for blob in client.list_blobs(BUCKET_BLOBS, prefix='%s/' % folder):
+            dict_blob_name_to_size[blob.name] = blob.size
+    return dict_blob_name_to_size
+
+def open_dataset_blob(blob_name):
+    return BlobReader(blob_name)
 
 def delete_dataset_blob(blob_name):
     __delete_blob(blob_name)
@@ -192,15 +355,59 @@ def delete_dataset_blob(blob_name):
 def delete_dataset_blobs(blob_names):
     __delete_blobs(blob_names)
 
+# dataset frame shards
+
+def __get_dataset_frame_shard_folder(team_uuid, dataset_uuid):
+    return '%s/dataset_frame_shards/%s/%s' % (CURRENT_SEASON, team_uuid, dataset_uuid)
+
+def __get_dataset_frame_shard_blob_name(team_uuid, dataset_uuid, video_uuid, shard_index):
+    return '%s/%s/%05d' % (__get_dataset_frame_shard_folder(team_uuid, dataset_uuid), video_uuid, shard_index)
+
+def store_dataset_frame_shard(team_uuid, dataset_uuid, video_uuid, shard_index, shard):
+    blob_name = __get_dataset_frame_shard_blob_name(team_uuid, dataset_uuid, video_uuid, shard_index)
+    __write_string_to_blob(blob_name, shard, 'application/octet-stream')
+
+def retrieve_dataset_frame_shard_range(team_uuid, dataset_uuid, video_uuid, shard_index, start, length):
+    blob_name = __get_dataset_frame_shard_blob_name(team_uuid, dataset_uuid, video_uuid, shard_index)
+    blob = util.storage_client().bucket(BUCKET_BLOBS).blob(blob_name)
+    # Retry up to 5 times.
+    retry = 0
+    while True:
+        try:
+            return blob.download_as_bytes(start=start, end=start + length - 1)
+        except:
+            if retry < 5:
+                retry += 1
+            else:
+                raise
+
+def delete_dataset_frame_shards(team_uuid, dataset_uuid):
+    client = util.storage_client()
+    prefix = '%s/' % __get_dataset_frame_shard_folder(team_uuid, dataset_uuid)
+    blob_names = [blob.name for blob in client.list_blobs(BUCKET_BLOBS, prefix=prefix)]
+    if len(blob_names) > 0:
+        __delete_blobs(blob_names)
+
 # dataset zips
 
 def __get_dataset_zip_blob_name(team_uuid, dataset_zip_uuid, partition_index):
     return '%s/dataset_zips/%s/%s/%s' % (CURRENT_SEASON, team_uuid, dataset_zip_uuid, partition_index)
 
-def store_dataset_zip(team_uuid, dataset_zip_uuid, partition_index, zip_data):
+def open_dataset_zip_writer(team_uuid, dataset_zip_uuid, partition_index):
     blob_name = __get_dataset_zip_blob_name(team_uuid, dataset_zip_uuid, partition_index)
-    __write_string_to_blob(blob_name, zip_data, 'application/zip')
-    return blob_name
+    # The bucket's lifecycle rule deletes blobs some days after their custom time. Only dataset zips
+    # have a custom time.
+    return BlobWriter(blob_name, 'application/zip', custom_time=datetime.utcnow())
+
+def touch_dataset_zip(team_uuid, dataset_zip_uuid, partition_count):
+    # Sets the custom time of the dataset zips to now, so the bucket's lifecycle rule doesn't delete
+    # them while they are still being used.
+    bucket = util.storage_client().bucket(BUCKET_BLOBS)
+    for partition_index in range(partition_count):
+        blob = bucket.get_blob(__get_dataset_zip_blob_name(team_uuid, dataset_zip_uuid, partition_index))
+        if blob is not None:
+            blob.custom_time = datetime.utcnow()
+            blob.patch()
 
 def get_dataset_zip_download_url(team_uuid, dataset_zip_uuid, partition_count):
     exists_array = []
@@ -22,12 +22,16 @@ PROJECT_ID = os.getenv('PROJECT_ID')
 # ORIGIN is set in the environment in app engine, but not cloud functions.
 ORIGIN = os.getenv('ORIGIN')
 
-# REDIS_IP_ADDR may be set in the environment in app engine, but not cloud functions.
+# REDIS_IP_ADDR may be set in the environment in app engine and cloud functions.
 REDIS_IP_ADDR = os.getenv('REDIS_IP_ADDR')
 
 # Expects to be 'development' or 'production'
 ENVIRONMENT = os.getenv('ENVIRONMENT')
 
+# STREAMING_RESPONSES is set to 'true' in the environment when the web tier runs from
+# app_engine/Dockerfile. App Engine standard buffers responses, so it can't stream large downloads.
+STREAMING_RESPONSES = os.getenv('STREAMING_RESPONSES') == 'true'
+
 
 TOTAL_TRAINING_MINUTES_PER_TEAM = 600
 
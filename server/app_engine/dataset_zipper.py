@@ -15,32 +15,205 @@
 __author__ = "lizlooney@google.com (Liz Looney)"
 
 # Python Standard Library
+from datetime import datetime, timedelta, timezone
+import hashlib
+import heapq
+import json
+import logging
 import math
+import os
+import traceback
 import uuid
+import zipfile
 
 # My Modules
 import action
+import blob_storage
+import exceptions
 import storage
 
+# Files are packed into partitions of about this many bytes, so the partitions take about the same
+# time to zip and download.
+TARGET_PARTITION_BYTES = 250000000
+# Zips of completed datasets are kept and reused until they haven't been downloaded for this long.
+DATASET_ZIP_CACHE_TIME = timedelta(days=7)
+# A zip that is not finished and hasn't made progress for this long is zipped again.
+DATASET_ZIP_STALE_TIME = timedelta(minutes=15)
+
 
 def prepare_to_zip_dataset(team_uuid, dataset_uuid):
-    dataset_zip_uuid = str(uuid.uuid4().hex)
-    max_files_per_partition = 10
+    # Returns dataset_zip_uuid, partition_lists, whether the zips already exist or are already
+    # being made, and whether the zips are kept for reuse. If the zips already exist or are already
+    # being made, the caller must not trigger the zip action. If the zips are not kept for reuse, the
+    # caller should delete them after downloading them.
     # storage.retrieve_dataset_entity will raise HttpErrorNotFound
     # if the team_uuid/dataset_uuid is not found.
     dataset_entity = storage.retrieve_dataset_entity(team_uuid, dataset_uuid)
-    total_file_count = dataset_entity['total_record_count'] + 1
-    partition_count = math.ceil(total_file_count / max_files_per_partition)
-    storage.create_dataset_zippers(team_uuid, dataset_zip_uuid, partition_count)
+    blob_names = __retrieve_dataset_blob_names(dataset_entity)
+    dict_blob_name_to_size = blob_storage.get_dataset_blob_sizes(blob_names)
+    partition_lists = __pack_partitions(blob_names, dict_blob_name_to_size)
     storage.increment_datasets_downloaded_today(team_uuid)
-    return dataset_zip_uuid, partition_count
+    __delete_expired_dataset_zips(team_uuid)
+
+    if not dataset_entity['dataset_completed']:
+        # The dataset may still change, so don't cache the zips.
+        dataset_zip_uuid = str(uuid.uuid4().hex)
+        storage.create_dataset_zippers(team_uuid, dataset_uuid, dataset_zip_uuid, len(partition_lists), False)
+        return dataset_zip_uuid, partition_lists, False, False
+
+    # A completed dataset doesn't change, so the zips are identified by the dataset and the
+    # partitions.
+    dataset_zip_uuid = __get_dataset_zip_uuid(dataset_uuid, partition_lists)
+    dataset_zipper_entities = storage.retrieve_dataset_zippers(team_uuid, dataset_zip_uuid)
+    if len(dataset_zipper_entities) != 0:
+        if __is_dataset_zip_usable(team_uuid, dataset_zip_uuid, dataset_zipper_entities, len(partition_lists)):
+            storage.update_dataset_zippers_last_used_time(dataset_zipper_entities)
+            # Push back the time when the bucket's lifecycle rule deletes the zips.
+            blob_storage.touch_dataset_zip(team_uuid, dataset_zip_uuid, len(partition_lists))
+            return dataset_zip_uuid, partition_lists, True, True
+        __delete_dataset_zip(team_uuid, dataset_zipper_entities)
+    # If another request created the dataset zippers since we looked, it will trigger the zip action.
+    created = storage.create_dataset_zippers(team_uuid, dataset_uuid, dataset_zip_uuid, len(partition_lists), True)
+    return dataset_zip_uuid, partition_lists, not created, True
+
+def __retrieve_dataset_blob_names(dataset_entity):
+    blob_names = [dataset_entity['label_map_blob_name']]
+    dataset_record_entities = storage.retrieve_dataset_records(dataset_entity)
+    for dataset_record_entity in dataset_record_entities:
+        blob_names.append(dataset_record_entity['tf_record_blob_name'])
+    return blob_names
+
+def __get_dataset_zip_uuid(dataset_uuid, partition_lists):
+    key = json.dumps([dataset_uuid, partition_lists])
+    # The dataset zip uuid has the same form as a uuid4 hex, so it passes storage.validate_uuid.
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
 
-def make_action_parameters(team_uuid, dataset_uuid, dataset_zip_uuid, partition_count):
+def __is_dataset_zip_usable(team_uuid, dataset_zip_uuid, dataset_zipper_entities, partition_count):
+    if len(dataset_zipper_entities) != partition_count:
+        return False
+    exists_array, download_url_array = blob_storage.get_dataset_zip_download_url(
+        team_uuid, dataset_zip_uuid, partition_count)
+    if all(exists_array):
+        return True
+    # The zips are not finished. Use them if they are still being made.
+    last_update_time = max([dataset_zipper_entity['update_time'] for dataset_zipper_entity in dataset_zipper_entities])
+    return datetime.now(timezone.utc) - last_update_time < DATASET_ZIP_STALE_TIME
+
+def __delete_dataset_zip(team_uuid, dataset_zipper_entities):
+    for dataset_zipper_entity in dataset_zipper_entities:
+        # blob_storage.delete_dataset_zip does nothing
+        # if the team_uuid/dataset_zip_uuid/partition_index is not found
+        blob_storage.delete_dataset_zip(team_uuid, dataset_zipper_entity['dataset_zip_uuid'],
+            dataset_zipper_entity['partition_index'])
+    storage.delete_dataset_zippers(dataset_zipper_entities)
+
+def __delete_expired_dataset_zips(team_uuid):
+    expired_dataset_zipper_entities = []
+    for dataset_zipper_entity in storage.retrieve_dataset_zippers_for_team(team_uuid):
+        # Dataset zippers created before zips were cached don't have last_used_time.
+        last_used_time = dataset_zipper_entity.get('last_used_time', dataset_zipper_entity['update_time'])
+        if datetime.now(timezone.utc) - last_used_time >= DATASET_ZIP_CACHE_TIME:
+            expired_dataset_zipper_entities.append(dataset_zipper_entity)
+    if len(expired_dataset_zipper_entities) != 0:
+        __delete_dataset_zip(team_uuid, expired_dataset_zipper_entities)
+
+def __pack_partitions(blob_names, dict_blob_name_to_size):
+    total_bytes = sum([dict_blob_name_to_size.get(blob_name, 0) for blob_name in blob_names])
+    partition_count = min(len(blob_names), max(1, math.ceil(total_bytes / TARGET_PARTITION_BYTES)))
+    # Largest file first, each into the partition that has the fewest bytes so far.
+    heap = [(0, partition_index) for partition_index in range(partition_count)]
+    partition_lists = [[] for i in range(partition_count)]
+    sorted_blob_names = sorted(blob_names, key=lambda blob_name: dict_blob_name_to_size.get(blob_name, 0),
+        reverse=True)
+    for blob_name in sorted_blob_names:
+        partition_bytes, partition_index = heapq.heappop(heap)
+        partition_lists[partition_index].append(blob_name)
+        heapq.heappush(heap, (partition_bytes + dict_blob_name_to_size.get(blob_name, 0), partition_index))
+    # Keep the files in each partition in their original order.
+    dict_blob_name_to_index = {blob_name: i for i, blob_name in enumerate(blob_names)}
+    for partition_list in partition_lists:
+        partition_list.sort(key=lambda blob_name: dict_blob_name_to_index[blob_name])
+    return partition_lists
+
+def make_action_parameters(team_uuid, dataset_uuid, dataset_zip_uuid, partition_lists):
     action_parameters = action.create_action_parameters(
         team_uuid, action.ACTION_NAME_DATASET_ZIP)
     action_parameters['team_uuid'] = team_uuid
     action_parameters['dataset_uuid'] = dataset_uuid
     action_parameters['dataset_zip_uuid'] = dataset_zip_uuid
-    action_parameters['partition_count']  = partition_count
+    action_parameters['partition_lists'] = partition_lists
     return action_parameters
 
+# single zip download
+
+def open_dataset_blobs_for_zip(team_uuid, dataset_uuid):
+    # Returns a list of BlobReaders for the files of the dataset. Everything that can fail before the
+    # zip is streamed is done here, while an error can still be returned as an HTTP status.
+    # storage.retrieve_dataset_entity will raise HttpErrorNotFound
+    # if the team_uuid/dataset_uuid is not found.
+    dataset_entity = storage.retrieve_dataset_entity(team_uuid, dataset_uuid)
+    if not dataset_entity['dataset_completed']:
+        message = 'Error: Dataset dataset_uuid=%s is not completed.' % dataset_uuid
+        logging.critical(message)
+        raise exceptions.HttpErrorUnprocessableEntity(message)
+    blob_names = __retrieve_dataset_blob_names(dataset_entity)
+    dict_blob_name_to_size = blob_storage.get_dataset_blob_sizes(blob_names)
+    for blob_name in blob_names:
+        if blob_name not in dict_blob_name_to_size:
+            message = 'Error: Blob %s for dataset_uuid=%s not found.' % (blob_name, dataset_uuid)
+            logging.critical(message)
+            raise exceptions.HttpErrorNotFound(message)
+    return [blob_storage.open_dataset_blob(blob_name) for blob_name in blob_names]
+
+def generate_dataset_zip(dataset_uuid, blob_readers):
+    # Yields the zip of the given blobs, piece by piece, as it is built. Nothing is staged, so memory
+    # use is bounded by blob_storage.STREAMING_CHUNK_SIZE. The files are stored without compression
+    # because the records are mostly PNG or JPEG images and deflating them would cost CPU in the web
+    # tier for almost no savings.
+    zip_stream = ZipStream()
+    try:
+        with zipfile.ZipFile(zip_stream, "w", zipfile.ZIP_STORED, allowZip64=True) as zip_file:
+            for blob_reader in blob_readers:
+                filename = os.path.basename(blob_reader.blob.name)
+                force_zip64 = blob_reader.size > zipfile.ZIP64_LIMIT
+                with zip_file.open(filename, "w", force_zip64=force_zip64) as zip_entry:
+                    while True:
+                        data = blob_reader.read(blob_storage.STREAMING_CHUNK_SIZE)
+                        if len(data) == 0:
+                            break
+                        zip_entry.write(data)
+                        yield zip_stream.pop()
+                yield zip_stream.pop()
+        # Closing the zip file writes the central directory.
+        yield zip_stream.pop()
+    except Exception:
+        # The status and headers have already been sent. Re-raising makes the server drop the
+        # connection without the final chunk, so the client sees a failed download instead of a
+        # truncated zip.
+        logging.critical('Error: Streaming the zip for dataset_uuid=%s failed. %s' % (
+            dataset_uuid, traceback.format_exc().replace('\n', ' ... ')))
+        raise
+
+class ZipStream():
+    # A write-only, non-seekable file object for zipfile.ZipFile. pop() returns the bytes that have
+    # been written since the last pop().
+
+    def __init__(self):
+        self.data = bytearray()
+        self.bytes_written = 0
+
+    def write(self, b):
+        self.data.extend(b)
+        self.bytes_written += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.bytes_written
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = bytes(self.data)
+        self.data.clear()
+        return data
@@ -15,15 +15,18 @@
 __author__ = "lizlooney@google.com (Liz Looney)"
 
 # Python Standard Library
+import collections
 from datetime import datetime, timedelta, timezone
 import dateutil.parser
 import json
 import logging
+import threading
 import time
 import traceback
 import uuid
 
 # Other Modules
+from google.api_core.exceptions import Aborted, Conflict
 from google.cloud import datastore
 
 # My Modules
@@ -32,6 +35,8 @@ import bbox_writer
 import blob_storage
 import constants
 import exceptions
+import tracking_channel
+import tracking_metrics
 import util
 
 DS_KIND_TEAM = 'Team'
@@ -48,6 +53,13 @@ DS_KIND_MODEL_SUMMARY_ITEMS = 'ModelSummaryItems'
 DS_KIND_ACTION = 'Action'
 DS_KIND_ADMIN_ACTION = 'AdminAction'
 DS_KIND_END_OF_SEASON = 'EndOfSeason'
+DS_KIND_TRACKING_LATENCY = 'TrackingLatency'
+
+# How long the web tier may reuse a tracker entity that it has already retrieved.
+TRACKER_ENTITY_CACHE_SECONDS = 1
+
+__tracker_entity_cache_lock = threading.Lock()
+__tracker_entity_cache = {}
 
 
 def validate_uuid(s):
@@ -241,6 +253,7 @@ def create_video_entity(team_uuid, video_uuid, description, video_filename, file
             'video_blob_name': blob_storage.get_video_blob_name(team_uuid, video_uuid),
             'entity_create_time': datetime.now(timezone.utc),
             'frame_extraction_failed': False,
+            'frame_extraction_done': False,
             'frame_extraction_triggered_time_ms': 0,
             'frame_extraction_active_time_ms': 0,
             'extracted_frame_count': 0,
@@ -277,8 +290,12 @@ def frame_extraction_active(team_uuid, video_uuid):
         transaction.put(video_entity)
         return video_entity
 
-def frame_extraction_starting(team_uuid, video_uuid, width, height, fps, frame_count):
-    __store_video_frames(team_uuid, video_uuid, frame_count)
+def frame_extraction_starting(team_uuid, video_uuid, width, height, fps, frame_count,
+        create_video_frames=True):
+    # If create_video_frames is False, frame_count is only an estimate and the video frame entities
+    # are created by store_frame_images as the frames are extracted.
+    if create_video_frames:
+        __store_video_frames(team_uuid, video_uuid, frame_count)
     datastore_client = datastore.Client()
     with datastore_client.transaction() as transaction:
         video_entity = retrieve_video_entity(team_uuid, video_uuid)
@@ -298,6 +315,7 @@ def frame_extraction_done(team_uuid, video_uuid, frame_count):
         video_entity = retrieve_video_entity(team_uuid, video_uuid)
         if frame_count > 0:
             video_entity['frame_count'] = frame_count
+        video_entity['frame_extraction_done'] = True
         video_entity['frame_extraction_end_time'] = datetime.now(timezone.utc)
         video_entity['frame_extraction_active_time'] = video_entity['frame_extraction_end_time']
         video_entity['frame_extraction_active_time_ms'] = util.ms_from_datetime(video_entity['frame_extraction_active_time'])
@@ -392,7 +410,7 @@ def retrieve_video_entity_for_labeling(team_uuid, video_uuid):
         if video_entity['tracking_in_progress']:
             tracking_in_progress = True
             tracker_uuid = video_entity['tracker_uuid']
-            tracker_entity = maybe_retrieve_tracker_entity(video_uuid, tracker_uuid)
+            tracker_entity = __maybe_retrieve_cached_tracker_entity(video_uuid, tracker_uuid)
             if tracker_entity is None:
                 tracking_in_progress = False
                 logging.warning('Tracker is not in progress. Tracker entity is missing.')
@@ -560,7 +578,19 @@ def __query_video_frame(team_uuid, video_uuid, min_frame_number, max_frame_numbe
     return video_frame_entities
 
 
+def __get_video_frame_key(datastore_client, team_uuid, video_uuid, frame_number):
+    # Video frame entities have keys derived from the team_uuid, video_uuid, and frame_number, so
+    # they can be looked up without a query. Video frame entities that were created before that have
+    # numeric ids and must be found with a query.
+    return datastore_client.key(DS_KIND_VIDEO_FRAME, '%s/%s/%d' % (team_uuid, video_uuid, frame_number))
+
+
 def __retrieve_video_frame_entity(team_uuid, video_uuid, frame_number):
+    datastore_client = datastore.Client()
+    video_frame_entity = datastore_client.get(
+        __get_video_frame_key(datastore_client, team_uuid, video_uuid, frame_number))
+    if video_frame_entity is not None:
+        return video_frame_entity
     video_frame_entities = __query_video_frame(team_uuid, video_uuid, frame_number, frame_number)
     if len(video_frame_entities) == 0:
         message = 'Error: Video frame entity for video_uuid=%s frame_number=%d not found.' % (video_uuid, frame_number)
@@ -585,40 +615,75 @@ def __store_video_frames_batch(team_uuid, video_uuid, frame_numbers):
     batch = datastore_client.batch()
     batch.begin()
     for frame_number in frame_numbers:
-        incomplete_key = datastore_client.key(DS_KIND_VIDEO_FRAME)
-        video_frame_entity = datastore.Entity(key=incomplete_key)
-        video_frame_entity.update({
-            'team_uuid': team_uuid,
-            'video_uuid': video_uuid,
-            'frame_number': frame_number,
-            'include_frame_in_dataset': True,
-            'bboxes_text': '',
-        })
-        batch.put(video_frame_entity)
+        batch.put(__create_video_frame_entity(datastore_client, team_uuid, video_uuid, frame_number))
     batch.commit()
 
+def __create_video_frame_entity(datastore_client, team_uuid, video_uuid, frame_number):
+    key = __get_video_frame_key(datastore_client, team_uuid, video_uuid, frame_number)
+    video_frame_entity = datastore.Entity(key=key)
+    video_frame_entity.update({
+        'team_uuid': team_uuid,
+        'video_uuid': video_uuid,
+        'frame_number': frame_number,
+        'include_frame_in_dataset': True,
+        'bboxes_text': '',
+    })
+    return video_frame_entity
+
 # video frame - public methods
 
 def retrieve_video_frame_entities(team_uuid, video_uuid, min_frame_number, max_frame_number):
     return __query_video_frame(team_uuid, video_uuid, min_frame_number, max_frame_number)
 
 
-def store_frame_image(team_uuid, video_uuid, frame_number, content_type, image_data):
-    image_blob_name = blob_storage.store_video_frame_image(team_uuid, video_uuid, frame_number, content_type, image_data)
+# Returns a dict where keys are frame numbers and values are video frame entities.
+def retrieve_video_frame_entities_for_frame_numbers(team_uuid, video_uuid, frame_number_list):
+    datastore_client = datastore.Client()
+    frame_numbers = sorted(set(frame_number_list))
+    dict_frame_number_to_video_frame_entity = {}
+    # Look up the entities by key, 1000 at a time.
+    for i in range(0, len(frame_numbers), 1000):
+        keys = [__get_video_frame_key(datastore_client, team_uuid, video_uuid, frame_number)
+            for frame_number in frame_numbers[i:i+1000]]
+        for video_frame_entity in datastore_client.get_multi(keys):
+            dict_frame_number_to_video_frame_entity[video_frame_entity['frame_number']] = video_frame_entity
+    missing_frame_numbers = set(frame_numbers) - dict_frame_number_to_video_frame_entity.keys()
+    if len(missing_frame_numbers) > 0:
+        # These video frame entities were created before keys were derived from the frame number.
+        video_frame_entities = __query_video_frame(team_uuid, video_uuid,
+            min(missing_frame_numbers), max(missing_frame_numbers))
+        for video_frame_entity in video_frame_entities:
+            if video_frame_entity['frame_number'] in missing_frame_numbers:
+                dict_frame_number_to_video_frame_entity[video_frame_entity['frame_number']] = video_frame_entity
+    return dict_frame_number_to_video_frame_entity
+
+
+def store_frame_images(team_uuid, video_uuid, min_frame_number, content_type, image_blob_names):
+    # The images for frames min_frame_number through min_frame_number + len(image_blob_names) - 1
+    # have already been written to blob storage. Update all of their video frame entities and the
+    # video entity in one transaction. Video frame entities that don't exist yet, because the frames
+    # are being counted while they are extracted, are created here.
+    max_frame_number = min_frame_number + len(image_blob_names) - 1
     datastore_client = datastore.Client()
     with datastore_client.transaction() as transaction:
-        video_frame_entity = __retrieve_video_frame_entity(team_uuid, video_uuid, frame_number)
-        video_frame_entity['content_type'] = content_type
-        video_frame_entity['image_blob_name'] = image_blob_name
-        transaction.put(video_frame_entity)
+        video_frame_entities = __query_video_frame(team_uuid, video_uuid, min_frame_number, max_frame_number)
+        found_frame_numbers = set([video_frame_entity['frame_number'] for video_frame_entity in video_frame_entities])
+        for frame_number in range(min_frame_number, max_frame_number + 1):
+            if frame_number not in found_frame_numbers:
+                video_frame_entities.append(
+                    __create_video_frame_entity(datastore_client, team_uuid, video_uuid, frame_number))
+        for video_frame_entity in video_frame_entities:
+            video_frame_entity['content_type'] = content_type
+            video_frame_entity['image_blob_name'] = image_blob_names[video_frame_entity['frame_number'] - min_frame_number]
+            transaction.put(video_frame_entity)
         # Also update the video_entity in the same transaction.
         video_entity = retrieve_video_entity(team_uuid, video_uuid)
-        video_entity['extracted_frame_count'] = frame_number + 1
-        video_entity['included_frame_count'] = frame_number + 1
+        video_entity['extracted_frame_count'] = max_frame_number + 1
+        video_entity['included_frame_count'] = max_frame_number + 1
         video_entity['frame_extraction_active_time'] = datetime.now(timezone.utc)
         video_entity['frame_extraction_active_time_ms'] = util.ms_from_datetime(video_entity['frame_extraction_active_time'])
         transaction.put(video_entity)
-        # Return the video entity, not the video frame entity!
+        # Return the video entity, not the video frame entities!
         return video_entity
 
 
@@ -638,35 +703,158 @@ def store_video_frame_bboxes_text(team_uuid, video_uuid, frame_number, bboxes_te
         return __store_video_frame_bboxes_text(transaction, team_uuid, video_uuid, frame_number, bboxes_text)
 
 def __store_video_frame_bboxes_text(transaction, team_uuid, video_uuid, frame_number, bboxes_text):
-    video_frame_entity = __retrieve_video_frame_entity(team_uuid, video_uuid, frame_number)
-    previously_had_labels = len(video_frame_entity['bboxes_text']) > 0
-    now_has_labels = len(bboxes_text) > 0
+    video_frame_entity = __retrieve_video_frame_entity_in_transaction(transaction, team_uuid, video_uuid, frame_number)
+    previous_bboxes_text = video_frame_entity['bboxes_text']
     video_frame_entity['bboxes_text'] = bboxes_text
     transaction.put(video_frame_entity)
-    if previously_had_labels != now_has_labels:
+    included = video_frame_entity['include_frame_in_dataset']
+    if __bboxes_text_change_affects_video_entity(included, previous_bboxes_text, bboxes_text):
         # Also update the video_entity in the same transaction.
-        video_entity = retrieve_video_entity(team_uuid, video_uuid)
-        if now_has_labels:
-            video_entity['labeled_frame_count'] += 1
-        else:
-            video_entity['labeled_frame_count'] -= 1
+        video_entity = __retrieve_video_entity_in_transaction(transaction, team_uuid, video_uuid)
+        __update_video_entity_for_bboxes_text(video_entity, frame_number,
+            included, previous_bboxes_text, bboxes_text)
         transaction.put(video_entity)
     return video_frame_entity
 
+def __bboxes_text_change_affects_video_entity(included, previous_bboxes_text, bboxes_text):
+    previously_had_labels = len(previous_bboxes_text) > 0
+    now_has_labels = len(bboxes_text) > 0
+    if previously_had_labels != now_has_labels:
+        return True
+    # Moving or resizing boxes doesn't change the label summary, so the video entity is only written
+    # when the labels of an included frame change.
+    return included and (collections.Counter(bbox_writer.extract_labels(previous_bboxes_text)) !=
+        collections.Counter(bbox_writer.extract_labels(bboxes_text)))
+
+def __update_video_entity_for_bboxes_text(video_entity, frame_number,
+        included, previous_bboxes_text, bboxes_text):
+    previously_had_labels = len(previous_bboxes_text) > 0
+    now_has_labels = len(bboxes_text) > 0
+    if now_has_labels and not previously_had_labels:
+        video_entity['labeled_frame_count'] += 1
+    elif previously_had_labels and not now_has_labels:
+        video_entity['labeled_frame_count'] -= 1
+    __update_label_summary(video_entity, frame_number,
+        included, previous_bboxes_text, included, bboxes_text)
+
+# Stores bboxes_texts for consecutive frames, starting at min_frame_number. Frames whose bboxes
+# haven't changed are not written. The video entity is updated once per transaction.
+# If dict_frame_number_to_expected_bboxes_text is given, the first transaction raises
+# HttpErrorConflict if the bboxes_text of any of those frames is not the expected value.
+def __store_video_frame_bboxes_texts(team_uuid, video_uuid, min_frame_number, bboxes_texts,
+        dict_frame_number_to_expected_bboxes_text=None):
+    frame_numbers = [min_frame_number + i for i in range(len(bboxes_texts))]
+    datastore_client = datastore.Client()
+    # A transaction can write at most 500 entities, including the video entity.
+    for i in range(0, len(frame_numbers), 499):
+        with datastore_client.transaction() as transaction:
+            # Read the video frame entities inside the transaction so that a concurrent write to
+            # one of them causes this transaction to be retried instead of being overwritten.
+            dict_frame_number_to_video_frame_entity = __retrieve_video_frame_entities_in_transaction(
+                datastore_client, transaction, team_uuid, video_uuid, frame_numbers[i:i+499])
+            if i == 0 and dict_frame_number_to_expected_bboxes_text is not None:
+                dict_frame_number_to_checked_entity = __retrieve_video_frame_entities_in_transaction(
+                    datastore_client, transaction, team_uuid, video_uuid,
+                    list(dict_frame_number_to_expected_bboxes_text.keys()))
+                for frame_number, expected_bboxes_text in dict_frame_number_to_expected_bboxes_text.items():
+                    if dict_frame_number_to_checked_entity[frame_number]['bboxes_text'] != expected_bboxes_text:
+                        message = 'Error: Bboxes for video_uuid=%s frame_number=%d were changed.' % (video_uuid, frame_number)
+                        logging.critical(message)
+                        raise exceptions.HttpErrorConflict(message)
+            video_entity = None
+            for frame_number, bboxes_text in zip(frame_numbers[i:i+499], bboxes_texts[i:i+499]):
+                video_frame_entity = dict_frame_number_to_video_frame_entity[frame_number]
+                previous_bboxes_text = video_frame_entity['bboxes_text']
+                if bboxes_text == previous_bboxes_text:
+                    continue
+                video_frame_entity['bboxes_text'] = bboxes_text
+                transaction.put(video_frame_entity)
+                included = video_frame_entity['include_frame_in_dataset']
+                if __bboxes_text_change_affects_video_entity(included, previous_bboxes_text, bboxes_text):
+                    if video_entity is None:
+                        video_entity = __retrieve_video_entity_in_transaction(transaction, team_uuid, video_uuid)
+                    __update_video_entity_for_bboxes_text(video_entity, frame_number,
+                        included, previous_bboxes_text, bboxes_text)
+            if video_entity is not None:
+                transaction.put(video_entity)
+
+# The query that finds the video entity is not part of a transaction, so the video entity is read
+# again by key in the given transaction. Otherwise concurrent updates could be lost.
+def __retrieve_video_entity_in_transaction(transaction, team_uuid, video_uuid):
+    key = retrieve_video_entity(team_uuid, video_uuid).key
+    return datastore.Client().get(key, transaction=transaction)
+
+def __retrieve_video_frame_entity_in_transaction(transaction, team_uuid, video_uuid, frame_number):
+    return __retrieve_video_frame_entities_in_transaction(datastore.Client(), transaction,
+        team_uuid, video_uuid, [frame_number])[frame_number]
+
+# Returns a dict where keys are frame numbers and values are video frame entities, read in the given
+# transaction. Raises HttpErrorNotFound if any of the video frame entities is not found.
+def __retrieve_video_frame_entities_in_transaction(datastore_client, transaction,
+        team_uuid, video_uuid, frame_numbers):
+    keys = [__get_video_frame_key(datastore_client, team_uuid, video_uuid, frame_number)
+        for frame_number in frame_numbers]
+    dict_frame_number_to_video_frame_entity = {}
+    for video_frame_entity in datastore_client.get_multi(keys, transaction=transaction):
+        dict_frame_number_to_video_frame_entity[video_frame_entity['frame_number']] = video_frame_entity
+    missing_frame_numbers = set(frame_numbers) - dict_frame_number_to_video_frame_entity.keys()
+    if len(missing_frame_numbers) > 0:
+        # These video frame entities were created before keys were derived from the frame number.
+        # Find their keys with a query and then read them in the transaction.
+        keys = [video_frame_entity.key for video_frame_entity in __query_video_frame(
+                team_uuid, video_uuid, min(missing_frame_numbers), max(missing_frame_numbers))
+            if video_frame_entity['frame_number'] in missing_frame_numbers]
+        for video_frame_entity in datastore_client.get_multi(keys, transaction=transaction):
+            dict_frame_number_to_video_frame_entity[video_frame_entity['frame_number']] = video_frame_entity
+    for frame_number in frame_numbers:
+        if frame_number not in dict_frame_number_to_video_frame_entity:
+            message = 'Error: Video frame entity for video_uuid=%s frame_number=%d not found.' % (video_uuid, frame_number)
+            logging.critical(message)
+            raise exceptions.HttpErrorNotFound(message)
+    return dict_frame_number_to_video_frame_entity
+
+# Interpolates the bboxes for the frames between two keyframes and stores them in one batch. Returns
+# the interpolated bboxes texts, starting with the frame after start_frame_number.
+def store_interpolated_video_frame_bboxes_text(team_uuid, video_uuid, start_frame_number, end_frame_number):
+    dict_frame_number_to_video_frame_entity = retrieve_video_frame_entities_for_frame_numbers(
+        team_uuid, video_uuid, [start_frame_number, end_frame_number])
+    for frame_number in [start_frame_number, end_frame_number]:
+        if frame_number not in dict_frame_number_to_video_frame_entity:
+            message = 'Error: Video frame entity for video_uuid=%s frame_number=%d not found.' % (video_uuid, frame_number)
+            logging.critical(message)
+            raise exceptions.HttpErrorNotFound(message)
+    dict_frame_number_to_keyframe_bboxes_text = {
+        start_frame_number: dict_frame_number_to_video_frame_entity[start_frame_number]['bboxes_text'],
+        end_frame_number: dict_frame_number_to_video_frame_entity[end_frame_number]['bboxes_text'],
+    }
+    bboxes_texts = bbox_writer.interpolate_bboxes_texts(
+        dict_frame_number_to_keyframe_bboxes_text[start_frame_number],
+        dict_frame_number_to_keyframe_bboxes_text[end_frame_number],
+        end_frame_number - start_frame_number - 1)
+    if len(bboxes_texts) > 0:
+        # Check that the keyframes still have the bboxes that were interpolated, in the same
+        # transaction that stores the first interpolated frames.
+        __store_video_frame_bboxes_texts(team_uuid, video_uuid, start_frame_number + 1, bboxes_texts,
+            dict_frame_number_to_keyframe_bboxes_text)
+    return bboxes_texts
+
 def store_video_frame_include_in_dataset(team_uuid, video_uuid, frame_number, include_frame_in_dataset):
     datastore_client = datastore.Client()
     with datastore_client.transaction() as transaction:
-        video_frame_entity = __retrieve_video_frame_entity(team_uuid, video_uuid, frame_number)
+        video_frame_entity = __retrieve_video_frame_entity_in_transaction(transaction, team_uuid, video_uuid, frame_number)
         previous_include_frame_in_dataset = video_frame_entity['include_frame_in_dataset']
         if include_frame_in_dataset != previous_include_frame_in_dataset:
             video_frame_entity['include_frame_in_dataset'] = include_frame_in_dataset
             transaction.put(video_frame_entity)
             # Also update the video_entity in the same transaction.
-            video_entity = retrieve_video_entity(team_uuid, video_uuid)
+            video_entity = __retrieve_video_entity_in_transaction(transaction, team_uuid, video_uuid)
             if include_frame_in_dataset:
                 video_entity['included_frame_count'] += 1
             else:
                 video_entity['included_frame_count'] -= 1
+            __update_label_summary(video_entity, frame_number,
+                previous_include_frame_in_dataset, video_frame_entity['bboxes_text'],
+                include_frame_in_dataset, video_frame_entity['bboxes_text'])
             transaction.put(video_entity)
         return video_frame_entity
 
@@ -681,6 +869,84 @@ def retrieve_video_frame_entities_with_image_urls(team_uuid, video_uuid,
         video_frame_entity['image_url'] = image_urls[i]
     return video_frame_entities
 
+# video label summary - private methods
+
+# The label summary is stored in the video entity. It describes the frames that are included in the
+# dataset: the number of boxes for each label and the number of frames without boxes. It also has
+# the frame numbers of the frames that are not included. The summary is computed from the video
+# frame entities the first time it is needed and kept up to date after that.
+
+def __has_label_summary(video_entity):
+    return 'dict_label_to_count' in video_entity
+
+def __exclude_label_summary_from_indexes(video_entity):
+    # The label summary is never used in a query.
+    video_entity.exclude_from_indexes.update(['dict_label_to_count', 'excluded_frame_numbers'])
+
+def __set_label_summary(video_entity, video_frame_entities):
+    __exclude_label_summary_from_indexes(video_entity)
+    video_entity['dict_label_to_count'] = {}
+    video_entity['negative_frame_count'] = 0
+    video_entity['excluded_frame_numbers'] = []
+    for video_frame_entity in video_frame_entities:
+        if video_frame_entity['include_frame_in_dataset']:
+            __add_frame_to_label_summary(video_entity, video_frame_entity['bboxes_text'], 1)
+        else:
+            video_entity['excluded_frame_numbers'].append(video_frame_entity['frame_number'])
+
+def __add_frame_to_label_summary(video_entity, bboxes_text, sign):
+    labels = bbox_writer.extract_labels(bboxes_text)
+    if len(labels) == 0:
+        video_entity['negative_frame_count'] += sign
+    dict_label_to_count = video_entity['dict_label_to_count']
+    for label, count in collections.Counter(labels).items():
+        dict_label_to_count[label] = dict_label_to_count.get(label, 0) + sign * count
+        if dict_label_to_count[label] == 0:
+            dict_label_to_count.pop(label)
+
+def __update_label_summary(video_entity, frame_number,
+        previously_included, previous_bboxes_text, now_included, bboxes_text):
+    if not __has_label_summary(video_entity):
+        # The summary hasn't been computed yet. It will include this change when it is.
+        return
+    # Video entities whose summary was stored before it was excluded from indexes are fixed here.
+    __exclude_label_summary_from_indexes(video_entity)
+    if previously_included:
+        __add_frame_to_label_summary(video_entity, previous_bboxes_text, -1)
+    if now_included:
+        __add_frame_to_label_summary(video_entity, bboxes_text, 1)
+    # If the summary is out of sync with the video frame entities, don't let that fail the update.
+    excluded_frame_numbers = video_entity['excluded_frame_numbers']
+    if previously_included and not now_included:
+        if frame_number not in excluded_frame_numbers:
+            excluded_frame_numbers.append(frame_number)
+    elif now_included and not previously_included:
+        if frame_number in excluded_frame_numbers:
+            excluded_frame_numbers.remove(frame_number)
+
+# video label summary - public methods
+
+# Returns the video entity, with its label summary computed if necessary.
+def retrieve_video_entity_with_label_summary(team_uuid, video_uuid):
+    video_entity = retrieve_video_entity(team_uuid, video_uuid)
+    if __has_label_summary(video_entity):
+        return video_entity
+    datastore_client = datastore.Client()
+    with datastore_client.transaction() as transaction:
+        video_entity = __retrieve_video_entity_in_transaction(transaction, team_uuid, video_uuid)
+        if not __has_label_summary(video_entity):
+            video_frame_entities = __query_video_frame(team_uuid, video_uuid, 0, video_entity['frame_count'] - 1)
+            __set_label_summary(video_entity, video_frame_entities)
+            transaction.put(video_entity)
+        return video_entity
+
+def retrieve_video_entities_with_label_summary(team_uuid, video_uuid_list):
+    video_entities = retrieve_video_entities(team_uuid, video_uuid_list)
+    for i, video_entity in enumerate(video_entities):
+        if not __has_label_summary(video_entity):
+            video_entities[i] = retrieve_video_entity_with_label_summary(team_uuid, video_entity['video_uuid'])
+    return video_entities
+
 # tracking - public methods
 
 def tracker_starting(team_uuid, video_uuid, tracker_name, scale, init_frame_number, init_bboxes_text):
@@ -692,8 +958,8 @@ def tracker_starting(team_uuid, video_uuid, tracker_name, scale, init_frame_numb
             message = 'Error: Tracking is already in progress for video_uuid=%s.' % video_uuid
             logging.critical(message)
             raise exceptions.HttpErrorConflict(message)
-        incomplete_key = datastore_client.key(DS_KIND_TRACKER)
-        tracker_entity = datastore.Entity(key=incomplete_key)
+        tracker_entity = datastore.Entity(key=__get_tracker_key(datastore_client, video_uuid, tracker_uuid),
+            exclude_from_indexes=['lookahead_bboxes_texts'])
         tracker_entity.update({
             'team_uuid': team_uuid,
             'video_uuid': video_uuid,
@@ -706,10 +972,12 @@ def tracker_starting(team_uuid, video_uuid, tracker_name, scale, init_frame_numb
             'scale': scale,
             'frame_number': init_frame_number,
             'bboxes_text': init_bboxes_text,
+            'lookahead_frame_number': init_frame_number,
+            'lookahead_bboxes_texts': [init_bboxes_text],
         })
         transaction.put(tracker_entity)
-        incomplete_key = datastore_client.key(DS_KIND_TRACKER_CLIENT)
-        tracker_client_entity = datastore.Entity(key=incomplete_key)
+        tracker_client_entity = datastore.Entity(
+            key=__get_tracker_client_key(datastore_client, video_uuid, tracker_uuid))
         tracker_client_entity.update({
             'team_uuid': team_uuid,
             'video_uuid': video_uuid,
@@ -728,63 +996,125 @@ def tracker_starting(team_uuid, video_uuid, tracker_name, scale, init_frame_numb
         __add_video_uuid_to_tracking_list(transaction, team_uuid, video_uuid)
         return tracker_uuid
 
+# Tracker and tracker client entities have keys derived from the video_uuid and tracker_uuid, so
+# they can be looked up without a query. Lookups by key are strongly consistent.
+def __get_tracker_key(datastore_client, video_uuid, tracker_uuid):
+    return datastore_client.key(DS_KIND_TRACKER, '%s/%s' % (video_uuid, tracker_uuid))
+
+def __get_tracker_client_key(datastore_client, video_uuid, tracker_uuid):
+    return datastore_client.key(DS_KIND_TRACKER_CLIENT, '%s/%s' % (video_uuid, tracker_uuid))
+
 # Retrieves the tracker entity associated with the given tracker_uuid and video_uuid. If no such
 # entity exists, returns None.
 def maybe_retrieve_tracker_entity(video_uuid, tracker_uuid):
     datastore_client = datastore.Client()
-    query = datastore_client.query(kind=DS_KIND_TRACKER)
-    query.add_filter('tracker_uuid', '=', tracker_uuid)
-    query.add_filter('video_uuid', '=', video_uuid)
-    tracker_entities = list(query.fetch(1))
-    if len(tracker_entities) == 0:
-        return None
-    return tracker_entities[0]
+    return datastore_client.get(__get_tracker_key(datastore_client, video_uuid, tracker_uuid))
 
 # Retrieves the tracker client entity associated with the given tracker_uuid and video_uuid. If no
 # such entity exists, returns None.
 def maybe_retrieve_tracker_client_entity(video_uuid, tracker_uuid):
     datastore_client = datastore.Client()
-    query = datastore_client.query(kind=DS_KIND_TRACKER_CLIENT)
-    query.add_filter('tracker_uuid', '=', tracker_uuid)
-    query.add_filter('video_uuid', '=', video_uuid)
-    tracker_client_entities = list(query.fetch(1))
-    if len(tracker_client_entities) == 0:
-        return None
-    return tracker_client_entities[0]
+    return datastore_client.get(__get_tracker_client_key(datastore_client, video_uuid, tracker_uuid))
+
+# Like maybe_retrieve_tracker_entity, but may return a tracker entity that was retrieved up to
+# TRACKER_ENTITY_CACHE_SECONDS ago. Only use this where a slightly stale tracker entity is ok.
+def __maybe_retrieve_cached_tracker_entity(video_uuid, tracker_uuid):
+    key = (video_uuid, tracker_uuid)
+    now = time.monotonic()
+    with __tracker_entity_cache_lock:
+        for k in [k for k, (t, _) in __tracker_entity_cache.items() if now - t > TRACKER_ENTITY_CACHE_SECONDS]:
+            __tracker_entity_cache.pop(k)
+        if key in __tracker_entity_cache:
+            return __tracker_entity_cache[key][1]
+    tracker_entity = maybe_retrieve_tracker_entity(video_uuid, tracker_uuid)
+    if tracker_entity is not None:
+        with __tracker_entity_cache_lock:
+            __tracker_entity_cache[key] = (now, tracker_entity)
+    return tracker_entity
+
+def __forget_cached_tracker_entity(video_uuid, tracker_uuid):
+    with __tracker_entity_cache_lock:
+        __tracker_entity_cache.pop((video_uuid, tracker_uuid), None)
 
-def store_tracked_bboxes(video_uuid, tracker_uuid, frame_number, bboxes_text):
+# lookahead_bboxes_texts holds the bboxes for consecutive frames, starting with
+# lookahead_frame_number. The first element is the bboxes that the tracker was initialized with or
+# the client approved, and the last element is bboxes_text for frame_number.
+def store_tracked_bboxes(video_uuid, tracker_uuid, frame_number, bboxes_text,
+        lookahead_frame_number, lookahead_bboxes_texts):
     datastore_client = datastore.Client()
     with datastore_client.transaction() as transaction:
         tracker_entity = maybe_retrieve_tracker_entity(video_uuid, tracker_uuid)
         if tracker_entity is not None:
             tracker_entity['frame_number'] = frame_number
             tracker_entity['bboxes_text'] = bboxes_text
+            tracker_entity['lookahead_frame_number'] = lookahead_frame_number
+            tracker_entity['lookahead_bboxes_texts'] = lookahead_bboxes_texts
+            tracker_entity.exclude_from_indexes.add('lookahead_bboxes_texts')
             tracker_entity['update_time'] = datetime.now(timezone.utc)
             transaction.put(tracker_entity)
+    # Wake up retrieve_tracked_bboxes.
+    tracking_channel.notify_tracked(tracker_uuid)
 
 def retrieve_tracked_bboxes(video_uuid, tracker_uuid, retrieve_frame_number, time_limit):
-    tracking_client_still_alive(video_uuid, tracker_uuid)
+    tracker_client_entity = tracking_client_still_alive(video_uuid, tracker_uuid)
     tracker_failed = False
-    tracker_entity = maybe_retrieve_tracker_entity(video_uuid, tracker_uuid)
-    while True:
-        if tracker_entity is None:
-            logging.warning('Tracker appears to have failed. Tracker entity is missing.')
-            return True, 0, ''
-        if tracker_entity['frame_number'] == retrieve_frame_number:
-            break
-        if datetime.now(timezone.utc) >= time_limit - timedelta(seconds=5):
-            break
-        # If it's been more than two minutes, assume the tracker has died.
-        timedelta_since_last_update = datetime.now(timezone.utc) - tracker_entity['update_time']
-        if timedelta_since_last_update > timedelta(minutes=2):
-            logging.warning('Tracker appears to have failed. Elapsed time since last tracker update: %f seconds' %
-                timedelta_since_last_update.total_seconds())
-            tracker_stopping(tracker_entity['team_uuid'], tracker_entity['video_uuid'], tracker_uuid)
-            tracker_failed = True
-            break
-        time.sleep(0.1)
+    start_time = time.monotonic()
+    subscription = tracking_channel.subscribe_tracked(tracker_uuid)
+    try:
         tracker_entity = maybe_retrieve_tracker_entity(video_uuid, tracker_uuid)
-    return tracker_failed, tracker_entity['frame_number'], tracker_entity['bboxes_text']
+        while True:
+            if tracker_entity is None or tracker_client_entity is None:
+                logging.warning('Tracker appears to have failed. Tracker entity is missing.')
+                return True, 0, ''
+            bboxes_text = __get_lookahead_bboxes_text(tracker_entity, tracker_client_entity, retrieve_frame_number)
+            if bboxes_text is not None:
+                # The tracker has already tracked the requested frame.
+                frame_number = retrieve_frame_number
+                break
+            # Until the requested frame is ready, return a frame that the client will not accept.
+            frame_number = tracker_entity['lookahead_frame_number']
+            bboxes_text = tracker_entity['lookahead_bboxes_texts'][0]
+            if datetime.now(timezone.utc) >= time_limit - timedelta(seconds=5):
+                break
+            # If it's been more than two minutes, assume the tracker has died.
+            timedelta_since_last_update = datetime.now(timezone.utc) - tracker_entity['update_time']
+            if timedelta_since_last_update > timedelta(minutes=2):
+                logging.warning('Tracker appears to have failed. Elapsed time since last tracker update: %f seconds' %
+                    timedelta_since_last_update.total_seconds())
+                tracker_stopping(tracker_entity['team_uuid'], tracker_entity['video_uuid'], tracker_uuid)
+                tracker_failed = True
+                break
+            subscription.wait()
+            tracker_entity = maybe_retrieve_tracker_entity(video_uuid, tracker_uuid)
+    finally:
+        subscription.close()
+    elapsed_ms = (time.monotonic() - start_time) * 1000
+    logging.info('retrieve_tracked_bboxes - waited %d ms for frame %d' % (elapsed_ms, retrieve_frame_number))
+    tracking_metrics.record(tracker_entity['tracker_name'], tracker_entity['video_width'], tracker_entity['video_height'],
+        tracking_metrics.SPAN_WAIT_FOR_TRACKER, elapsed_ms)
+    return tracker_failed, frame_number, bboxes_text
+
+# Returns the tracked bboxes for retrieve_frame_number from the tracker's lookahead buffer, or None
+# if they are not there.
+def __get_lookahead_bboxes_text(tracker_entity, tracker_client_entity, retrieve_frame_number):
+    lookahead_bboxes_texts = __get_lookahead_bboxes_texts(tracker_entity, tracker_client_entity)
+    i = retrieve_frame_number - tracker_client_entity['frame_number'] - 1
+    if i < 0 or i >= len(lookahead_bboxes_texts):
+        return None
+    return lookahead_bboxes_texts[i]
+
+# Returns the tracked bboxes in the tracker's lookahead buffer for the frames after the frame that
+# the client approved. The buffer is only valid if the bboxes that the client approved match the
+# bboxes that the tracker continued from. If the user adjusted the bboxes, the tracker will
+# discard the speculative frames and start over from the approved frame.
+def __get_lookahead_bboxes_texts(tracker_entity, tracker_client_entity):
+    lookahead_bboxes_texts = tracker_entity['lookahead_bboxes_texts']
+    approved_index = tracker_client_entity['frame_number'] - tracker_entity['lookahead_frame_number']
+    if approved_index < 0 or approved_index >= len(lookahead_bboxes_texts):
+        return []
+    if lookahead_bboxes_texts[approved_index] != tracker_client_entity['bboxes_text']:
+        return []
+    return lookahead_bboxes_texts[approved_index + 1:]
 
 def tracking_client_still_alive(video_uuid, tracker_uuid):
     datastore_client = datastore.Client()
@@ -793,6 +1123,7 @@ def tracking_client_still_alive(video_uuid, tracker_uuid):
         if tracker_client_entity is not None:
             tracker_client_entity['update_time'] = datetime.now(timezone.utc)
             transaction.put(tracker_client_entity)
+        return tracker_client_entity
 
 def continue_tracking(team_uuid, video_uuid, tracker_uuid, frame_number, bboxes_text):
     datastore_client = datastore.Client()
@@ -806,6 +1137,56 @@ def continue_tracking(team_uuid, video_uuid, tracker_uuid, frame_number, bboxes_
             tracker_client_entity['bboxes_text'] = bboxes_text
             tracker_client_entity['update_time'] = datetime.now(timezone.utc)
             transaction.put(tracker_client_entity)
+    # Wake up the tracker.
+    tracking_channel.notify_client(tracker_uuid)
+
+# Stores the approved bboxes for consecutive frames, starting at min_frame_number, and advances the
+# tracker client to the last of those frames.
+def continue_tracking_batch(team_uuid, video_uuid, tracker_uuid, min_frame_number, bboxes_texts):
+    tracker_client_entity = maybe_retrieve_tracker_client_entity(video_uuid, tracker_uuid)
+    tracker_entity = maybe_retrieve_tracker_entity(video_uuid, tracker_uuid)
+    if tracker_client_entity is None or tracker_entity is None:
+        return
+    # The frames must start right after the frame that the client approved last and must not go
+    # past the frames that the tracker has tracked.
+    max_frame_number = min_frame_number + len(bboxes_texts) - 1
+    max_tracked_frame_number = tracker_entity['lookahead_frame_number'] + len(tracker_entity['lookahead_bboxes_texts']) - 1
+    if min_frame_number != tracker_client_entity['frame_number'] + 1:
+        message = 'Error: min_frame_number %d does not follow the approved frame_number %d.' % (
+            min_frame_number, tracker_client_entity['frame_number'])
+        logging.critical(message)
+        raise exceptions.HttpErrorBadRequest(message)
+    if max_frame_number > max_tracked_frame_number:
+        message = 'Error: Frame number %d has not been tracked yet. The last tracked frame_number is %d.' % (
+            max_frame_number, max_tracked_frame_number)
+        logging.critical(message)
+        raise exceptions.HttpErrorBadRequest(message)
+    __store_video_frame_bboxes_texts(team_uuid, video_uuid, min_frame_number, bboxes_texts)
+    datastore_client = datastore.Client()
+    with datastore_client.transaction() as transaction:
+        tracker_client_entity = maybe_retrieve_tracker_client_entity(video_uuid, tracker_uuid)
+        if tracker_client_entity is not None:
+            tracker_client_entity['frame_number'] = min_frame_number + len(bboxes_texts) - 1
+            tracker_client_entity['bboxes_text'] = bboxes_texts[-1]
+            tracker_client_entity['update_time'] = datetime.now(timezone.utc)
+            transaction.put(tracker_client_entity)
+    # Wake up the tracker.
+    tracking_channel.notify_client(tracker_uuid)
+
+# Returns the tracked bboxes that the tracker has already stored for the frames after the frame
+# that the client approved last, starting with that frame + 1.
+def retrieve_lookahead_bboxes(video_uuid, tracker_uuid):
+    tracker_entity = __maybe_retrieve_cached_tracker_entity(video_uuid, tracker_uuid)
+    tracker_client_entity = maybe_retrieve_tracker_client_entity(video_uuid, tracker_uuid)
+    if tracker_entity is None or tracker_client_entity is None:
+        return []
+    return __get_lookahead_bboxes_texts(tracker_entity, tracker_client_entity)
+
+def record_tracking_latency(video_uuid, tracker_uuid, span, ms):
+    tracker_entity = __maybe_retrieve_cached_tracker_entity(video_uuid, tracker_uuid)
+    if tracker_entity is not None:
+        tracking_metrics.record(tracker_entity['tracker_name'], tracker_entity['video_width'], tracker_entity['video_height'],
+            span, ms)
 
 def set_tracking_stop_requested(video_uuid, tracker_uuid):
     datastore_client = datastore.Client()
@@ -815,6 +1196,8 @@ def set_tracking_stop_requested(video_uuid, tracker_uuid):
             tracker_client_entity['tracking_stop_requested'] = True
             tracker_client_entity['update_time'] = datetime.now(timezone.utc)
             transaction.put(tracker_client_entity)
+    # Wake up the tracker.
+    tracking_channel.notify_client(tracker_uuid)
 
 def tracker_stopping(team_uuid, video_uuid, tracker_uuid):
     datastore_client = datastore.Client()
@@ -832,6 +1215,47 @@ def tracker_stopping(team_uuid, video_uuid, tracker_uuid):
         tracker_client_entity = maybe_retrieve_tracker_client_entity(video_uuid, tracker_uuid)
         if tracker_client_entity is not None:
             transaction.delete(tracker_client_entity.key)
+    __forget_cached_tracker_entity(video_uuid, tracker_uuid)
+    # Wake up retrieve_tracked_bboxes and the tracker so they notice that the entities are gone.
+    tracking_channel.notify_tracked(tracker_uuid)
+    tracking_channel.notify_client(tracker_uuid)
+
+
+# tracking latency - public methods
+
+# dict_key_to_counts has (tracker_name, resolution, span) keys and lists of histogram bucket counts
+# as values. The counts are added to the counts already stored.
+def add_tracking_latency_counts(dict_key_to_counts):
+    datastore_client = datastore.Client()
+    keys = {}
+    for key in dict_key_to_counts.keys():
+        keys[key] = datastore_client.key(DS_KIND_TRACKING_LATENCY, '/'.join(key))
+    with datastore_client.transaction() as transaction:
+        dict_name_to_entity = {}
+        for tracking_latency_entity in datastore_client.get_multi(list(keys.values())):
+            dict_name_to_entity[tracking_latency_entity.key.name] = tracking_latency_entity
+        for key, counts in dict_key_to_counts.items():
+            tracking_latency_entity = dict_name_to_entity.get(keys[key].name)
+            if tracking_latency_entity is None:
+                tracking_latency_entity = datastore.Entity(key=keys[key], exclude_from_indexes=['counts'])
+                tracking_latency_entity.update({
+                    'tracker_name': key[0],
+                    'resolution': key[1],
+                    'span': key[2],
+                    'counts': [0] * len(counts),
+                })
+            total_counts = tracking_latency_entity['counts']
+            # If the buckets have changed, start over.
+            if len(total_counts) != len(counts):
+                total_counts = [0] * len(counts)
+            tracking_latency_entity['counts'] = [a + b for a, b in zip(total_counts, counts)]
+            tracking_latency_entity['update_time'] = datetime.now(timezone.utc)
+            transaction.put(tracking_latency_entity)
+
+def retrieve_tracking_latency_entities():
+    datastore_client = datastore.Client()
+    query = datastore_client.query(kind=DS_KIND_TRACKING_LATENCY)
+    return list(query.fetch())
 
 
 # dataset - private methods
@@ -968,6 +1392,7 @@ def __create_dataset_records_batch(team_uuid, dataset_uuid, record_numbers):
     batch.commit()
 
 def dataset_producer_maybe_done(team_uuid, dataset_uuid):
+    completed = False
     datastore_client = datastore.Client()
     with datastore_client.transaction() as transaction:
         # Fetch the dataset entity first.
@@ -1007,6 +1432,10 @@ def dataset_producer_maybe_done(team_uuid, dataset_uuid):
                 dataset_entity['eval_dict_label_to_count'] = eval_dict_label_to_count
                 transaction.put(dataset_entity)
                 __delete_dataset_record_writers(dataset_entity)
+                completed = True
+    if completed:
+        # The frame shards are only needed while the dataset records are written.
+        blob_storage.delete_dataset_frame_shards(team_uuid, dataset_uuid)
 
 # Retrieves the dataset entity associated with the given team_uuid and dataset_uuid. If no such
 # entity exists, raises HttpErrorNotFound.
@@ -1086,6 +1515,16 @@ def finish_delete_dataset(action_parameters):
         action.retrigger_if_necessary(action_parameters)
         # Then, delete the dataset record entities.
         datastore_client.delete_multi(keys)
+    # Delete the cached dataset zips.
+    action.retrigger_if_necessary(action_parameters)
+    dataset_zipper_entities = retrieve_dataset_zippers_for_dataset(team_uuid, dataset_uuid)
+    for dataset_zipper_entity in dataset_zipper_entities:
+        blob_storage.delete_dataset_zip(team_uuid, dataset_zipper_entity['dataset_zip_uuid'],
+            dataset_zipper_entity['partition_index'])
+    delete_dataset_zippers(dataset_zipper_entities)
+    # Delete any frame shards left by a dataset producer that didn't finish.
+    action.retrigger_if_necessary(action_parameters)
+    blob_storage.delete_dataset_frame_shards(team_uuid, dataset_uuid)
     # Finally, delete the dataset.
     action.retrigger_if_necessary(action_parameters)
     dataset_entities = __query_dataset(team_uuid, dataset_uuid)
@@ -1200,22 +1639,77 @@ def finish_delete_dataset_record_writers(action_parameters):
 
 # dataset zipper - public methods
 
-def create_dataset_zippers(team_uuid, dataset_zip_uuid, partition_count):
+def __get_dataset_zipper_key(datastore_client, team_uuid, dataset_zip_uuid, partition_index):
+    # Dataset zipper entities have keys derived from the team_uuid, dataset_zip_uuid, and
+    # partition_index, so whether they exist can be checked inside a transaction.
+    return datastore_client.key(DS_KIND_DATASET_ZIPPER, '%s/%s/%d' % (team_uuid, dataset_zip_uuid, partition_index))
+
+def create_dataset_zippers(team_uuid, dataset_uuid, dataset_zip_uuid, partition_count, cacheable):
+    # Returns False, without creating anything, if the dataset zippers already exist.
+    datastore_client = datastore.Client()
+    keys = [__get_dataset_zipper_key(datastore_client, team_uuid, dataset_zip_uuid, partition_index)
+        for partition_index in range(partition_count)]
+    try:
+        with datastore_client.transaction() as transaction:
+            if len(datastore_client.get_multi(keys, transaction=transaction)) != 0:
+                return False
+            for partition_index, key in enumerate(keys):
+                dataset_zipper_entity = datastore.Entity(key=key)
+                dataset_zipper_entity.update({
+                    'team_uuid': team_uuid,
+                    'dataset_uuid': dataset_uuid,
+                    'dataset_zip_uuid': dataset_zip_uuid,
+                    'partition_index': partition_index,
+                    'file_count': 0,
+                    'files_written': 0,
+                    'update_time': datetime.now(timezone.utc),
+                    'last_used_time': datetime.now(timezone.utc),
+                    # Zips of completed datasets are kept for reuse. Other zips are deleted after
+                    # they are downloaded.
+                    'cacheable': cacheable,
+                })
+                transaction.put(dataset_zipper_entity)
+            return True
+    except (Aborted, Conflict):
+        # Another request created the dataset zippers at the same time.
+        if len(datastore_client.get_multi(keys)) != 0:
+            return False
+        raise
+
+def retrieve_dataset_zippers(team_uuid, dataset_zip_uuid):
+    datastore_client = datastore.Client()
+    query = datastore_client.query(kind=DS_KIND_DATASET_ZIPPER)
+    query.add_filter('team_uuid', '=', team_uuid)
+    query.add_filter('dataset_zip_uuid', '=', dataset_zip_uuid)
+    dataset_zipper_entities = list(query.fetch())
+    dataset_zipper_entities.sort(key=lambda dataset_zipper_entity: dataset_zipper_entity['partition_index'])
+    return dataset_zipper_entities
+
+def retrieve_dataset_zippers_for_team(team_uuid):
+    datastore_client = datastore.Client()
+    query = datastore_client.query(kind=DS_KIND_DATASET_ZIPPER)
+    query.add_filter('team_uuid', '=', team_uuid)
+    return list(query.fetch())
+
+def retrieve_dataset_zippers_for_dataset(team_uuid, dataset_uuid):
+    datastore_client = datastore.Client()
+    query = datastore_client.query(kind=DS_KIND_DATASET_ZIPPER)
+    query.add_filter('team_uuid', '=', team_uuid)
+    query.add_filter('dataset_uuid', '=', dataset_uuid)
+    return list(query.fetch())
+
+def update_dataset_zippers_last_used_time(dataset_zipper_entities):
     datastore_client = datastore.Client()
     with datastore_client.transaction() as transaction:
-        for partition_index in range(partition_count):
-            incomplete_key = datastore_client.key(DS_KIND_DATASET_ZIPPER)
-            dataset_zipper_entity = datastore.Entity(key=incomplete_key)
-            dataset_zipper_entity.update({
-                'team_uuid': team_uuid,
-                'dataset_zip_uuid': dataset_zip_uuid,
-                'partition_index': partition_index,
-                'file_count': 0,
-                'files_written': 0,
-                'update_time': datetime.now(timezone.utc),
-            })
+        for dataset_zipper_entity in dataset_zipper_entities:
+            dataset_zipper_entity['last_used_time'] = datetime.now(timezone.utc)
             transaction.put(dataset_zipper_entity)
 
+def delete_dataset_zippers(dataset_zipper_entities):
+    datastore_client = datastore.Client()
+    keys = [dataset_zipper_entity.key for dataset_zipper_entity in dataset_zipper_entities]
+    datastore_client.delete_multi(keys)
+
 def __maybe_retrieve_dataset_zipper(team_uuid, dataset_zip_uuid, partition_index):
     datastore_client = datastore.Client()
     query = datastore_client.query(kind=DS_KIND_DATASET_ZIPPER)
@@ -1258,11 +1752,17 @@ def retrieve_dataset_zipper_files_written(team_uuid, dataset_zip_uuid, partition
         files_written_array[i] = dataset_zipper_entity['files_written']
     return file_count_array, files_written_array
 
+# Deletes the dataset zipper entity, unless the zip is kept for reuse. Returns True if the zip should
+# be deleted.
 def delete_dataset_zipper(team_uuid, dataset_zip_uuid, partition_index):
     datastore_client = datastore.Client()
     dataset_zipper_entity = __maybe_retrieve_dataset_zipper(team_uuid, dataset_zip_uuid, partition_index)
-    if dataset_zipper_entity is not None:
-        datastore_client.delete(dataset_zipper_entity.key)
+    if dataset_zipper_entity is None:
+        return True
+    if dataset_zipper_entity.get('cacheable', False):
+        return False
+    datastore_client.delete(dataset_zipper_entity.key)
+    return True
 
 # model - public methods
 
@@ -1343,6 +1843,7 @@ def model_trainer_started(team_uuid, model_uuid, description, model_folder,
             'eval_job_elapsed_seconds': 0,
             'evaled_steps': 0,
             'dict_event_file_path_to_updated': {},
+            'dict_event_file_path_to_offset': {},
             'monitor_training_triggered_time_ms': 0,
             'monitor_training_active_time_ms': 0,
             'monitor_training_finished': False,
@@ -1591,7 +2092,8 @@ def separate_summary_item_key(key):
 
 
 def update_model_entity_for_event_file(team_uuid, model_uuid, job_type,
-        event_file_path, updated, largest_step):
+        event_file_path, updated, offset, largest_step):
+    # updated is None if the event file has not been read to the end yet.
     datastore_client = datastore.Client()
     with datastore_client.transaction() as transaction:
         model_entity = retrieve_model_entity(team_uuid, model_uuid)
@@ -1605,10 +2107,17 @@ def update_model_entity_for_event_file(team_uuid, model_uuid, job_type,
         if 'dict_event_file_path_to_updated' not in model_entity:
             model_entity['dict_event_file_path_to_updated'] = {}
             modified = True
-        if (event_file_path not in model_entity['dict_event_file_path_to_updated'] or
+        if updated is not None and (event_file_path not in model_entity['dict_event_file_path_to_updated'] or
                 model_entity['dict_event_file_path_to_updated'][event_file_path] < updated):
             model_entity['dict_event_file_path_to_updated'][event_file_path] = updated
             modified = True
+        if 'dict_event_file_path_to_offset' not in model_entity:
+            model_entity['dict_event_file_path_to_offset'] = {}
+            modified = True
+        if (event_file_path not in model_entity['dict_event_file_path_to_offset'] or
+                model_entity['dict_event_file_path_to_offset'][event_file_path] < offset):
+            model_entity['dict_event_file_path_to_offset'][event_file_path] = offset
+            modified = True
         if modified:
             model_entity['monitor_training_active_time'] = datetime.now(timezone.utc)
             model_entity['monitor_training_active_time_ms'] = util.ms_from_datetime(model_entity['monitor_training_active_time'])
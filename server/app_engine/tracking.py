@@ -34,6 +34,15 @@ tracker_fns = [
     'TLD',
     'KCF',
     'Boosting',
+    'CSRT-Parallel',
+    'MedianFlow-Parallel',
+    'MIL-Parallel',
+    'MOSSE-Parallel',
+    'TLD-Parallel',
+    'KCF-Parallel',
+    'Boosting-Parallel',
+    'Adaptive',
+    'Adaptive-Parallel',
 ]
 
 
@@ -0,0 +1,141 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "lizlooney@google.com (Liz Looney)"
+
+# Notifications between the tracker (in cloud functions) and the web tier (in app engine).
+#
+# The tracker and tracker client entities in datastore are still the source of truth. A
+# notification just wakes up the side that is waiting, so it can read the entity right away instead
+# of sleeping and polling. If redis is not configured, or isn't reachable, waiting falls back to
+# sleeping for POLL_INTERVAL_SECONDS.
+
+# Python Standard Library
+import logging
+import threading
+import time
+
+# Other Modules
+import redis
+
+# My Modules
+import constants
+
+# How long to sleep between datastore reads if redis is not available.
+POLL_INTERVAL_SECONDS = 0.1
+# How long to wait for a notification before reading datastore anyway. This bounds the delay if a
+# notification is lost.
+MAX_WAIT_SECONDS = 1.0
+
+__redis_lock = threading.Lock()
+__redis_client = None
+
+
+def __get_redis_client():
+    global __redis_client
+    if constants.REDIS_IP_ADDR is None:
+        return None
+    with __redis_lock:
+        if __redis_client is None:
+            # Use timeouts so an unreachable redis server falls back to polling instead of hanging.
+            __redis_client = redis.Redis(host=constants.REDIS_IP_ADDR, port=6379,
+                socket_connect_timeout=2, socket_timeout=5)
+        return __redis_client
+
+
+def __get_tracked_channel(tracker_uuid):
+    # The tracker publishes here when it has stored bboxes for a new frame or has stopped.
+    return 'tracker/%s/tracked' % tracker_uuid
+
+
+def __get_client_channel(tracker_uuid):
+    # The web tier publishes here when the client has approved/adjusted bboxes or requested a stop.
+    return 'tracker/%s/client' % tracker_uuid
+
+
+def __publish(channel):
+    redis_client = __get_redis_client()
+    if redis_client is None:
+        return
+    try:
+        redis_client.publish(channel, str(time.time()))
+    except redis.RedisError as e:
+        logging.warning('tracking_channel - unable to publish to %s: %s' % (channel, str(e)))
+
+
+def notify_tracked(tracker_uuid):
+    __publish(__get_tracked_channel(tracker_uuid))
+
+
+def notify_client(tracker_uuid):
+    __publish(__get_client_channel(tracker_uuid))
+
+
+def subscribe_tracked(tracker_uuid):
+    return Subscription(__get_redis_client(), __get_tracked_channel(tracker_uuid))
+
+
+def subscribe_client(tracker_uuid):
+    return Subscription(__get_redis_client(), __get_client_channel(tracker_uuid))
+
+
+def is_using_redis():
+    return constants.REDIS_IP_ADDR is not None
+
+
+class Subscription():
+    # Subscribe before reading the entity that you are waiting on, so a notification that is sent
+    # after the read is not missed.
+
+    def __init__(self, redis_client, channel):
+        self.channel = channel
+        self.pubsub = None
+        if redis_client is not None:
+            try:
+                self.pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+                self.pubsub.subscribe(channel)
+            except redis.RedisError as e:
+                logging.warning('tracking_channel - unable to subscribe to %s: %s' % (channel, str(e)))
+                self.pubsub = None
+
+    # Waits until a notification arrives or MAX_WAIT_SECONDS pass. Returns True if a notification
+    # arrived.
+    def wait(self):
+        if self.pubsub is None:
+            time.sleep(POLL_INTERVAL_SECONDS)
+            return False
+        deadline = time.monotonic() + MAX_WAIT_SECONDS
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                message = self.pubsub.get_message(timeout=remaining)
+                if message is not None and message['type'] == 'message':
+                    # Drain any other notifications that are already here.
+                    while self.pubsub.get_message() is not None:
+                        pass
+                    return True
+        except redis.RedisError as e:
+            logging.warning('tracking_channel - lost subscription to %s: %s' % (self.channel, str(e)))
+            self.close()
+            return False
+
+    def close(self):
+        if self.pubsub is not None:
+            try:
+                self.pubsub.close()
+            except redis.RedisError:
+                pass
+            self.pubsub = None
@@ -0,0 +1,123 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "lizlooney@google.com (Liz Looney)"
+
+# Per-frame tracking latency, from the tracker (in cloud functions) and the web tier (in app
+# engine), aggregated into histograms by tracker name, resolution, and span.
+#
+# Spans are counted in memory and added to the histograms in datastore every
+# FLUSH_INTERVAL_SECONDS, so recording a span doesn't cost a datastore write.
+
+# Python Standard Library
+import bisect
+import logging
+import threading
+import time
+
+# My Modules
+import storage
+
+# Spans recorded by the tracker.
+SPAN_DECODE = 'tracker_decode'
+SPAN_TRACK = 'tracker_update'
+SPAN_STORE = 'tracker_store'
+SPAN_READ_CLIENT = 'tracker_read_client'
+SPAN_ROUND_TRIP = 'tracker_round_trip'
+# Spans recorded by the web tier.
+SPAN_WAIT_FOR_TRACKER = 'web_wait_for_tracker'
+SPAN_CONTINUE_TRACKING = 'web_continue_tracking'
+
+# Upper bounds of the histogram buckets, in milliseconds. The last bucket has no upper bound.
+BUCKET_UPPER_BOUNDS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 60000]
+
+FLUSH_INTERVAL_SECONDS = 30
+
+__lock = threading.Lock()
+# Keys are (tracker_name, resolution, span), values are lists of bucket counts.
+__pending_counts = {}
+__last_flush_time = time.monotonic()
+
+
+def get_resolution(width, height):
+    shorter = min(width, height)
+    for resolution in [480, 720, 1080, 1440]:
+        if shorter <= resolution:
+            return '%dp' % resolution
+    return '2160p'
+
+
+def record(tracker_name, width, height, span, ms):
+    key = (tracker_name, get_resolution(width, height), span)
+    bucket = bisect.bisect_left(BUCKET_UPPER_BOUNDS_MS, ms)
+    with __lock:
+        counts = __pending_counts.setdefault(key, [0] * (len(BUCKET_UPPER_BOUNDS_MS) + 1))
+        counts[bucket] += 1
+        flush_now = time.monotonic() - __last_flush_time >= FLUSH_INTERVAL_SECONDS
+    if flush_now:
+        flush()
+
+
+def flush():
+    global __last_flush_time
+    with __lock:
+        pending_counts = __pending_counts.copy()
+        __pending_counts.clear()
+        __last_flush_time = time.monotonic()
+    if len(pending_counts) == 0:
+        return
+    try:
+        storage.add_tracking_latency_counts(pending_counts)
+    except Exception as e:
+        logging.warning('tracking_metrics - unable to store latency counts: %s' % str(e))
+        # Keep the counts for the next flush.
+        with __lock:
+            for key, counts in pending_counts.items():
+                total_counts = __pending_counts.setdefault(key, [0] * len(counts))
+                for i, count in enumerate(counts):
+                    total_counts[i] += count
+
+
+def __get_percentile_ms(counts, total, percentile):
+    # Returns the upper bound of the bucket that contains the percentile, or None if it is in the
+    # last bucket.
+    threshold = total * percentile / 100
+    cumulative = 0
+    for i, count in enumerate(counts):
+        cumulative += count
+        if cumulative >= threshold:
+            return BUCKET_UPPER_BOUNDS_MS[i] if i < len(BUCKET_UPPER_BOUNDS_MS) else None
+    return None
+
+
+def retrieve_latency_summary():
+    summary = []
+    for tracking_latency_entity in storage.retrieve_tracking_latency_entities():
+        counts = tracking_latency_entity['counts']
+        total = sum(counts)
+        if total == 0:
+            continue
+        summary.append({
+            'tracker_name': tracking_latency_entity['tracker_name'],
+            'resolution': tracking_latency_entity['resolution'],
+            'span': tracking_latency_entity['span'],
+            'count': total,
+            'p50_ms': __get_percentile_ms(counts, total, 50),
+            'p95_ms': __get_percentile_ms(counts, total, 95),
+            'p99_ms': __get_percentile_ms(counts, total, 99),
+            'bucket_upper_bounds_ms': BUCKET_UPPER_BOUNDS_MS,
+            'counts': counts,
+        })
+    summary.sort(key=lambda s: (s['tracker_name'], s['resolution'], s['span']))
+    return summary
@@ -15,12 +15,16 @@
 __author__ = "lizlooney@google.com (Liz Looney)"
 
 # Python Standard Library
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 import json
+import logging
+import threading
 
 # Other Modules
+from google.auth.transport.requests import AuthorizedSession
 import google.cloud.storage
 from google.oauth2 import service_account
+import requests.adapters
 
 from werkzeug.wrappers import Response
 
@@ -31,6 +35,23 @@ import constants
 ENV_DEVELOPMENT = "development"
 ENV_PRODUCTION = "production"
 
+# The key_json secret is fetched again after this much time so that rotated credentials are
+# eventually picked up even if nobody calls invalidate_storage_client().
+STORAGE_CREDENTIALS_TTL = timedelta(minutes=30)
+# The maximum number of connections kept open by the shared storage session.
+STORAGE_CONNECTION_POOL_SIZE = 32
+
+__storage_client_lock = threading.Lock()
+__storage_client = None
+__storage_key_json = None
+__storage_key_json_fetch_time = None
+__storage_client_stats = {
+    'client_creations': 0,
+    'secret_fetches': 0,
+    'invalidations': 0,
+}
+
+
 def ms_from_datetime(dt):
     return round(dt.timestamp() * 1000)
 
@@ -47,10 +68,55 @@ def make_label_map(sorted_label_list):
 
 
 def storage_client():
-    payload = cloud_secrets.get("key_json")
-    credentials_dict = json.loads(payload)
-    credentials = service_account.Credentials.from_service_account_info(credentials_dict)
-    return google.cloud.storage.Client(project=constants.PROJECT_ID, credentials=credentials)
+    # The storage client is shared by all threads in this process. It is rebuilt only if it was
+    # invalidated or if the key_json secret has changed since it was created.
+    global __storage_client, __storage_key_json, __storage_key_json_fetch_time
+    with __storage_client_lock:
+        now = datetime.now(timezone.utc)
+        if (__storage_client is not None and
+                now - __storage_key_json_fetch_time < STORAGE_CREDENTIALS_TTL):
+            return __storage_client
+        payload = cloud_secrets.get("key_json")
+        __storage_client_stats['secret_fetches'] += 1
+        __storage_key_json_fetch_time = now
+        if __storage_client is not None and payload == __storage_key_json:
+            # The credentials have not changed. Keep using the same client.
+            return __storage_client
+        credentials_dict = json.loads(payload)
+        credentials = service_account.Credentials.from_service_account_info(credentials_dict)
+        __storage_client = google.cloud.storage.Client(project=constants.PROJECT_ID,
+            credentials=credentials,
+            _http=__create_authorized_session(credentials.with_scopes(google.cloud.storage.Client.SCOPE)))
+        __storage_key_json = payload
+        __storage_client_stats['client_creations'] += 1
+        logging.info('util.storage_client - created storage client, stats: %s' % str(__storage_client_stats))
+        return __storage_client
+
+
+def __create_authorized_session(credentials):
+    # The client scopes only its own copy of the credentials, not the ones in the session that is
+    # passed to it, so the caller must pass scoped credentials here.
+    session = AuthorizedSession(credentials)
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=STORAGE_CONNECTION_POOL_SIZE, pool_maxsize=STORAGE_CONNECTION_POOL_SIZE)
+    session.mount('https://', adapter)
+    return session
+
+
+def invalidate_storage_client():
+    # Call this after the key_json secret has been rotated. The next call to storage_client() will
+    # fetch the secret and build a new client.
+    global __storage_client, __storage_key_json, __storage_key_json_fetch_time
+    with __storage_client_lock:
+        __storage_client = None
+        __storage_key_json = None
+        __storage_key_json_fetch_time = None
+        __storage_client_stats['invalidations'] += 1
+
+
+def get_storage_client_stats():
+    with __storage_client_lock:
+        return __storage_client_stats.copy()
 
 
 def extend_dict_label_to_count(dict, other_dict):
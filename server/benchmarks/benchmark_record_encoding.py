@@ -0,0 +1,104 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "lizlooney@google.com (Liz Looney)"
+
+# Reports bytes per record and frames per second for each dataset record image setting.
+#
+# Usage, from the server directory:
+#   python benchmarks/benchmark_record_encoding.py <video file> [--max_frames N]
+
+# Python Standard Library
+import argparse
+import math
+import os
+import sys
+import tempfile
+import time
+
+# Other Modules
+import cv2
+import tensorflow as tf
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cf_dataset_producer
+import dataset_util
+
+# (format, jpeg_quality)
+SETTINGS = [
+    ('png', None),
+    ('jpeg', 95),
+    ('jpeg', 85),
+    ('jpeg', 75),
+    ('jpeg', 50),
+]
+
+FRAMES_PER_RECORD = 50
+
+
+def read_frames(video_filename, max_frames):
+    vid = cv2.VideoCapture(video_filename)
+    if not vid.isOpened():
+        raise RuntimeError('Unable to open %s' % video_filename)
+    frames = []
+    try:
+        while len(frames) < max_frames:
+            success, frame = vid.read()
+            if not success:
+                break
+            frames.append(frame)
+    finally:
+        vid.release()
+    return frames
+
+
+def run_setting(frames, format, jpeg_quality, folder):
+    record_filename = os.path.join(folder, '%s_%s.record' % (format, jpeg_quality))
+    start = time.perf_counter()
+    with tf.io.TFRecordWriter(record_filename) as writer:
+        for frame in frames:
+            image = cf_dataset_producer.encode_frame_image(frame, format, jpeg_quality)
+            tf_example = tf.train.Example(features=tf.train.Features(feature={
+                'image/height': dataset_util.int64_feature(frame.shape[0]),
+                'image/width': dataset_util.int64_feature(frame.shape[1]),
+                'image/encoded': dataset_util.bytes_feature(image),
+                'image/format': dataset_util.bytes_feature(format.encode('utf-8')),
+            }))
+            writer.write(tf_example.SerializeToString())
+    elapsed = time.perf_counter() - start
+    record_count = math.ceil(len(frames) / FRAMES_PER_RECORD)
+    return os.path.getsize(record_filename) / record_count, len(frames) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('video_filename')
+    parser.add_argument('--max_frames', type=int, default=200)
+    args = parser.parse_args()
+
+    frames = read_frames(args.video_filename, args.max_frames)
+    if len(frames) == 0:
+        raise RuntimeError('No frames in %s' % args.video_filename)
+    print('%d frames, %d x %d, %d frames per record' %
+        (len(frames), frames[0].shape[1], frames[0].shape[0], FRAMES_PER_RECORD))
+    print('%-12s %16s %12s' % ('setting', 'bytes/record', 'frames/sec'))
+    with tempfile.TemporaryDirectory() as folder:
+        for format, jpeg_quality in SETTINGS:
+            bytes_per_record, frames_per_second = run_setting(frames, format, jpeg_quality, folder)
+            setting = format if jpeg_quality is None else '%s q=%d' % (format, jpeg_quality)
+            print('%-12s %16d %12.1f' % (setting, bytes_per_record, frames_per_second))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "lizlooney@google.com (Liz Looney)"
+
+# Reports the per-frame tracking latency for each object count, tracking the objects one after
+# another and in parallel.
+#
+# Usage, from the server directory:
+#   python benchmarks/benchmark_tracking.py <video file> [--tracker CSRT] [--max_frames N]
+
+# Python Standard Library
+import argparse
+import os
+import statistics
+import sys
+import time
+
+# Other Modules
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app_engine import constants
+import cf_tracking
+
+
+def read_frames(video_filename, max_frames):
+    vid = cv2.VideoCapture(video_filename)
+    if not vid.isOpened():
+        raise RuntimeError('Unable to open %s' % video_filename)
+    frames = []
+    try:
+        while len(frames) < max_frames:
+            success, frame = vid.read()
+            if not success:
+                break
+            frames.append(frame)
+    finally:
+        vid.release()
+    return frames
+
+
+def create_bboxes(frame, object_count):
+    # Place the objects on a grid, so they don't overlap.
+    height, width = frame.shape[:2]
+    columns = 5
+    rows = (object_count + columns - 1) // columns
+    box_width = width // (columns * 2)
+    box_height = height // (rows * 2)
+    bboxes = []
+    for i in range(object_count):
+        x = (2 * (i % columns) + 0.5) * box_width
+        y = (2 * (i // columns) + 0.5) * box_height
+        bboxes.append((x, y, box_width, box_height))
+    return bboxes
+
+
+def run(frames, tracker_name, object_count):
+    executor = cf_tracking.create_executor(tracker_name)
+    try:
+        trackers = cf_tracking.create_trackers(tracker_name, frames[0],
+            create_bboxes(frames[0], object_count), executor)
+        latencies_ms = []
+        for frame_number in range(1, len(frames)):
+            start = time.perf_counter()
+            cf_tracking.update_trackers(trackers, frames[frame_number], frame_number, executor)
+            latencies_ms.append((time.perf_counter() - start) * 1000)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return statistics.median(latencies_ms), max(latencies_ms)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('video_filename')
+    parser.add_argument('--tracker', default='CSRT')
+    parser.add_argument('--max_frames', type=int, default=100)
+    args = parser.parse_args()
+
+    frames = read_frames(args.video_filename, args.max_frames)
+    if len(frames) < 2:
+        raise RuntimeError('Not enough frames in %s' % args.video_filename)
+    print('%d frames, %d x %d' % (len(frames), frames[0].shape[1], frames[0].shape[0]))
+    tracker_names = [args.tracker, '%s-Parallel' % args.tracker]
+    print('%-8s %24s %24s' % ('objects', tracker_names[0] + ' ms (p50/max)', tracker_names[1] + ' ms (p50/max)'))
+    for object_count in range(1, constants.MAX_BOUNDING_BOX_PER_FRAME + 1):
+        results = [run(frames, tracker_name, object_count) for tracker_name in tracker_names]
+        print('%-8d %24s %24s' % (object_count,
+            '%.1f / %.1f' % results[0], '%.1f / %.1f' % results[1]))
+
+
+if __name__ == '__main__':
+    main()
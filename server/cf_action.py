@@ -53,6 +53,7 @@ def __perform_action(action_parameters, time_limit):
         action.ACTION_NAME_TRACKING: cf_tracking.start_tracking,
         action.ACTION_NAME_DATASET_PRODUCE: cf_dataset_producer.produce_dataset,
         action.ACTION_NAME_DATASET_PRODUCE_RECORD: cf_dataset_producer.produce_dataset_record,
+        action.ACTION_NAME_DATASET_PRODUCE_VIDEO_RECORDS: cf_dataset_producer.produce_dataset_video_records,
         action.ACTION_NAME_DELETE_DATASET_RECORD_WRITERS: storage.finish_delete_dataset_record_writers,
         action.ACTION_NAME_DATASET_ZIP: cf_dataset_zipper.zip_dataset,
         action.ACTION_NAME_DATASET_ZIP_PARTITION: cf_dataset_zipper.zip_dataset_partition,
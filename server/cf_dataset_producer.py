@@ -18,7 +18,8 @@ __author__ = "lizlooney@google.com (Liz Looney)"
 
 # Python Standard Library
 import collections
-import io
+import concurrent.futures
+from datetime import timedelta
 import json
 import logging
 import math
@@ -29,7 +30,7 @@ import uuid
 
 # Other Modules
 import cv2
-import PIL.Image
+import numpy as np
 import tensorflow as tf
 import dataset_util
 
@@ -39,6 +40,32 @@ from app_engine import bbox_writer
 from app_engine import blob_storage
 from app_engine import exceptions
 from app_engine import storage
+import video_cache
+import video_index
+
+# If True, each video is decoded once, by a single action that writes the selected frames, already
+# encoded, into frame shard blobs. That action then triggers one action per record, which reads the
+# record's frames from the shards. If False, each record is written by its own action, which decodes
+# the video up to the last frame in the record. Either way, the records contain the same shuffled
+# frames.
+PRODUCE_RECORDS_PER_VIDEO = True
+# A frame shard is stored when it reaches this many bytes, so the action holds at most one shard in
+# memory.
+FRAME_SHARD_BYTES = 32 * 1024 * 1024
+# A partial frame shard is stored, and the action is retriggered, when this much time remains.
+FRAME_SHARD_FLUSH_RESERVE = timedelta(seconds=80)
+
+# If True, the JPEG images that were stored during frame extraction are written into the records as
+# is, without decoding the video. Those images were encoded with JPEG quality 50. If False, the
+# frames are decoded from the video and encoded as PNG.
+USE_EXTRACTED_FRAME_IMAGES = False
+# The number of threads used to fetch extracted frame images.
+FRAME_IMAGE_FETCH_WORKER_COUNT = 16
+
+# The image format, 'png' or 'jpeg', used for frames that are decoded from the video.
+RECORD_IMAGE_FORMAT = 'png'
+# The JPEG quality, used if RECORD_IMAGE_FORMAT is 'jpeg'.
+RECORD_JPEG_QUALITY = 95
 
 # NamedTuple for split
 Split = collections.namedtuple('Split', [
@@ -47,7 +74,7 @@ Split = collections.namedtuple('Split', [
 
 # NamedTuple for frame data.
 FrameData = collections.namedtuple('FrameData', [
-    'video_filename', 'frame_number', 'filename', 'image', 'format', 'bboxes_text'])
+    'video_filename', 'frame_number', 'filename', 'image', 'format', 'bboxes_text', 'width', 'height'])
 
 
 def produce_dataset(action_parameters):
@@ -66,7 +93,7 @@ def produce_dataset(action_parameters):
         logging.critical(message)
         raise exceptions.HttpErrorBadRequest(message)
 
-    video_entities = storage.retrieve_video_entities(team_uuid, video_uuid_list)
+    video_entities = storage.retrieve_video_entities_with_label_summary(team_uuid, video_uuid_list)
     if len(video_entities) != len(video_uuid_list):
         message = 'Error: One or more videos not found for video_uuids=%s.' % str(video_uuid_list)
         logging.critical(message)
@@ -81,11 +108,9 @@ def produce_dataset(action_parameters):
 
     for video_entity in video_entities:
         video_uuid = video_entity['video_uuid']
-        # Read the video_frame entities from storage. They contain the labels.
-        video_frame_entities = storage.retrieve_video_frame_entities(
-             team_uuid, video_uuid, 0, video_entity['frame_count'] - 1)
         # Determine which frames will be used for training and which frames will be used for eval.
-        split = __split_for_records(video_frame_entities, eval_percent)
+        # The video entity's label summary has the labels and the excluded frame numbers.
+        split = __split_for_records(video_entity, eval_percent)
         dict_video_uuid_to_split[video_uuid] = split
         train_frame_count += split.train_frame_count
         train_record_count += len(split.train_frame_number_lists)
@@ -107,55 +132,91 @@ def produce_dataset(action_parameters):
     record_number = 0
     train_record_number = 0
     eval_record_number = 0
+    # Keys are video uuids, values are lists of dicts describing the records for the video.
+    dict_video_uuid_to_records = collections.defaultdict(list)
 
-    action_parameters = action.create_action_parameters(
-        team_uuid, action.ACTION_NAME_DATASET_PRODUCE_RECORD)
-    action_parameters['team_uuid'] = team_uuid
-    action_parameters['dataset_uuid'] = dataset_uuid
-    action_parameters['sorted_label_list'] = sorted_label_list
-
-    # Trigger actions for the train records
+    # Train records
     for video_entity in video_entities:
         video_uuid = video_entity['video_uuid']
         split = dict_video_uuid_to_split[video_uuid]
-        action_parameters['video_uuid'] = video_uuid
         for i, train_frame_number_list in enumerate(split.train_frame_number_lists):
-            action_parameters['frame_number_list'] = train_frame_number_list
-            action_parameters['record_number'] = record_number
-            action_parameters['record_id'] = train_record_id_format % (train_record_number, train_record_count)
-            action_parameters['is_eval'] = False
-            action.trigger_action_via_blob(action_parameters)
+            dict_video_uuid_to_records[video_uuid].append({
+                'frame_number_list': train_frame_number_list,
+                'record_number': record_number,
+                'record_id': train_record_id_format % (train_record_number, train_record_count),
+                'is_eval': False,
+            })
             train_record_number += 1
             record_number += 1
 
-    # Trigger actions for the eval records
+    # Eval records
     for video_entity in video_entities:
         video_uuid = video_entity['video_uuid']
         split = dict_video_uuid_to_split[video_uuid]
-        action_parameters['video_uuid'] = video_uuid
         for i, eval_frame_number_list in enumerate(split.eval_frame_number_lists):
-            action_parameters['frame_number_list'] = eval_frame_number_list
-            action_parameters['record_number'] = record_number
-            action_parameters['record_id'] = eval_record_id_format % (eval_record_number, eval_record_count)
-            action_parameters['is_eval'] = True
-            action.trigger_action_via_blob(action_parameters)
+            dict_video_uuid_to_records[video_uuid].append({
+                'frame_number_list': eval_frame_number_list,
+                'record_number': record_number,
+                'record_id': eval_record_id_format % (eval_record_number, eval_record_count),
+                'is_eval': True,
+            })
             eval_record_number += 1
             record_number += 1
 
+    if PRODUCE_RECORDS_PER_VIDEO and not USE_EXTRACTED_FRAME_IMAGES:
+        # Trigger one action per video. The extracted frame images don't need to be decoded, so
+        # they aren't copied into frame shards.
+        action_parameters = action.create_action_parameters(
+            team_uuid, action.ACTION_NAME_DATASET_PRODUCE_VIDEO_RECORDS)
+        action_parameters['team_uuid'] = team_uuid
+        action_parameters['dataset_uuid'] = dataset_uuid
+        action_parameters['sorted_label_list'] = sorted_label_list
+        for video_entity in video_entities:
+            video_uuid = video_entity['video_uuid']
+            if len(dict_video_uuid_to_records[video_uuid]) == 0:
+                continue
+            action_parameters['video_uuid'] = video_uuid
+            action_parameters['records'] = dict_video_uuid_to_records[video_uuid]
+            action.trigger_action_via_blob(action_parameters)
+    else:
+        # Trigger one action per record.
+        for video_entity in video_entities:
+            video_uuid = video_entity['video_uuid']
+            for record in dict_video_uuid_to_records[video_uuid]:
+                __trigger_produce_dataset_record(team_uuid, dataset_uuid, sorted_label_list, video_uuid, record)
 
-def __split_for_records(video_frame_entities, eval_percent, max_frames_per_record=50):
+
+def __trigger_produce_dataset_record(team_uuid, dataset_uuid, sorted_label_list, video_uuid, record,
+        frame_shard_locations=None):
+    action_parameters = action.create_action_parameters(
+        team_uuid, action.ACTION_NAME_DATASET_PRODUCE_RECORD)
+    action_parameters['team_uuid'] = team_uuid
+    action_parameters['dataset_uuid'] = dataset_uuid
+    action_parameters['sorted_label_list'] = sorted_label_list
+    action_parameters['video_uuid'] = video_uuid
+    action_parameters['frame_number_list'] = record['frame_number_list']
+    action_parameters['record_number'] = record['record_number']
+    action_parameters['record_id'] = record['record_id']
+    action_parameters['is_eval'] = record['is_eval']
+    if frame_shard_locations is not None:
+        # Only pass the locations of the frames in this record. Frames that were not found in the
+        # video have no location.
+        action_parameters['frame_shard_locations'] = {
+            str(frame_number): frame_shard_locations[str(frame_number)]
+            for frame_number in record['frame_number_list']
+            if str(frame_number) in frame_shard_locations
+        }
+    action.trigger_action_via_blob(action_parameters)
+
+
+def __split_for_records(video_entity, eval_percent, max_frames_per_record=50):
     # Make sure the shuffle order is the same.
     random.seed(42)
 
-    included_frame_numbers = []
-    label_set = set()
-    for frame_number, video_frame_entity in enumerate(video_frame_entities):
-        if video_frame_entity['include_frame_in_dataset']:
-            included_frame_numbers.append(frame_number)
-            bboxes_text = video_frame_entities[frame_number]['bboxes_text']
-            if bboxes_text is not None:
-                labels = bbox_writer.extract_labels(bboxes_text)
-                label_set.update(set(labels))
+    excluded_frame_numbers = set(video_entity['excluded_frame_numbers'])
+    included_frame_numbers = [frame_number for frame_number in range(video_entity['frame_count'])
+        if frame_number not in excluded_frame_numbers]
+    label_set = set(video_entity['dict_label_to_count'].keys())
     random.shuffle(included_frame_numbers)
 
     if eval_percent == 0 or len(included_frame_numbers) == 1:
@@ -175,28 +236,26 @@ def __split_for_records(video_frame_entities, eval_percent, max_frames_per_recor
         train_frame_numbers = included_frame_numbers[eval_frame_count:]
 
     train_frame_count = len(train_frame_numbers)
-    if train_frame_count > 0:
-        # Split up the training frame numbers.
-        train_record_count = math.ceil(len(train_frame_numbers) / max_frames_per_record)
-        train_frame_number_lists = [[] for i in range(train_record_count)]
-        for i, frame_number in enumerate(train_frame_numbers):
-            train_frame_number_lists[i % train_record_count].append(frame_number)
-    else:
-        train_frame_number_lists = []
+    # Split up the training frame numbers.
+    train_frame_number_lists = __split_frame_numbers(train_frame_numbers, max_frames_per_record)
 
     eval_frame_count = len(eval_frame_numbers)
-    if eval_frame_count > 0:
-        # Split up the eval frame numbers.
-        eval_record_count = math.ceil(len(eval_frame_numbers) / max_frames_per_record)
-        eval_frame_number_lists = [[] for i in range(eval_record_count)]
-        for i, frame_number in enumerate(eval_frame_numbers):
-            eval_frame_number_lists[i % eval_record_count].append(frame_number)
-    else:
-        eval_frame_number_lists = []
+    # Split up the eval frame numbers.
+    eval_frame_number_lists = __split_frame_numbers(eval_frame_numbers, max_frames_per_record)
     return Split(train_frame_count, train_frame_number_lists,
         eval_frame_count, eval_frame_number_lists, label_set)
 
 
+def __split_frame_numbers(shuffled_frame_numbers, max_frames_per_record):
+    if len(shuffled_frame_numbers) == 0:
+        return []
+    record_count = math.ceil(len(shuffled_frame_numbers) / max_frames_per_record)
+    frame_number_lists = [[] for i in range(record_count)]
+    for i, frame_number in enumerate(shuffled_frame_numbers):
+        frame_number_lists[i % record_count].append(frame_number)
+    return frame_number_lists
+
+
 def produce_dataset_record(action_parameters):
     team_uuid = action_parameters['team_uuid']
     dataset_uuid = action_parameters['dataset_uuid']
@@ -210,12 +269,18 @@ def produce_dataset_record(action_parameters):
     # Read the video_entity from storage.
     video_entity = storage.retrieve_video_entity(team_uuid, video_uuid)
 
-    # Read the video_frame entities from storage. They contain the labels.
-    video_frame_entities = storage.retrieve_video_frame_entities(
-         team_uuid, video_uuid, 0, video_entity['frame_count'] - 1)
+    # Read the video_frame entities for the frames in frame_number_list from storage. They contain
+    # the labels.
+    video_frame_entities = storage.retrieve_video_frame_entities_for_frame_numbers(
+         team_uuid, video_uuid, frame_number_list)
 
     # Get the data for the frames in frame_number_list.
-    frame_data_dict = __get_frame_data(video_entity, video_frame_entities, frame_number_list)
+    if 'frame_shard_locations' in action_parameters:
+        # The frames were already decoded and stored in frame shards.
+        frame_data_dict = __get_frame_data_from_shards(team_uuid, dataset_uuid, video_entity,
+            video_frame_entities, action_parameters['frame_shard_locations'])
+    else:
+        frame_data_dict = __get_frame_data(video_entity, video_frame_entities, frame_number_list)
 
     # Make the directory for tensorflow record file.
     folder = '/tmp/dataset/%s' % str(uuid.uuid4().hex)
@@ -230,14 +295,153 @@ def produce_dataset_record(action_parameters):
         shutil.rmtree(folder)
 
 
+def produce_dataset_video_records(action_parameters):
+    team_uuid = action_parameters['team_uuid']
+    dataset_uuid = action_parameters['dataset_uuid']
+    video_uuid = action_parameters['video_uuid']
+    sorted_label_list = action_parameters['sorted_label_list']
+
+    # frame_shard_locations is a dict where keys are frame numbers, as strings, and values are
+    # [shard_index, start, length, width, height, format] lists. It is kept in the action parameters
+    # so a retriggered action continues after the frames that are already in shards.
+    if 'frame_shard_locations' not in action_parameters:
+        action_parameters['frame_shard_locations'] = {}
+        action_parameters['next_shard_index'] = 0
+        action_parameters['frame_shards_done'] = False
+    frame_shard_locations = action_parameters['frame_shard_locations']
+
+    if not action_parameters['frame_shards_done']:
+        # Read the video_entity from storage.
+        video_entity = storage.retrieve_video_entity(team_uuid, video_uuid)
+
+        frame_numbers = set()
+        for record in action_parameters['records']:
+            frame_numbers.update(record['frame_number_list'])
+        remaining_frame_numbers = sorted([frame_number for frame_number in frame_numbers
+            if str(frame_number) not in frame_shard_locations])
+
+        # Read the video_frame entities for the remaining frames from storage.
+        video_frame_entities = storage.retrieve_video_frame_entities_for_frame_numbers(
+             team_uuid, video_uuid, remaining_frame_numbers)
+
+        # Decode the rest of the video once, storing the frames in shards.
+        __store_frame_shards(team_uuid, dataset_uuid, video_entity, video_frame_entities,
+            remaining_frame_numbers, action_parameters)
+        action_parameters['frame_shards_done'] = True
+
+    # Trigger one action per record. The records are written in parallel.
+    while len(action_parameters['records']) > 0:
+        record = action_parameters['records'][0]
+        __trigger_produce_dataset_record(team_uuid, dataset_uuid, sorted_label_list, video_uuid, record,
+            frame_shard_locations)
+        # Remove the record from the action parameters so it isn't triggered again if the action is
+        # retriggered.
+        action_parameters['records'] = action_parameters['records'][1:]
+        action.retrigger_if_necessary(action_parameters)
+
+
+def __store_frame_shards(team_uuid, dataset_uuid, video_entity, video_frame_entities, frame_numbers,
+        action_parameters):
+    video_uuid = video_entity['video_uuid']
+    shard = bytearray()
+    # Keys are frame numbers, as strings, values are locations of the frames in shard.
+    shard_frame_locations = {}
+    frame_data_generator = __generate_frame_data(video_entity, video_frame_entities, frame_numbers)
+    try:
+        for frame_data in frame_data_generator:
+            shard_frame_locations[str(frame_data.frame_number)] = [
+                action_parameters['next_shard_index'], len(shard), len(frame_data.image),
+                frame_data.width, frame_data.height, frame_data.format]
+            shard.extend(frame_data.image)
+            time_is_short = action.remaining_timedelta(action_parameters) <= FRAME_SHARD_FLUSH_RESERVE
+            if len(shard) >= FRAME_SHARD_BYTES or time_is_short:
+                __store_frame_shard(team_uuid, dataset_uuid, video_uuid, shard, shard_frame_locations,
+                    action_parameters)
+                shard = bytearray()
+                shard_frame_locations = {}
+                if time_is_short:
+                    action.retrigger_now(action_parameters)
+                action.retrigger_if_necessary(action_parameters)
+    finally:
+        frame_data_generator.close()
+    if len(shard) > 0:
+        __store_frame_shard(team_uuid, dataset_uuid, video_uuid, shard, shard_frame_locations,
+            action_parameters)
+
+
+def __store_frame_shard(team_uuid, dataset_uuid, video_uuid, shard, shard_frame_locations, action_parameters):
+    blob_storage.store_dataset_frame_shard(team_uuid, dataset_uuid, video_uuid,
+        action_parameters['next_shard_index'], bytes(shard))
+    # Only record the frame locations once the shard has been stored.
+    action_parameters['frame_shard_locations'].update(shard_frame_locations)
+    action_parameters['next_shard_index'] += 1
+
+
+def __get_frame_data_from_shards(team_uuid, dataset_uuid, video_entity, video_frame_entities,
+        frame_shard_locations):
+    # frame_data_dict is a dict where keys are frame numbers, and values are FrameData named tuples.
+    video_uuid = video_entity['video_uuid']
+    frame_numbers = sorted([int(frame_number) for frame_number in frame_shard_locations.keys()])
+    locations = [frame_shard_locations[str(frame_number)] for frame_number in frame_numbers]
+    frame_data_dict = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=FRAME_IMAGE_FETCH_WORKER_COUNT) as executor:
+        images = executor.map(blob_storage.retrieve_dataset_frame_shard_range,
+            [team_uuid] * len(locations), [dataset_uuid] * len(locations), [video_uuid] * len(locations),
+            [location[0] for location in locations], [location[1] for location in locations],
+            [location[2] for location in locations])
+        for frame_number, location, image in zip(frame_numbers, locations, images):
+            shard_index, start, length, width, height, format = location
+            filename = '%s_%05d.%s' % (video_uuid, frame_number, __get_file_extension(format))
+            bboxes_text = video_frame_entities[frame_number]['bboxes_text']
+            frame_data_dict[frame_number] = FrameData(
+                video_entity['video_filename'], frame_number,
+                filename, image, format, bboxes_text, width, height)
+    return frame_data_dict
+
+
 def __get_frame_data(video_entity, video_frame_entities, frame_number_list):
+    # frame_data_dict is a dict where keys are frame numbers, and values are FrameData named tuples.
+    frame_data_dict = {}
+    for frame_data in __generate_frame_data(video_entity, video_frame_entities, frame_number_list):
+        frame_data_dict[frame_data.frame_number] = frame_data
+    return frame_data_dict
+
+
+def __generate_frame_data(video_entity, video_frame_entities, frame_number_list):
+    if USE_EXTRACTED_FRAME_IMAGES:
+        # Use the extracted frame images, unless some of them are missing.
+        if all('image_blob_name' in video_frame_entities[frame_number] for frame_number in frame_number_list):
+            return __generate_frame_data_from_images(video_entity, video_frame_entities, frame_number_list)
+        logging.warning('Frame images for video_uuid=%s are incomplete. Decoding the video instead.' %
+            video_entity['video_uuid'])
+    return __generate_frame_data_from_video(video_entity, video_frame_entities, frame_number_list)
+
+
+def __generate_frame_data_from_images(video_entity, video_frame_entities, frame_number_list):
+    video_uuid = video_entity['video_uuid']
+    sorted_frame_numbers = sorted(set(frame_number_list))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=FRAME_IMAGE_FETCH_WORKER_COUNT) as executor:
+        images = executor.map(blob_storage.retrieve_video_frame_image,
+            [video_frame_entities[frame_number]['image_blob_name'] for frame_number in sorted_frame_numbers])
+        for frame_number, image in zip(sorted_frame_numbers, images):
+            format = 'jpeg'
+            filename = '%s_%05d.jpg' % (video_uuid, frame_number)
+            bboxes_text = video_frame_entities[frame_number]['bboxes_text']
+            yield FrameData(
+                video_entity['video_filename'], frame_number,
+                filename, image, format, bboxes_text, video_entity['width'], video_entity['height'])
+
+
+def __generate_frame_data_from_video(video_entity, video_frame_entities, frame_number_list):
     video_uuid = video_entity['video_uuid']
     video_blob_name = video_entity['video_blob_name']
 
-    # Write the video out to a temporary file and open it with cv2.
-    temp_video_filename = '/tmp/%s' % str(uuid.uuid4().hex)
-    os.makedirs(os.path.dirname(temp_video_filename), exist_ok=True)
-    blob_storage.write_video_to_file(video_blob_name, temp_video_filename)
+    # Get a local copy of the video file and open it with cv2.
+    temp_video_filename = video_cache.acquire_video_file(video_blob_name)
+    if temp_video_filename is None:
+        message = "Error: Video blob for video_uuid=%s not found." % video_uuid
+        logging.critical(message)
+        raise RuntimeError(message)
     try:
         vid = cv2.VideoCapture(temp_video_filename)
         if not vid.isOpened():
@@ -245,41 +449,52 @@ def __get_frame_data(video_entity, video_frame_entities, frame_number_list):
             logging.critical(message)
             raise RuntimeError(message)
         try:
-            # frame_data_dict is a dict where keys are frame numbers, and values are FrameData
-            # named tuples.
-            frame_data_dict = {}
-            frame_number = 0
-            while True:
-                if frame_number in frame_number_list:
-                    success, frame = vid.read()
-                    if not success:
-                        # We've reached the end of the video.
-                        break
-                    format = 'png'
-                    success, buffer = cv2.imencode('.%s' % format, frame)
-                    if not success:
-                        message = 'cv2.imencode returned %s for frame number %d.' % (success, frame_number)
-                        logging.critical(message)
-                        raise RuntimeError(message)
-                    filename = '%s_%05d.%s' % (video_uuid, frame_number, format)
-                    image = buffer
-                    bboxes_text = video_frame_entities[frame_number]['bboxes_text']
-                    frame_data_dict[frame_number] = FrameData(
-                        video_entity['video_filename'], frame_number,
-                        filename, image, format, bboxes_text)
-                else:
-                    success = vid.grab()
-                    if not success:
-                        # We've reached the end of the video.
-                        break
-                frame_number += 1
-            return frame_data_dict
+            # Use the video's seek index, if it has one, to skip over long runs of frames that
+            # aren't in frame_number_list.
+            index = video_index.retrieve_index(video_blob_name)
+            next_frame_number = 0
+            for frame_number in sorted(set(frame_number_list)):
+                vid = video_index.seek_to_frame(vid, temp_video_filename,
+                    next_frame_number, frame_number, index)
+                success, frame = vid.read()
+                if not success:
+                    # We've reached the end of the video.
+                    break
+                next_frame_number = frame_number + 1
+                format = RECORD_IMAGE_FORMAT
+                image = encode_frame_image(frame, format, RECORD_JPEG_QUALITY)
+                if image is None:
+                    message = 'cv2.imencode failed for frame number %d.' % frame_number
+                    logging.critical(message)
+                    raise RuntimeError(message)
+                filename = '%s_%05d.%s' % (video_uuid, frame_number, __get_file_extension(format))
+                bboxes_text = video_frame_entities[frame_number]['bboxes_text']
+                yield FrameData(
+                    video_entity['video_filename'], frame_number,
+                    filename, image, format, bboxes_text, frame.shape[1], frame.shape[0])
         finally:
             # Release the cv2 video.
             vid.release()
     finally:
-        # Delete the temporary file.
-        os.remove(temp_video_filename)
+        # Let the video cache know we are finished with the file.
+        video_cache.release_video_file(temp_video_filename)
+
+
+def encode_frame_image(frame, format, jpeg_quality):
+    # Returns the encoded image bytes, or None if the frame could not be encoded.
+    if format == 'jpeg':
+        success, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality])
+    else:
+        success, buffer = cv2.imencode('.png', frame)
+    if not success:
+        return None
+    return buffer.tobytes()
+
+
+def __get_file_extension(format):
+    if format == 'jpeg':
+        return 'jpg'
+    return format
 
 
 def __write_record(team_uuid, sorted_label_list, frame_number_list, frame_data_dict,
@@ -307,20 +522,18 @@ def __write_record(team_uuid, sorted_label_list, frame_number_list, frame_data_d
 
 
 def __create_tf_example(frame_data, sorted_label_list):
-    # frame_data.image is a numpy.ndarray. Convert it to bytes.
-    im = PIL.Image.open(io.BytesIO(frame_data.image))
-    arr = io.BytesIO()
-    im.save(arr, format=frame_data.format)
-    height = im.height
-    width = im.width
-    encoded_image_data = arr.getvalue()
+    # frame_data.image is already encoded in frame_data.format. Use it as is.
+    height = frame_data.height
+    width = frame_data.width
+    encoded_image_data = frame_data.image
 
     rects, labels = bbox_writer.convert_text_to_rects_and_labels(frame_data.bboxes_text)
-    # List of normalized coordinates, 1 per box, capped to [0, 1]
-    xmins = [max(min(rect[0] / width, 1), 0) for rect in rects] # left x
-    xmaxs = [max(min(rect[2] / width, 1), 0) for rect in rects] # right x
-    ymins = [max(min(rect[1] / height, 1), 0) for rect in rects] # top y
-    ymaxs = [max(min(rect[3] / height, 1), 0) for rect in rects] # bottom y
+    # Normalized coordinates, 1 per box, capped to [0, 1]
+    normalized_rects = np.clip(rects / np.array([width, height, width, height], dtype=float), 0, 1)
+    xmins = normalized_rects[:, 0].tolist() # left x
+    xmaxs = normalized_rects[:, 2].tolist() # right x
+    ymins = normalized_rects[:, 1].tolist() # top y
+    ymaxs = normalized_rects[:, 3].tolist() # bottom y
 
     classes_txt = [label.encode('utf-8') for label in labels] # String names
     label_to_id_dict = {label: i for i, label in enumerate(sorted_label_list)}
@@ -15,34 +15,44 @@
 __author__ = "lizlooney@google.com (Liz Looney)"
 
 # Python Standard Library
-import io
+import logging
 import os
+import shutil
 import zipfile
+import zlib
 
 # My Modules
 from app_engine import action
 from app_engine import blob_storage
 from app_engine import storage
 
+# The records are mostly PNG or JPEG images, which deflate hardly shrinks. Before zipping, deflate
+# a sample of each of a few records. If it doesn't save at least MIN_DEFLATE_SAVINGS, store the
+# files without compression.
+COMPRESSIBILITY_SAMPLE_FILE_COUNT = 3
+COMPRESSIBILITY_SAMPLE_BYTES = 1024 * 1024
+MIN_DEFLATE_SAVINGS = 0.05
+
 
 def zip_dataset(action_parameters):
     team_uuid = action_parameters['team_uuid']
     dataset_zip_uuid = action_parameters['dataset_zip_uuid']
     dataset_uuid = action_parameters['dataset_uuid']
-    partition_count = action_parameters['partition_count']
+    partition_lists = action_parameters['partition_lists']
 
-    partition_lists = [[] for i in range(partition_count)]
     dataset_entity = storage.retrieve_dataset_entity(team_uuid, dataset_uuid)
-    partition_lists[0].append(dataset_entity['label_map_blob_name'])
-    dataset_record_entities = storage.retrieve_dataset_records(dataset_entity)
-    for i, dataset_record_entity in enumerate(dataset_record_entities):
-        partition_lists[(i + 1) % partition_count].append(dataset_record_entity['tf_record_blob_name'])
+    record_blob_names = [blob_name
+        for partition_list in partition_lists
+        for blob_name in partition_list
+        if blob_name != dataset_entity['label_map_blob_name']]
+    compress_type = __choose_compress_type(record_blob_names)
 
     # Trigger actions for the partitions
     action_parameters = action.create_action_parameters(
         team_uuid, action.ACTION_NAME_DATASET_ZIP_PARTITION)
     action_parameters['team_uuid'] = team_uuid
     action_parameters['dataset_zip_uuid'] = dataset_zip_uuid
+    action_parameters['compress_type'] = compress_type
     for partition_index, partition_list in enumerate(partition_lists):
         file_count = len(partition_list)
         storage.update_dataset_zipper(team_uuid, dataset_zip_uuid, partition_index, file_count, 0)
@@ -50,20 +60,48 @@ def zip_dataset(action_parameters):
         action_parameters['partition_index'] = partition_index
         action.trigger_action_via_blob(action_parameters)
 
+def __choose_compress_type(record_blob_names):
+    sample_count = min(COMPRESSIBILITY_SAMPLE_FILE_COUNT, len(record_blob_names))
+    if sample_count == 0:
+        return zipfile.ZIP_DEFLATED
+    # Sample records spread through the dataset.
+    step = len(record_blob_names) / sample_count
+    sample_bytes = 0
+    compressed_bytes = 0
+    for i in range(sample_count):
+        blob_name = record_blob_names[int(i * step)]
+        sample = blob_storage.open_dataset_blob(blob_name).read(COMPRESSIBILITY_SAMPLE_BYTES)
+        sample_bytes += len(sample)
+        compressed_bytes += len(zlib.compress(sample))
+    if sample_bytes == 0:
+        return zipfile.ZIP_DEFLATED
+    savings = 1 - compressed_bytes / sample_bytes
+    compress_type = zipfile.ZIP_DEFLATED if savings >= MIN_DEFLATE_SAVINGS else zipfile.ZIP_STORED
+    logging.info('Deflate saved %.1f%% of %d sampled bytes, using %s' % (100 * savings, sample_bytes,
+        'ZIP_DEFLATED' if compress_type == zipfile.ZIP_DEFLATED else 'ZIP_STORED'))
+    return compress_type
+
 def zip_dataset_partition(action_parameters):
     team_uuid = action_parameters['team_uuid']
     dataset_zip_uuid = action_parameters['dataset_zip_uuid']
     partition_list = action_parameters['partition_list']
     partition_index = action_parameters['partition_index']
+    compress_type = action_parameters.get('compress_type', zipfile.ZIP_DEFLATED)
     files_written = 0
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "a", zipfile.ZIP_DEFLATED, allowZip64=True) as zip_file:
+    # Stream each file from its blob, through the zip encoder, into a resumable upload, so neither
+    # the files nor the zip are held in memory.
+    zip_writer = blob_storage.open_dataset_zip_writer(team_uuid, dataset_zip_uuid, partition_index)
+    with zipfile.ZipFile(zip_writer, "w", compress_type, allowZip64=True) as zip_file:
         # Write the files.
         file_count = len(partition_list)
         for blob_name in partition_list:
-            content = blob_storage.retrieve_dataset_blob(blob_name)
+            blob_reader = blob_storage.open_dataset_blob(blob_name)
             filename = os.path.basename(blob_name)
-            zip_file.writestr(filename, content)
+            # The zip writer can't seek back to fix the local header, so zip64 has to be decided up
+            # front.
+            force_zip64 = blob_reader.size > zipfile.ZIP64_LIMIT
+            with zip_file.open(filename, "w", force_zip64=force_zip64) as zip_entry:
+                shutil.copyfileobj(blob_reader, zip_entry, blob_storage.STREAMING_CHUNK_SIZE)
             files_written += 1
             storage.update_dataset_zipper(team_uuid, dataset_zip_uuid, partition_index, file_count, files_written)
-    blob_storage.store_dataset_zip(team_uuid, dataset_zip_uuid, partition_index, zip_buffer.getvalue())
+    zip_writer.close()
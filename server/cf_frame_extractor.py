@@ -15,11 +15,11 @@
 __author__ = "lizlooney@google.com (Liz Looney)"
 
 # Python Standard Library
+import collections
+import concurrent.futures
 from datetime import timedelta
 import logging
-import os
 import time
-import uuid
 
 # Other Modules
 import cv2
@@ -30,6 +30,19 @@ from app_engine import blob_storage
 from app_engine import constants
 from app_engine import storage
 from app_engine import frame_extractor
+import video_cache
+import video_index
+
+# If True, the frames are counted in a separate pass before any are extracted. Otherwise, the frames
+# are counted while they are extracted and the video's frame_count is fixed up at the end.
+COUNT_FRAMES_BEFORE_EXTRACTION = False
+# The number of frames whose video_frame entities are updated in a single datastore transaction.
+FRAME_COMMIT_BATCH_SIZE = 50
+# The maximum number of frames that have been decoded but not yet encoded, and the maximum number
+# that have been encoded but not yet uploaded.
+MAX_FRAME_UPLOADS_IN_FLIGHT = 16
+# The number of threads used to encode and upload frames.
+FRAME_WORKER_COUNT = 8
 
 
 def wait_for_video_upload(action_parameters):
@@ -65,12 +78,10 @@ def extract_frames(action_parameters):
     if video_entity['delete_in_progress']:
         return
 
-    # Write the video out to a temporary file.
+    # Get a local copy of the video file.
     video_blob_name = video_entity['video_blob_name']
-    video_filename = '/tmp/%s' % str(uuid.uuid4().hex)
-    os.makedirs(os.path.dirname(video_filename), exist_ok=True)
-
-    if not blob_storage.write_video_to_file(video_blob_name, video_filename):
+    video_filename = video_cache.acquire_video_file(video_blob_name)
+    if video_filename is None:
         storage.frame_extraction_failed(team_uuid, video_uuid,
                 "Unable to extract frames from the video.")
         return
@@ -85,100 +96,202 @@ def extract_frames(action_parameters):
                     "Unable to the open the video file.")
             return
         try:
-            # If we haven't extracted any frames yet, we need to create the video frame entities
-            # and update the video entity with the width, height, fps, and frame_count.
+            width = int(vid.get(cv2.CAP_PROP_FRAME_WIDTH))
+            height = int(vid.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            fps = vid.get(cv2.CAP_PROP_FPS)
+
+            # If we haven't extracted any frames yet, we need to update the video entity with the
+            # width, height, fps, and frame_count.
             if previously_extracted_frame_count == 0:
-                width = int(vid.get(cv2.CAP_PROP_FRAME_WIDTH))
-                height = int(vid.get(cv2.CAP_PROP_FRAME_HEIGHT))
-                fps = vid.get(cv2.CAP_PROP_FPS)
-                # Count the frames. Getting the CAP_PROP_FRAME_COUNT property is not reliable.
-                # Instead, we iterate through the video using vid.grab(), which is faster than
-                # vid.read().
-                frame_count = 0
-                while True:
-                    action.retrigger_if_necessary(action_parameters)
-                    success = vid.grab()
-                    if not success:
-                        # We've reached the end of the video. All finished counting!
-                        break
-                    frame_count += 1
-                # Limit by duration.
-                duration = frame_count / fps
-                if duration > constants.MAX_VIDEO_LENGTH_SECONDS:
-                    message = "This video is longer than %d seconds, which is the maximum duration allowed." % constants.MAX_VIDEO_LENGTH_SECONDS
-                    storage.frame_extraction_failed(team_uuid, video_uuid, message,
-                            width=width, height=height, fps=fps, frame_count=frame_count)
-                    return
-                # Limit by number of frames.
-                if frame_count > constants.MAX_FRAMES_PER_VIDEO:
-                    message = "This video has more than %d frames, which is the maximum allowed." % constants.MAX_FRAMES_PER_VIDEO
-                    storage.frame_extraction_failed(team_uuid, video_uuid, message,
-                            width=width, height=height, fps=fps, frame_count=frame_count)
-                    return
-                # Don't allow videos that have zero frames.
-                if frame_count <= 0:
-                    storage.frame_extraction_failed(team_uuid, video_uuid,
-                            "This video has zero frames.",
-                            width=width, height=height, fps=fps, frame_count=frame_count)
-                    return
-                # Limit by resolution.
-                if (max(width, height) > max(constants.MAX_VIDEO_RESOLUTION_WIDTH, constants.MAX_VIDEO_RESOLUTION_HEIGHT) or
-                        min(width, height) > min(constants.MAX_VIDEO_RESOLUTION_WIDTH, constants.MAX_VIDEO_RESOLUTION_HEIGHT)):
-                    message = "This video's resolution is larger than %d x %d, which is the maximum resolution allowed." % (
-                            constants.MAX_VIDEO_RESOLUTION_WIDTH, constants.MAX_VIDEO_RESOLUTION_HEIGHT)
-                    storage.frame_extraction_failed(team_uuid, video_uuid, message,
-                            width=width, height=height, fps=fps, frame_count=frame_count)
-                    return
-
-                video_entity = storage.frame_extraction_starting(team_uuid, video_uuid,
-                    width, height, fps, frame_count)
-                if video_entity['delete_in_progress']:
-                    return
-
-                # Back up to the beginning of the video. Setting the CAP_PROP_POS_FRAMES property
-                # is not reliable. Instead, we release vid and open it again.
-                vid.release()
-                vid = cv2.VideoCapture(video_filename)
-            else:
-                # We are continuing the extraction. Skip to the next frame we need to extract.
-                # Setting the CAP_PROP_POS_FRAMES property is not reliable. Instead, we skip
-                # through frames using vid.grab().
-                for i in range(previously_extracted_frame_count):
-                    ret = vid.grab()
+                if COUNT_FRAMES_BEFORE_EXTRACTION:
+                    # Count the frames. Getting the CAP_PROP_FRAME_COUNT property is not reliable.
+                    # Instead, we iterate through the video using vid.grab(), which is faster than
+                    # vid.read().
+                    frame_count = 0
+                    while True:
+                        action.retrigger_if_necessary(action_parameters)
+                        success = vid.grab()
+                        if not success:
+                            # We've reached the end of the video. All finished counting!
+                            break
+                        frame_count += 1
+                    if __fail_if_too_long(team_uuid, video_uuid, width, height, fps, frame_count):
+                        return
+                    # Don't allow videos that have zero frames.
+                    if frame_count <= 0:
+                        storage.frame_extraction_failed(team_uuid, video_uuid,
+                                "This video has zero frames.",
+                                width=width, height=height, fps=fps, frame_count=frame_count)
+                        return
+                    if __fail_if_resolution_too_large(team_uuid, video_uuid, width, height, fps, frame_count):
+                        return
 
-            frame_number = previously_extracted_frame_count
+                    video_entity = storage.frame_extraction_starting(team_uuid, video_uuid,
+                        width, height, fps, frame_count)
+                    if video_entity['delete_in_progress']:
+                        return
 
-            action.retrigger_if_necessary(action_parameters)
-
-            while True:
-                success, frame = vid.read()
-                if not success:
-                    # We've reached the end of the video. All finished extracting frames!
-                    video_entity = storage.frame_extraction_done(team_uuid, video_uuid, frame_number)
-                    return
-                # Store the frame as a jpg image, which are smaller/faster than png.
-                success, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 50])
-                if success:
-                    try:
-                        video_entity = storage.store_frame_image(team_uuid, video_uuid, frame_number,
-                            'image/jpg', buffer.tostring())
-                    except:
-                        # Check if the video has been deleted.
-                        team_entity = storage.retrieve_team_entity(team_uuid)
-                        if 'video_uuids_deleted' in team_entity:
-                            if video_uuid in team_entity['video_uuids_deleted']:
-                                return
-                        raise
+                    # Back up to the beginning of the video. Setting the CAP_PROP_POS_FRAMES property
+                    # is not reliable. Instead, we release vid and open it again.
+                    vid.release()
+                    vid = cv2.VideoCapture(video_filename)
+                else:
+                    # The frames are counted while they are extracted. Until then, use the
+                    # CAP_PROP_FRAME_COUNT property as an estimate. The actual frame_count is stored
+                    # by storage.frame_extraction_done.
+                    frame_count = int(vid.get(cv2.CAP_PROP_FRAME_COUNT))
+                    # Check the limits with the estimate before uploading any frames. The limits are
+                    # checked again for each frame, in case the estimate is too low.
+                    if __fail_if_too_long(team_uuid, video_uuid, width, height, fps, frame_count):
+                        return
+                    if __fail_if_resolution_too_large(team_uuid, video_uuid, width, height, fps, frame_count):
+                        return
+
+                    video_entity = storage.frame_extraction_starting(team_uuid, video_uuid,
+                        width, height, fps, frame_count, create_video_frames=False)
                     if video_entity['delete_in_progress']:
                         return
-                    frame_number += 1
+                index = video_index.create_index(fps)
+            else:
+                # We are continuing the extraction. Skip to the next frame we need to extract.
+                index = video_index.retrieve_index(video_blob_name)
+                if index is not None and len(index['frame_timestamps_ms']) >= previously_extracted_frame_count:
+                    video_index.truncate_index(index, previously_extracted_frame_count)
+                    vid = video_index.seek_to_frame(vid, video_filename,
+                        0, previously_extracted_frame_count, index)
                 else:
-                    logging.error('cv2.imencode() returned %s' % success)
+                    # Setting the CAP_PROP_POS_FRAMES property is not reliable. Instead, we skip
+                    # through frames using vid.grab() and record their timestamps as we go.
+                    index = video_index.create_index(fps)
+                    for i in range(previously_extracted_frame_count):
+                        if vid.grab():
+                            video_index.record_frame(vid, index)
+
+            frame_number = previously_extracted_frame_count
+
+            # Frames are decoded here, one at a time. Encoding each frame happens on the worker
+            # threads. Frame numbers are assigned here, in decoding order, as the encoded frames come
+            # back, so a frame that can't be encoded is skipped without leaving a gap. Uploading each
+            # frame also happens on the worker threads. The video_frame entities and the video entity
+            # are updated once per batch of frames, after all the frames in the batch have been
+            # uploaded.
+            pending_encodes = collections.deque()
+            pending_uploads = collections.deque()
+            decoded_frame_count = frame_number
+            batch_frame_number = frame_number
+            batch_image_blob_names = []
+            try:
                 action.retrigger_if_necessary(action_parameters)
 
+                with concurrent.futures.ThreadPoolExecutor(max_workers=FRAME_WORKER_COUNT) as executor:
+                    while True:
+                        success, frame = vid.read()
+                        if success:
+                            video_index.record_frame(vid, index)
+                            decoded_frame_count += 1
+                            if __fail_if_too_long(team_uuid, video_uuid, width, height, fps, decoded_frame_count):
+                                return
+                            pending_encodes.append(executor.submit(__encode_frame_image, frame))
+                        # Wait for encodes and uploads if there are too many in flight or we've
+                        # reached the end of the video.
+                        while len(pending_encodes) >= MAX_FRAME_UPLOADS_IN_FLIGHT or (not success and len(pending_encodes) > 0):
+                            image = pending_encodes.popleft().result()
+                            if image is None:
+                                # Skip this frame. Its timestamp is the one for frame_number, since
+                                # the timestamps of frames skipped earlier have already been removed.
+                                del index['frame_timestamps_ms'][frame_number]
+                                continue
+                            pending_uploads.append(executor.submit(blob_storage.store_video_frame_image,
+                                team_uuid, video_uuid, frame_number, 'image/jpg', image))
+                            frame_number += 1
+                        while len(pending_uploads) >= MAX_FRAME_UPLOADS_IN_FLIGHT or (not success and len(pending_uploads) > 0):
+                            batch_image_blob_names.append(pending_uploads.popleft().result())
+                            if len(batch_image_blob_names) >= FRAME_COMMIT_BATCH_SIZE:
+                                video_entity = __commit_frame_images(team_uuid, video_uuid,
+                                    batch_frame_number, batch_image_blob_names)
+                                if video_entity is None or video_entity['delete_in_progress']:
+                                    return
+                                batch_frame_number += len(batch_image_blob_names)
+                                batch_image_blob_names = []
+                        if not success:
+                            # We've reached the end of the video. All finished extracting frames!
+                            if len(batch_image_blob_names) > 0:
+                                video_entity = __commit_frame_images(team_uuid, video_uuid,
+                                    batch_frame_number, batch_image_blob_names)
+                                if video_entity is None or video_entity['delete_in_progress']:
+                                    return
+                            # Don't allow videos that have zero frames.
+                            if frame_number <= 0:
+                                storage.frame_extraction_failed(team_uuid, video_uuid,
+                                        "This video has zero frames.",
+                                        width=width, height=height, fps=fps, frame_count=frame_number)
+                                return
+                            video_index.store_index(video_blob_name, index)
+                            video_entity = storage.frame_extraction_done(team_uuid, video_uuid, frame_number)
+                            return
+                        action.retrigger_if_necessary(action_parameters)
+            except action.Stop:
+                # Save the index for the frames that have been committed so the next invocation can
+                # seek to where we left off.
+                video_index.truncate_index(index, batch_frame_number)
+                video_index.store_index(video_blob_name, index)
+                raise
+
         finally:
             # Release the cv2 video.
             vid.release()
     finally:
-        # Delete the temporary file.
-        os.remove(video_filename)
+        # Let the video cache know we are finished with the file.
+        video_cache.release_video_file(video_filename)
+
+
+def __fail_if_too_long(team_uuid, video_uuid, width, height, fps, frame_count):
+    # Limit by duration.
+    duration = frame_count / fps
+    if duration > constants.MAX_VIDEO_LENGTH_SECONDS:
+        message = "This video is longer than %d seconds, which is the maximum duration allowed." % constants.MAX_VIDEO_LENGTH_SECONDS
+        storage.frame_extraction_failed(team_uuid, video_uuid, message,
+                width=width, height=height, fps=fps, frame_count=frame_count)
+        return True
+    # Limit by number of frames.
+    if frame_count > constants.MAX_FRAMES_PER_VIDEO:
+        message = "This video has more than %d frames, which is the maximum allowed." % constants.MAX_FRAMES_PER_VIDEO
+        storage.frame_extraction_failed(team_uuid, video_uuid, message,
+                width=width, height=height, fps=fps, frame_count=frame_count)
+        return True
+    return False
+
+
+def __fail_if_resolution_too_large(team_uuid, video_uuid, width, height, fps, frame_count):
+    # Limit by resolution.
+    if (max(width, height) > max(constants.MAX_VIDEO_RESOLUTION_WIDTH, constants.MAX_VIDEO_RESOLUTION_HEIGHT) or
+            min(width, height) > min(constants.MAX_VIDEO_RESOLUTION_WIDTH, constants.MAX_VIDEO_RESOLUTION_HEIGHT)):
+        message = "This video's resolution is larger than %d x %d, which is the maximum resolution allowed." % (
+                constants.MAX_VIDEO_RESOLUTION_WIDTH, constants.MAX_VIDEO_RESOLUTION_HEIGHT)
+        storage.frame_extraction_failed(team_uuid, video_uuid, message,
+                width=width, height=height, fps=fps, frame_count=frame_count)
+        return True
+    return False
+
+
+def __encode_frame_image(frame):
+    # Store the frame as a jpg image, which are smaller/faster than png.
+    # Returns None if the frame can't be encoded.
+    success, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 50])
+    if not success:
+        logging.error('cv2.imencode() returned %s' % success)
+        return None
+    return buffer.tobytes()
+
+
+def __commit_frame_images(team_uuid, video_uuid, min_frame_number, image_blob_names):
+    try:
+        return storage.store_frame_images(team_uuid, video_uuid, min_frame_number,
+            'image/jpg', image_blob_names)
+    except:
+        # Check if the video has been deleted.
+        team_entity = storage.retrieve_team_entity(team_uuid)
+        if 'video_uuids_deleted' in team_entity:
+            if video_uuid in team_entity['video_uuids_deleted']:
+                return None
+        raise
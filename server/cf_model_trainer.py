@@ -18,11 +18,14 @@ __author__ = "lizlooney@google.com (Liz Looney)"
 from datetime import datetime, timedelta, timezone
 import dateutil.parser
 import io
+import logging
 import math
+import struct
 import time
 
 # Other Modules
 from google.api_core.exceptions import GoogleAPIError
+import google_crc32c
 import PIL.Image
 import tensorflow as tf
 from tensorflow.core.util import event_pb2
@@ -34,6 +37,9 @@ from app_engine import model_trainer
 from app_engine import storage
 from app_engine import tflite_creator
 
+# Stop reading an event file when this much time is left, so there is time to store what was read
+# before the action is retriggered.
+EVENT_FILE_READ_RESERVE = timedelta(seconds=100)
 
 def __update_model_entity_job_state(model_entity):
     # If the training and eval jobs weren't done last time we checked, check now.
@@ -125,15 +131,19 @@ def monitor_training(action_parameters):
                         event_file_path in model_entity['dict_event_file_path_to_updated'] and
                         model_entity['dict_event_file_path_to_updated'][event_file_path] == updated):
                     continue
-                largest_step, scalar_summary_items, image_summary_items = __monitor_training_for_event_file(
-                    model_folder, job_type, event_file_path, action_parameters)
+                # Event files are only appended to, so resume reading where we stopped last time.
+                offset = model_entity.get('dict_event_file_path_to_offset', {}).get(event_file_path, 0)
+                largest_step, scalar_summary_items, image_summary_items, offset, finished = __monitor_training_for_event_file(
+                    model_folder, job_type, event_file_path, offset, action_parameters)
                 scalar_modified_count = storage.store_model_summary_items(team_uuid, model_uuid, job_type,
                     'scalar', scalar_summary_items)
                 image_modified_count = storage.store_model_summary_items(team_uuid, model_uuid, job_type,
                     'image', image_summary_items)
+                # Only store the updated time once the whole file has been read. Until then, the file
+                # is read again, from offset, the next time.
                 model_entity, modified_model_entity = storage.update_model_entity_for_event_file(team_uuid, model_uuid, job_type,
-                    event_file_path, updated, largest_step)
-                if scalar_modified_count > 0 or image_modified_count > 0 or modified_model_entity:
+                    event_file_path, updated if finished else None, offset, largest_step)
+                if scalar_modified_count > 0 or image_modified_count > 0 or modified_model_entity or not finished:
                     action.retrigger_now(action_parameters)
 
         if is_done(model_entity):
@@ -147,59 +157,114 @@ def monitor_training(action_parameters):
         action.retrigger_if_necessary(action_parameters)
 
 
-def __monitor_training_for_event_file(model_folder, job_type, event_file_path, action_parameters):
+def __read_event_record(event_file, event_file_path, offset):
+    # Returns the next record and its size in the file, or None if the file doesn't have a complete
+    # record after the current position. Each record is a uint64 length, a uint32 crc of the length,
+    # the data, and a uint32 crc of the data. If only the data is corrupt, the record is None, so the
+    # caller can skip it. If the length is corrupt, the records after it can't be found, so it raises
+    # RuntimeError.
+    header = event_file.read(12)
+    if len(header) < 12:
+        return None
+    if struct.unpack('<I', header[8:])[0] != __masked_crc32c(header[:8]):
+        message = 'Error: Event file %s has a corrupt record length at offset %d.' % (event_file_path, offset)
+        logging.critical(message)
+        raise RuntimeError(message)
+    length = struct.unpack('<Q', header[:8])[0]
+    data_and_crc = event_file.read(length + 4)
+    if len(data_and_crc) < length + 4:
+        # The trainer hasn't finished writing this record.
+        return None
+    data = data_and_crc[:length]
+    if struct.unpack('<I', data_and_crc[length:])[0] != __masked_crc32c(data):
+        logging.error('Event file %s has a corrupt record at offset %d. Skipping it.' % (event_file_path, offset))
+        return None, 12 + length + 4
+    return data, 12 + length + 4
+
+
+def __masked_crc32c(data):
+    # The masked crc that tensorflow writes in record files.
+    crc = google_crc32c.value(data)
+    return (((crc >> 15) | (crc << 17)) + 0xa282ead8) & 0xffffffff
+
+
+def __monitor_training_for_event_file(model_folder, job_type, event_file_path, offset, action_parameters):
+    # Reads the records that start at offset. Returns the new offset and whether the end of the file
+    # was reached. If not, the action is almost out of time.
     largest_step = None
     scalar_summary_items = {}
     image_summary_items = {}
-    for record in tf.data.TFRecordDataset(event_file_path):
-        action.retrigger_if_necessary(action_parameters)
-        event = event_pb2.Event.FromString(record.numpy())
-        if not hasattr(event, 'step'):
-            continue
-        if largest_step is None or event.step > largest_step:
-            largest_step = event.step
-        if not hasattr(event, 'summary'):
+    finished = False
+    with tf.io.gfile.GFile(event_file_path, 'rb') as event_file:
+        event_file.seek(offset)
+        while True:
+            if action.remaining_timedelta(action_parameters) <= EVENT_FILE_READ_RESERVE:
+                break
+            result = __read_event_record(event_file, event_file_path, offset)
+            if result is None:
+                finished = True
+                break
+            record, record_size = result
+            offset += record_size
+            if record is None:
+                # The record is corrupt.
+                continue
+            largest_step = __process_event_record(model_folder, job_type, record, largest_step,
+                scalar_summary_items, image_summary_items)
+    return largest_step, scalar_summary_items, image_summary_items, offset, finished
+
+
+def __process_event_record(model_folder, job_type, record, largest_step,
+        scalar_summary_items, image_summary_items):
+    # Adds the summary items in the record to scalar_summary_items and image_summary_items. Returns
+    # the largest step.
+    event = event_pb2.Event.FromString(record)
+    if not hasattr(event, 'step'):
+        return largest_step
+    if largest_step is None or event.step > largest_step:
+        largest_step = event.step
+    if not hasattr(event, 'summary'):
+        return largest_step
+    for value in event.summary.value:
+        if (not hasattr(value, 'metadata') or
+                not hasattr(value.metadata, 'plugin_data') or
+                not hasattr(value.metadata.plugin_data, 'plugin_name')):
             continue
-        for value in event.summary.value:
-            if (not hasattr(value, 'metadata') or
-                    not hasattr(value.metadata, 'plugin_data') or
-                    not hasattr(value.metadata.plugin_data, 'plugin_name')):
+        if value.metadata.plugin_data.plugin_name == 'scalars':
+            item_value = float(tf.make_ndarray(value.tensor))
+            if math.isnan(item_value):
                 continue
-            if value.metadata.plugin_data.plugin_name == 'scalars':
-                item_value = float(tf.make_ndarray(value.tensor))
-                if math.isnan(item_value):
-                    continue
-                item = {
-                    'step': event.step,
-                    'tag': value.tag,
-                    'value': item_value
-                }
-                scalar_summary_items[model_trainer.make_key(event.step, value.tag)] = item
-            elif value.metadata.plugin_data.plugin_name == 'images':
-                if job_type == 'train':
-                    # Don't bother saving training images.
-                    continue
-                image_value = tf.make_ndarray(value.tensor)
-                if len(image_value) < 3: # width, height, image bytes
-                    continue
-                width = int(float(image_value[0].decode('utf-8')))
-                height = int(float(image_value[1].decode('utf-8')))
-                image_bytes = image_value[2]
-
-                # Convert to JPEG with lower quality.
-                im = PIL.Image.open(io.BytesIO(image_bytes))
-                arr = io.BytesIO()
-                im.save(arr, format='JPEG', quality=50)
-                jpeg_image_bytes = arr.getvalue()
-
-                blob_storage.store_event_summary_image(model_folder, job_type,
-                    event.step, value.tag, jpeg_image_bytes)
-                item = {
-                    'job_type': job_type,
-                    'step': event.step,
-                    'tag': value.tag,
-                    'width': width,
-                    'height': height,
-                }
-                image_summary_items[model_trainer.make_key(event.step, value.tag)] = item
-    return largest_step, scalar_summary_items, image_summary_items
+            item = {
+                'step': event.step,
+                'tag': value.tag,
+                'value': item_value
+            }
+            scalar_summary_items[model_trainer.make_key(event.step, value.tag)] = item
+        elif value.metadata.plugin_data.plugin_name == 'images':
+            if job_type == 'train':
+                # Don't bother saving training images.
+                continue
+            image_value = tf.make_ndarray(value.tensor)
+            if len(image_value) < 3: # width, height, image bytes
+                continue
+            width = int(float(image_value[0].decode('utf-8')))
+            height = int(float(image_value[1].decode('utf-8')))
+            image_bytes = image_value[2]
+
+            # Convert to JPEG with lower quality.
+            im = PIL.Image.open(io.BytesIO(image_bytes))
+            arr = io.BytesIO()
+            im.save(arr, format='JPEG', quality=50)
+            jpeg_image_bytes = arr.getvalue()
+
+            blob_storage.store_event_summary_image(model_folder, job_type,
+                event.step, value.tag, jpeg_image_bytes)
+            item = {
+                'job_type': job_type,
+                'step': event.step,
+                'tag': value.tag,
+                'width': width,
+                'height': height,
+            }
+            image_summary_items[model_trainer.make_key(event.step, value.tag)] = item
+    return largest_step
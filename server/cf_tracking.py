@@ -18,12 +18,11 @@ __author__ = "lizlooney@google.com (Liz Looney)"
 # https://github.com/google/ftc-object-detection/tree/46197ce4ecaee954c2164d257d7dc24e85678285/training/tracking.py
 
 # Python Standard Library
+import concurrent.futures
 from datetime import datetime, timedelta, timezone
 import logging
-import os
 import time
 import traceback
-import uuid
 
 # Other Modules
 import cv2
@@ -32,9 +31,102 @@ import numpy as np
 # My Modules
 from app_engine import action
 from app_engine import bbox_writer
-from app_engine import blob_storage
+from app_engine import constants
 from app_engine import exceptions
 from app_engine import storage
+from app_engine import tracking_channel
+from app_engine import tracking_metrics
+import video_cache
+import video_index
+
+
+# How many frames the tracker may run ahead of the last frame that the client approved. The tracked
+# bboxes for those frames are stored in the tracker entity, so /continueTracking can answer right
+# away when the user accepts the tracked bboxes without changing them.
+LOOKAHEAD_FRAME_COUNT = 30
+
+# The trackers run on frames that are resized so that neither dimension is larger than this. The
+# accuracy of the trackers doesn't improve much above this, but the time per frame does. Set it to
+# None to track on the full resolution frames.
+TRACKING_MAX_DIMENSION = 1280
+
+# After CSRT loses the object, AdaptiveTracker starts CSRT again from the last good bbox on each
+# following frame, for up to this many frames. After that, the object is treated as lost, for
+# example because it left the frame, and the failures are reported to the client.
+ADAPTIVE_TRACKER_MAX_RECOVERY_FRAMES = 30
+
+
+class AdaptiveTracker():
+    # Tracks one object with KCF, which is fast. If KCF loses the object, or its bbox jumps further
+    # than the object could plausibly move in one frame, switches to CSRT, which is slower but more
+    # robust, starting again from the last good bbox. If CSRT loses the object too, starts CSRT again
+    # from the last good bbox on each following frame, until it finds the object or
+    # ADAPTIVE_TRACKER_MAX_RECOVERY_FRAMES frames have failed in a row.
+
+    def __init__(self):
+        self.tracker = None
+        self.tracker_name = 'KCF'
+        self.last_frame = None
+        self.last_bbox = None
+        self.frame_count = 0
+        self.failure_count = 0
+        self.consecutive_failure_count = 0
+        self.recovery_count = 0
+        self.escalated_frame_count = None
+        self.update_seconds = 0
+
+    def init(self, frame, bbox):
+        self.tracker = cv2.legacy.TrackerKCF_create()
+        self.last_frame = frame
+        self.last_bbox = tuple(bbox)
+        return self.tracker.init(frame, self.last_bbox)
+
+    def update(self, frame):
+        start = time.perf_counter()
+        success, bbox = self.tracker.update(frame)
+        if self.tracker_name == 'KCF' and not (success and self.is_plausible(bbox)):
+            self.tracker_name = 'CSRT'
+            self.escalated_frame_count = self.frame_count
+            success, bbox = self.__restart(frame)
+        elif (self.tracker_name == 'CSRT' and not success and
+                self.consecutive_failure_count < ADAPTIVE_TRACKER_MAX_RECOVERY_FRAMES):
+            # A CSRT tracker that has lost the object doesn't find it again by itself.
+            success, bbox = self.__restart(frame)
+            if success:
+                self.recovery_count += 1
+        self.frame_count += 1
+        self.update_seconds += time.perf_counter() - start
+        if success:
+            self.last_frame = frame
+            self.last_bbox = tuple(bbox)
+            self.consecutive_failure_count = 0
+        else:
+            self.failure_count += 1
+            self.consecutive_failure_count += 1
+        return success, bbox
+
+    def __restart(self, frame):
+        # Starts a new CSRT tracker from the last good bbox and updates it with the given frame.
+        self.tracker = cv2.legacy.TrackerCSRT_create()
+        if not self.tracker.init(self.last_frame, self.last_bbox):
+            return False, None
+        return self.tracker.update(frame)
+
+    def is_plausible(self, bbox):
+        # KCF doesn't report a confidence score. Treat a bbox that changes size by more than half or
+        # moves by more than its own size in one frame as a lost object.
+        x0, y0, w0, h0 = self.last_bbox
+        x, y, w, h = bbox
+        if w <= 0 or h <= 0 or w0 <= 0 or h0 <= 0:
+            return False
+        if not 0.5 <= (w * h) / (w0 * h0) <= 2:
+            return False
+        return abs((x + w / 2) - (x0 + w0 / 2)) <= w0 and abs((y + h / 2) - (y0 + h0 / 2)) <= h0
+
+    def get_summary(self):
+        return '%s, %d frames, %d failures, %d recoveries, escalated to CSRT after %s frames, %.1f ms per frame' % (
+            self.tracker_name, self.frame_count, self.failure_count, self.recovery_count,
+            self.escalated_frame_count, 1000 * self.update_seconds / max(self.frame_count, 1))
 
 
 # These keys should match the values in tracker_fns in server/app_engine/tracking.py.
@@ -46,10 +138,30 @@ tracker_fns = {
     'TLD': cv2.legacy.TrackerTLD_create,
     'KCF': cv2.legacy.TrackerKCF_create,
     'Boosting': cv2.legacy.TrackerBoosting_create,
+    # These trackers update all the objects on each frame concurrently, one thread per object. The
+    # objects share the same decoded frame, and cv2 releases the GIL while a tracker updates.
+    'CSRT-Parallel': cv2.legacy.TrackerCSRT_create,
+    'MedianFlow-Parallel': cv2.legacy.TrackerMedianFlow_create,
+    'MIL-Parallel': cv2.legacy.TrackerMIL_create,
+    'MOSSE-Parallel': cv2.legacy.TrackerMOSSE_create,
+    'TLD-Parallel': cv2.legacy.TrackerTLD_create,
+    'KCF-Parallel': cv2.legacy.TrackerKCF_create,
+    'Boosting-Parallel': cv2.legacy.TrackerBoosting_create,
+    'Adaptive': AdaptiveTracker,
+    'Adaptive-Parallel': AdaptiveTracker,
 }
 
 
 def start_tracking(action_parameters):
+    # Subscribe before reading the tracker client entity, so that a notification sent after the
+    # read wakes us up.
+    subscription = tracking_channel.subscribe_client(action_parameters['tracker_uuid'])
+    try:
+        __track(action_parameters, subscription)
+    finally:
+        subscription.close()
+
+def __track(action_parameters, subscription):
     video_uuid = action_parameters['video_uuid']
     tracker_uuid = action_parameters['tracker_uuid']
 
@@ -70,19 +182,27 @@ def start_tracking(action_parameters):
 
     tracker_name = tracker_entity['tracker_name']
     scale = tracker_entity['scale']
-    frame_number = tracker_entity['frame_number']
+    # The tracker entity's lookahead buffer is the checkpoint that tracking resumes from. When
+    # tracking starts, it holds just the initial frame and bboxes. If this action was retriggered,
+    # it also holds the frames that were tracked after the last frame that the client approved.
+    lookahead_frame_number = tracker_entity['lookahead_frame_number']
+    lookahead_bboxes_texts = list(tracker_entity['lookahead_bboxes_texts'])
+    frame_number = lookahead_frame_number
 
     if tracker_name not in tracker_fns:
         message = 'Error: Tracker named %s not found.' % tracker_name
         logging.critical(message)
         raise exceptions.HttpErrorNotFound(message)
-    tracker_fn = tracker_fns[tracker_name]
 
-    # Write the video out to a temporary file.
-    video_filename = '/tmp/%s' % str(uuid.uuid4().hex)
-    os.makedirs(os.path.dirname(video_filename), exist_ok=True)
-    blob_storage.write_video_to_file(tracker_entity['video_blob_name'], video_filename)
+    # Get a local copy of the video file.
+    video_filename = video_cache.acquire_video_file(tracker_entity['video_blob_name'])
+    if video_filename is None:
+        message = "Error: Video blob for video_uuid=%s not found." % video_uuid
+        logging.critical(message)
+        raise exceptions.HttpErrorNotFound(message)
 
+    trackers = []
+    executor = create_executor(tracker_name)
     try:
         # Open the video file with cv2.
         vid = cv2.VideoCapture(video_filename)
@@ -93,96 +213,187 @@ def start_tracking(action_parameters):
         try:
             if frame_number > 0:
                 # We are tracking from a frame that is not the beginning of the video. Skip to
-                # that frame. Setting the CAP_PROP_POS_FRAMES property is not reliable.
-                # Instead, we skip through frames using vid.grab().
-                for i in range(frame_number):
-                    vid.grab()
+                # that frame, using the video's seek index if it has one.
+                index = video_index.retrieve_index(tracker_entity['video_blob_name'])
+                vid = video_index.seek_to_frame(vid, video_filename, 0, frame_number, index)
 
-            trackers = None
+            # The lookahead buffer starts at the last frame that the client approved.
+            # decoded_frames holds the frames that have been read from the video, starting with
+            # that frame. lookahead_bboxes_texts holds the approved bboxes, followed by the bboxes
+            # for the frames that have been tracked so far.
+            decoded_frames = []
+            end_of_video = False
+            stored_times = {}
 
-            # Read the frame from the video file.
-            success, frame = vid.read()
-            if not success:
-                # We've reached the end of the video.
+            def record_span(span, start_time):
+                tracking_metrics.record(tracker_name, tracker_entity['video_width'], tracker_entity['video_height'],
+                    span, (time.monotonic() - start_time) * 1000)
+
+            # Read the frames in the lookahead buffer from the video file.
+            frame_scale = 1
+            while len(decoded_frames) < len(lookahead_bboxes_texts):
+                success, frame = vid.read()
+                if not success:
+                    # We've reached the end of the video.
+                    end_of_video = True
+                    break
+                if len(decoded_frames) == 0:
+                    # Track on a smaller copy of each frame if the video is larger than
+                    # TRACKING_MAX_DIMENSION.
+                    frame_scale = get_frame_scale(frame)
+                decoded_frames.append(resize_frame(frame, frame_scale))
+            if len(decoded_frames) == 0:
                 storage.tracker_stopping(team_uuid, video_uuid, tracker_uuid)
                 return
+            del lookahead_bboxes_texts[len(decoded_frames):]
+            if len(lookahead_bboxes_texts) > 1:
+                logging.info('Resuming tracking at frame %d, %d frames ahead of frame %d' %
+                    (lookahead_frame_number + len(lookahead_bboxes_texts) - 1,
+                    len(lookahead_bboxes_texts) - 1, lookahead_frame_number))
+
+            # Separate bboxes_text into bboxes and classes. cv2 trackers can't be saved and
+            # restored, so create the trackers from the bboxes for the last tracked frame.
+            bboxes, classes = bbox_writer.parse_bboxes_text(lookahead_bboxes_texts[-1], scale, frame_scale)
+            # Create the trackers, one per bbox.
+            trackers = create_trackers(tracker_name, decoded_frames[-1], bboxes, executor)
 
-            # Wait for the bboxes to be approved/adjusted.
-            while tracker_client_entity['frame_number'] != frame_number:
+            while True:
                 if __should_stop(team_uuid, video_uuid, tracker_uuid, tracker_client_entity,
                         action_parameters):
                     return
-                time.sleep(0.1)
-                tracker_client_entity = storage.maybe_retrieve_tracker_client_entity(video_uuid, tracker_uuid)
-                if tracker_client_entity is None:
-                    logging.critical('Unexpected: storage.maybe_retrieve_tracker_client_entity returned None')
-                    return
-
-            # Separate bboxes_text into bboxes and classes.
-            bboxes, classes = bbox_writer.parse_bboxes_text(tracker_client_entity['bboxes_text'], scale)
 
-            # Create the trackers, one per bbox.
-            trackers = __create_trackers(tracker_fn, tracker_name, frame, bboxes)
+                approved_index = tracker_client_entity['frame_number'] - lookahead_frame_number
+                if (0 <= approved_index < len(lookahead_bboxes_texts) and
+                        (approved_index > 0 or tracker_client_entity['bboxes_text'] != lookahead_bboxes_texts[0])):
+                    if tracker_client_entity['bboxes_text'] != lookahead_bboxes_texts[approved_index]:
+                        # The user adjusted the bboxes. Discard the speculative frames after the
+                        # approved frame and create new trackers, one per bbox.
+                        bboxes, classes = bbox_writer.parse_bboxes_text(tracker_client_entity['bboxes_text'], scale, frame_scale)
+                        __log_tracker_summaries(trackers)
+                        trackers = create_trackers(tracker_name, decoded_frames[approved_index], bboxes, executor)
+                        del lookahead_bboxes_texts[approved_index:]
+                        lookahead_bboxes_texts.append(tracker_client_entity['bboxes_text'])
+                    # Drop the frames before the approved frame.
+                    del decoded_frames[:approved_index]
+                    del lookahead_bboxes_texts[:approved_index]
+                    lookahead_frame_number += approved_index
+                    # Log the round trip from storing the tracked bboxes to seeing them approved/adjusted.
+                    for stored_frame_number in sorted(stored_times):
+                        if stored_frame_number > lookahead_frame_number:
+                            break
+                        stored_time = stored_times.pop(stored_frame_number)
+                        logging.info('Frame %d round trip %d ms (%s)' % (stored_frame_number,
+                            (time.monotonic() - stored_time) * 1000,
+                            'redis' if tracking_channel.is_using_redis() else 'polling'))
+                        record_span(tracking_metrics.SPAN_ROUND_TRIP, stored_time)
 
-            while True:
-                # Read the next frame from the video file.
-                frame_number += 1
-                success, frame = vid.read()
-                if not success:
-                    # We've reached the end of the video.
+                if end_of_video and len(decoded_frames) == 1:
+                    # The client has approved the last frame of the video.
                     storage.tracker_stopping(team_uuid, video_uuid, tracker_uuid)
                     return
 
-                # Get the updated bboxes from the trackers.
-                bboxes = []
-                for i, tracker in enumerate(trackers):
-                    if tracker is not None:
-                        success, tuple = tracker.update(frame)
+                # Get the next frame to track, unless the tracker is already LOOKAHEAD_FRAME_COUNT
+                # frames ahead of the client.
+                frame = None
+                next_index = len(lookahead_bboxes_texts)
+                if next_index <= LOOKAHEAD_FRAME_COUNT:
+                    if next_index < len(decoded_frames):
+                        frame = decoded_frames[next_index]
+                    elif not end_of_video:
+                        # Read the next frame from the video file.
+                        start_time = time.monotonic()
+                        success, frame = vid.read()
                         if success:
-                            bboxes.append(np.array(tuple))
+                            frame = resize_frame(frame, frame_scale)
+                            decoded_frames.append(frame)
+                            record_span(tracking_metrics.SPAN_DECODE, start_time)
                         else:
-                            logging.error('Tracking failure for object %d on frame %d' % (i, frame_number))
-                            bboxes.append(None)
-                    else:
-                        logging.error('Tracking failure for object %d on frame %d' % (i, frame_number))
-                        bboxes.append(None)
+                            # We've reached the end of the video.
+                            end_of_video = True
+                            frame = None
 
-                # Store the new bboxes.
-                tracked_bboxes_text = bbox_writer.format_bboxes_text(bboxes, classes, scale,
-                      tracker_entity['video_width'], tracker_entity['video_height'])
-                storage.store_tracked_bboxes(video_uuid, tracker_uuid, frame_number, tracked_bboxes_text)
+                if frame is not None:
+                    frame_number = lookahead_frame_number + next_index
+                    # Get the updated bboxes from the trackers.
+                    start_time = time.monotonic()
+                    bboxes = update_trackers(trackers, frame, frame_number, executor)
+                    record_span(tracking_metrics.SPAN_TRACK, start_time)
 
-                if __should_stop(team_uuid, video_uuid, tracker_uuid, tracker_client_entity,
-                        action_parameters):
-                    return
+                    # Store the new bboxes.
+                    tracked_bboxes_text = bbox_writer.format_bboxes_text(bboxes, classes, scale,
+                          tracker_entity['video_width'], tracker_entity['video_height'], frame_scale)
+                    lookahead_bboxes_texts.append(tracked_bboxes_text)
+                    start_time = time.monotonic()
+                    storage.store_tracked_bboxes(video_uuid, tracker_uuid, frame_number, tracked_bboxes_text,
+                        lookahead_frame_number, lookahead_bboxes_texts)
+                    stored_times[frame_number] = time.monotonic()
+                    record_span(tracking_metrics.SPAN_STORE, start_time)
+                else:
+                    # Wait for the bboxes to be approved/adjusted.
+                    subscription.wait()
 
-                # Wait for the bboxes to be approved/adjusted.
+                start_time = time.monotonic()
                 tracker_client_entity = storage.maybe_retrieve_tracker_client_entity(video_uuid, tracker_uuid)
+                record_span(tracking_metrics.SPAN_READ_CLIENT, start_time)
                 if tracker_client_entity is None:
                     logging.critical('Unexpected: storage.maybe_retrieve_tracker_client_entity returned None')
                     return
-                while tracker_client_entity['frame_number'] != frame_number:
-                    if __should_stop(team_uuid, video_uuid, tracker_uuid, tracker_client_entity,
-                            action_parameters):
-                        return
-                    time.sleep(0.1)
-                    tracker_client_entity = storage.maybe_retrieve_tracker_client_entity(video_uuid, tracker_uuid)
-                    if tracker_client_entity is None:
-                        logging.critical('Unexpected: storage.maybe_retrieve_tracker_client_entity returned None')
-                        return
-
-                if tracker_client_entity['bboxes_text'] != tracked_bboxes_text:
-                    # Separate bboxes_text into bboxes and classes.
-                    bboxes, classes = bbox_writer.parse_bboxes_text(tracker_client_entity['bboxes_text'], scale)
-                    # Create new trackers, one per bbox.
-                    trackers = __create_trackers(tracker_fn, tracker_name, frame, bboxes)
 
         finally:
             # Release the cv2 video.
             vid.release()
     finally:
-        # Delete the temporary file.
-        os.remove(video_filename)
+        __log_tracker_summaries(trackers)
+        tracking_metrics.flush()
+        if executor is not None:
+            executor.shutdown()
+        # Let the video cache know we are finished with the file.
+        video_cache.release_video_file(video_filename)
+
+def __log_tracker_summaries(trackers):
+    for i, tracker in enumerate(trackers):
+        if isinstance(tracker, AdaptiveTracker):
+            logging.info('Object %d: %s' % (i, tracker.get_summary()))
+
+# Returns the factor that frames should be resized by so that neither dimension is larger than
+# TRACKING_MAX_DIMENSION.
+def get_frame_scale(frame):
+    max_dimension = max(frame.shape[0], frame.shape[1])
+    if TRACKING_MAX_DIMENSION is None or max_dimension <= TRACKING_MAX_DIMENSION:
+        return 1
+    return TRACKING_MAX_DIMENSION / max_dimension
+
+def resize_frame(frame, frame_scale):
+    if frame_scale == 1:
+        return frame
+    size = (round(frame.shape[1] * frame_scale), round(frame.shape[0] * frame_scale))
+    return cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+# Returns the executor that create_trackers and update_trackers should use for the given tracker,
+# or None if the objects should be tracked one after another.
+def create_executor(tracker_name):
+    if tracker_name.endswith('-Parallel'):
+        return concurrent.futures.ThreadPoolExecutor(max_workers=constants.MAX_BOUNDING_BOX_PER_FRAME)
+    return None
+
+def update_trackers(trackers, frame, frame_number, executor=None):
+    if executor is not None:
+        results = list(executor.map(lambda tracker: __update_tracker(tracker, frame), trackers))
+    else:
+        results = [__update_tracker(tracker, frame) for tracker in trackers]
+    bboxes = []
+    for i, (success, tuple) in enumerate(results):
+        if success:
+            bboxes.append(np.array(tuple))
+        else:
+            logging.error('Tracking failure for object %d on frame %d' % (i, frame_number))
+            bboxes.append(None)
+    return bboxes
+
+def __update_tracker(tracker, frame):
+    if tracker is None:
+        return False, None
+    return tracker.update(frame)
 
 def __should_stop(team_uuid, video_uuid, tracker_uuid, tracker_client_entity, action_parameters):
     if (tracker_client_entity['tracking_stop_requested'] or
@@ -192,22 +403,21 @@ def __should_stop(team_uuid, video_uuid, tracker_uuid, tracker_client_entity, ac
     action.retrigger_if_necessary(action_parameters)
     return False
 
-def __create_trackers(tracker_fn, tracker_name, frame, init_bboxes):
-    trackers = []
-    for i, bbox in enumerate(init_bboxes):
-        rect = np.array(bbox, dtype=float).astype(int)
-        tracker = tracker_fn()
-        try:
-            success = tracker.init(frame, tuple(rect))
-            if success:
-                trackers.append(tracker)
-            else:
-                trackers.append(None)
-                logging.error('Unable to initialize tracker %s for rect %s' % (tracker_name, str(rect)))
-                continue
-        except:
-            trackers.append(None)
-            logging.error('Unable to initialize tracker %s for rect %s, traceback: %s' %
-                (tracker_name, str(rect), traceback.format_exc().replace('\n', ' ... ')))
-            continue
-    return trackers
+def create_trackers(tracker_name, frame, init_bboxes, executor=None):
+    tracker_fn = tracker_fns[tracker_name]
+    if executor is not None:
+        return list(executor.map(lambda bbox: __create_tracker(tracker_fn, tracker_name, frame, bbox), init_bboxes))
+    return [__create_tracker(tracker_fn, tracker_name, frame, bbox) for bbox in init_bboxes]
+
+def __create_tracker(tracker_fn, tracker_name, frame, bbox):
+    rect = np.array(bbox, dtype=float).astype(int)
+    tracker = tracker_fn()
+    try:
+        success = tracker.init(frame, tuple(rect))
+        if success:
+            return tracker
+        logging.error('Unable to initialize tracker %s for rect %s' % (tracker_name, str(rect)))
+    except:
+        logging.error('Unable to initialize tracker %s for rect %s, traceback: %s' %
+            (tracker_name, str(rect), traceback.format_exc().replace('\n', ' ... ')))
+    return None
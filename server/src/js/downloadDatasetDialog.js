@@ -45,6 +45,7 @@ fmltc.DownloadDatasetDialog = function(util, datasetEntity, downloadStartTime) {
   this.finishedDiv = document.getElementById('ddFinishedDiv');
 
   this.partitionCount = 0;
+  this.cacheable = false;
   this.downloadStartedArray = [];
   this.downloadFinishedArray = [];
   this.zipProgressArray = [];
@@ -105,6 +106,7 @@ fmltc.DownloadDatasetDialog.prototype.xhr_prepareToZipDataset_onreadystatechange
       const response = JSON.parse(xhr.responseText);
 
       this.partitionCount = response.partition_count;
+      this.cacheable = response.cacheable;
       if (response.partition_count == 1) {
         this.partitionCountSpan.textContent = '1 zip file';
       } else {
@@ -112,7 +114,12 @@ fmltc.DownloadDatasetDialog.prototype.xhr_prepareToZipDataset_onreadystatechange
       }
       this.partitionCountDiv.style.visibility = 'visible';
 
-      setTimeout(this.getDatasetZipStatus.bind(this, response.dataset_zip_uuid), 2000);
+      if (response.cached) {
+        // The dataset was zipped before. The response includes the zip status.
+        this.updateDatasetZipStatus(response.dataset_zip_uuid, response);
+      } else {
+        setTimeout(this.getDatasetZipStatus.bind(this, response.dataset_zip_uuid), 2000);
+      }
 
     } else {
       // TODO(lizlooney): handle error properly
@@ -155,72 +162,75 @@ fmltc.DownloadDatasetDialog.prototype.xhr_getDatasetZipStatus_onreadystatechange
 
     if (xhr.status === 200) {
       const response = JSON.parse(xhr.responseText);
+      this.updateDatasetZipStatus(datasetZipUuid, response);
 
-      if (this.downloadStartedArray.length == 0) {
-        for (let partitionIndex = 0; partitionIndex < this.partitionCount; partitionIndex++) {
-          this.downloadStartedArray[partitionIndex] = false;
-          this.downloadFinishedArray[partitionIndex] = false;
-
-          let div = document.createElement('div');
-          const zipProgress = document.createElement('progress');
-          zipProgress.value = 0;
-          zipProgress.max = 1;
-          this.zipProgressArray[partitionIndex] = zipProgress;
-          div.appendChild(zipProgress);
-          let zipProgressSpan = document.createElement('span');
-          zipProgressSpan.textContent = this.makeZipProgressLabel(0);
-          this.zipProgressSpanArray[partitionIndex] = zipProgressSpan;
-          div.appendChild(zipProgressSpan);
-          this.progressDiv.appendChild(div);
-
-          div = document.createElement('div');
-          const downloadProgress = document.createElement('progress');
-          downloadProgress.value = 0;
-          downloadProgress.max = 1;
-          this.downloadProgressArray[partitionIndex] = downloadProgress;
-          div.appendChild(downloadProgress);
-          let downloadProgressSpan = document.createElement('span');
-          downloadProgressSpan.textContent = this.makeDownloadProgressLabel(0);
-          this.downloadProgressSpanArray[partitionIndex] = downloadProgressSpan;
-          div.appendChild(downloadProgressSpan);
-          this.progressDiv.appendChild(div);
-
-          if (partitionIndex != this.partitionCount - 1) {
-            this.progressDiv.appendChild(document.createElement('hr'));
-          }
-        }
-        this.progressDiv.style.visibility = 'visible';
-      }
-
-      let allDownloadsStarted = true;
-      for (let partitionIndex = 0; partitionIndex < this.partitionCount; partitionIndex++) {
-        if (!this.downloadStartedArray[partitionIndex]) {
-          this.zipProgressArray[partitionIndex].value = response.files_written_array[partitionIndex];
-          this.zipProgressArray[partitionIndex].max = response.file_count_array[partitionIndex];
-          this.zipProgressSpanArray[partitionIndex].textContent = this.makeZipProgressLabel(
-              response.files_written_array[partitionIndex], response.file_count_array[partitionIndex]);
-
-          if (response.is_ready_array[partitionIndex] && response.download_url_array[partitionIndex]) {
-            this.downloadStartedArray[partitionIndex] = true;
-            this.downloadDatasetZip(datasetZipUuid, partitionIndex, response.download_url_array[partitionIndex], 0);
-          }
-        }
+    } else {
+      console.log('Failure! /getDatasetZipStatus?' + params +
+          ' xhr.status is ' + xhr.status + '. xhr.statusText is ' + xhr.statusText);
+      setTimeout(this.getDatasetZipStatus.bind(this, datasetZipUuid), 5000);
+    }
+  }
+};
 
-        if (!this.downloadStartedArray[partitionIndex]) {
-          allDownloadsStarted = false;
-        }
+fmltc.DownloadDatasetDialog.prototype.updateDatasetZipStatus = function(datasetZipUuid, response) {
+  if (this.downloadStartedArray.length == 0) {
+    for (let partitionIndex = 0; partitionIndex < this.partitionCount; partitionIndex++) {
+      this.downloadStartedArray[partitionIndex] = false;
+      this.downloadFinishedArray[partitionIndex] = false;
+
+      let div = document.createElement('div');
+      const zipProgress = document.createElement('progress');
+      zipProgress.value = 0;
+      zipProgress.max = 1;
+      this.zipProgressArray[partitionIndex] = zipProgress;
+      div.appendChild(zipProgress);
+      let zipProgressSpan = document.createElement('span');
+      zipProgressSpan.textContent = this.makeZipProgressLabel(0);
+      this.zipProgressSpanArray[partitionIndex] = zipProgressSpan;
+      div.appendChild(zipProgressSpan);
+      this.progressDiv.appendChild(div);
+
+      div = document.createElement('div');
+      const downloadProgress = document.createElement('progress');
+      downloadProgress.value = 0;
+      downloadProgress.max = 1;
+      this.downloadProgressArray[partitionIndex] = downloadProgress;
+      div.appendChild(downloadProgress);
+      let downloadProgressSpan = document.createElement('span');
+      downloadProgressSpan.textContent = this.makeDownloadProgressLabel(0);
+      this.downloadProgressSpanArray[partitionIndex] = downloadProgressSpan;
+      div.appendChild(downloadProgressSpan);
+      this.progressDiv.appendChild(div);
+
+      if (partitionIndex != this.partitionCount - 1) {
+        this.progressDiv.appendChild(document.createElement('hr'));
       }
+    }
+    this.progressDiv.style.visibility = 'visible';
+  }
 
-      if (!allDownloadsStarted) {
-        setTimeout(this.getDatasetZipStatus.bind(this, datasetZipUuid), 2000);
+  let allDownloadsStarted = true;
+  for (let partitionIndex = 0; partitionIndex < this.partitionCount; partitionIndex++) {
+    if (!this.downloadStartedArray[partitionIndex]) {
+      this.zipProgressArray[partitionIndex].value = response.files_written_array[partitionIndex];
+      this.zipProgressArray[partitionIndex].max = response.file_count_array[partitionIndex];
+      this.zipProgressSpanArray[partitionIndex].textContent = this.makeZipProgressLabel(
+          response.files_written_array[partitionIndex], response.file_count_array[partitionIndex]);
+
+      if (response.is_ready_array[partitionIndex] && response.download_url_array[partitionIndex]) {
+        this.downloadStartedArray[partitionIndex] = true;
+        this.downloadDatasetZip(datasetZipUuid, partitionIndex, response.download_url_array[partitionIndex], 0);
       }
+    }
 
-    } else {
-      console.log('Failure! /getDatasetZipStatus?' + params +
-          ' xhr.status is ' + xhr.status + '. xhr.statusText is ' + xhr.statusText);
-      setTimeout(this.getDatasetZipStatus.bind(this, datasetZipUuid), 5000);
+    if (!this.downloadStartedArray[partitionIndex]) {
+      allDownloadsStarted = false;
     }
   }
+
+  if (!allDownloadsStarted) {
+    setTimeout(this.getDatasetZipStatus.bind(this, datasetZipUuid), 2000);
+  }
 };
 
 fmltc.DownloadDatasetDialog.prototype.makeZipProgressLabel = function(filesWritten, fileCount) {
@@ -303,10 +313,12 @@ fmltc.DownloadDatasetDialog.prototype.xhr_downloadDatasetZip_onreadystatechange
 fmltc.DownloadDatasetDialog.prototype.allDone = function(datasetZipUuid) {
   this.finishedDiv.style.visibility = 'visibile';
 
-  // Delete the zip blobs from the server in 30 seconds.
-  for (let partitionIndex = 0; partitionIndex < this.partitionCount; partitionIndex++) {
-      setTimeout(this.deleteDatasetZip.bind(this,
-          datasetZipUuid, partitionIndex, 0), 30000);
+  if (!this.cacheable) {
+    // The zip blobs are not kept for reuse. Delete them from the server in 30 seconds.
+    for (let partitionIndex = 0; partitionIndex < this.partitionCount; partitionIndex++) {
+        setTimeout(this.deleteDatasetZip.bind(this,
+            datasetZipUuid, partitionIndex, 0), 30000);
+    }
   }
 
   this.xButton.disabled = this.closeButton.disabled = false;
@@ -179,7 +179,13 @@ fmltc.ListVideos.prototype.onVideoEntityUpdated = function(videoEntity) {
   }
   if ('frame_count' in videoEntity) {
     this.frameCountTds[i].textContent = videoEntity.frame_count;
-    if (videoEntity.extracted_frame_count != videoEntity.frame_count) {
+    if ('frame_extraction_done' in videoEntity) {
+      // The frame_count is only an estimate until frame extraction is done.
+      if (!videoEntity.frame_extraction_done) {
+        frameExtractionComplete = false;
+      }
+    } else if (videoEntity.extracted_frame_count != videoEntity.frame_count) {
+      // This video was extracted before frame_extraction_done was added.
       frameExtractionComplete = false;
     }
   } else {
@@ -0,0 +1,173 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "lizlooney@google.com (Liz Looney)"
+
+# Python Standard Library
+import fcntl
+import hashlib
+import logging
+import os
+import threading
+
+# My Modules
+from app_engine import blob_storage
+
+# Videos are cached on local disk, keyed by video blob name and generation, so actions that run in
+# the same instance share one download. Cached files are evicted in least recently used order.
+VIDEO_CACHE_DIR = '/tmp/video_cache'
+# In cloud functions, /tmp is an in-memory file system, so keep this well below the memory limit.
+VIDEO_CACHE_MAX_BYTES = 500000000
+
+__lock = threading.Lock()
+# Keys are video filenames, values are lists of open lock files, one per acquire_video_file call.
+__lock_files = {}
+__stats = {
+    'hits': 0,
+    'misses': 0,
+    'evictions': 0,
+    'bytes_downloaded': 0,
+}
+
+
+def acquire_video_file(video_blob_name):
+    # Returns the filename of a local copy of the video, or None if the video blob doesn't exist.
+    # The caller must call release_video_file when it is finished with the file.
+    generation = blob_storage.get_video_blob_generation(video_blob_name)
+    if generation is None:
+        return None
+    os.makedirs(VIDEO_CACHE_DIR, exist_ok=True)
+    key = hashlib.sha256(('%s#%d' % (video_blob_name, generation)).encode('utf-8')).hexdigest()
+    video_filename = os.path.join(VIDEO_CACHE_DIR, key)
+    # Hold a shared lock on the video file while it is in use. Eviction only removes files that it
+    # can lock exclusively.
+    lock_file = __open_and_lock('%s.lock' % video_filename, fcntl.LOCK_SH)
+    try:
+        hit = os.path.exists(video_filename)
+        if not hit:
+            # Hold an exclusive download lock while checking for and downloading the video, so that
+            # concurrent actions wait for one download instead of starting their own.
+            with __open_and_lock('%s.download.lock' % video_filename, fcntl.LOCK_EX) as download_lock_file:
+                hit = os.path.exists(video_filename)
+                if not hit:
+                    download_filename = '%s.download' % video_filename
+                    try:
+                        blob_storage.write_video_generation_to_file(video_blob_name, generation, download_filename)
+                        os.rename(download_filename, video_filename)
+                    except:
+                        if os.path.exists(download_filename):
+                            os.remove(download_filename)
+                        raise
+        if hit:
+            # Update the modification time, which is used for least recently used eviction.
+            os.utime(video_filename)
+    except:
+        lock_file.close()
+        raise
+
+    with __lock:
+        if hit:
+            __stats['hits'] += 1
+        else:
+            __stats['misses'] += 1
+            __stats['bytes_downloaded'] += os.path.getsize(video_filename)
+        __lock_files.setdefault(video_filename, []).append(lock_file)
+        logging.info('video_cache - %s %s - stats %s' % ('hit' if hit else 'miss', video_blob_name, str(__stats)))
+
+    if not hit:
+        __evict(video_filename)
+    return video_filename
+
+
+def release_video_file(video_filename):
+    with __lock:
+        lock_files = __lock_files.get(video_filename)
+        if not lock_files:
+            logging.warning('video_cache - release_video_file called for %s, which is not acquired' % video_filename)
+            return
+        lock_file = lock_files.pop()
+        if len(lock_files) == 0:
+            __lock_files.pop(video_filename)
+    # Closing the lock file releases the shared lock.
+    lock_file.close()
+
+
+def __open_and_lock(lock_filename, operation):
+    # Eviction removes lock files. If the lock file was removed between opening and locking it, the
+    # lock is on a file that nobody else will see, so open the new lock file and try again.
+    while True:
+        lock_file = open(lock_filename, 'a')
+        try:
+            fcntl.flock(lock_file, operation)
+            try:
+                same_file = os.fstat(lock_file.fileno()).st_ino == os.stat(lock_filename).st_ino
+            except FileNotFoundError:
+                same_file = False
+        except:
+            lock_file.close()
+            raise
+        if same_file:
+            return lock_file
+        lock_file.close()
+
+
+def get_video_cache_stats():
+    with __lock:
+        return __stats.copy()
+
+
+def __evict(keep_video_filename):
+    entries = []
+    total_bytes = 0
+    for name in os.listdir(VIDEO_CACHE_DIR):
+        if name.endswith('.lock') or name.endswith('.download'):
+            continue
+        path = os.path.join(VIDEO_CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        total_bytes += stat.st_size
+        entries.append((stat.st_mtime, path, stat.st_size))
+    # Oldest first.
+    entries.sort()
+    for mtime, path, size in entries:
+        if total_bytes <= VIDEO_CACHE_MAX_BYTES:
+            break
+        if path == keep_video_filename:
+            continue
+        try:
+            lock_file = __open_and_lock('%s.lock' % path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # The video is in use.
+            continue
+        try:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            total_bytes -= size
+            with __lock:
+                __stats['evictions'] += 1
+            # Remove the lock files too, so they don't pile up. Downloads only happen while holding
+            # the shared lock, so nobody holds the download lock and it can be removed without
+            # locking it. Remove the lock file last, while holding its exclusive lock. Anyone
+            # waiting on it will see that it was removed and open a new one.
+            try:
+                os.remove('%s.download.lock' % path)
+            except FileNotFoundError:
+                pass
+            os.remove('%s.lock' % path)
+        finally:
+            lock_file.close()
@@ -0,0 +1,116 @@
+# Copyright 2020 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+__author__ = "lizlooney@google.com (Liz Looney)"
+
+# Python Standard Library
+import bisect
+import json
+import logging
+
+# Other Modules
+import cv2
+
+# My Modules
+from app_engine import blob_storage
+
+# The video index records the presentation timestamp of every frame, in the order that the frames
+# are decoded. cv2 doesn't expose keyframe positions or byte offsets, but it can seek by timestamp,
+# which makes the demuxer jump to the nearest keyframe and decode forward from there.
+
+# Seeking costs a keyframe decode, so skip ahead with vid.grab() if the target frame is this close.
+MIN_FRAMES_TO_SEEK = 30
+
+
+def create_index(fps):
+    return {
+        'fps': fps,
+        'frame_timestamps_ms': [],
+    }
+
+
+def record_frame(vid, index):
+    # Call this right after vid.read() or vid.grab() returns successfully.
+    index['frame_timestamps_ms'].append(vid.get(cv2.CAP_PROP_POS_MSEC))
+
+
+def truncate_index(index, frame_count):
+    del index['frame_timestamps_ms'][frame_count:]
+
+
+def store_index(video_blob_name, index):
+    # Some containers don't provide timestamps. If the timestamps aren't strictly increasing, the
+    # index can't be used to identify frames, so don't store it.
+    frame_timestamps_ms = index['frame_timestamps_ms']
+    for i in range(1, len(frame_timestamps_ms)):
+        if frame_timestamps_ms[i] <= frame_timestamps_ms[i - 1]:
+            logging.warning('Not storing video index for %s: timestamps are not increasing.' % video_blob_name)
+            return
+    blob_storage.store_video_index(video_blob_name, json.dumps(index))
+
+
+def retrieve_index(video_blob_name):
+    video_index_json = blob_storage.retrieve_video_index(video_blob_name)
+    if video_index_json is None:
+        return None
+    return json.loads(video_index_json)
+
+
+def seek_to_frame(vid, video_filename, current_frame_number, frame_number, index):
+    # Positions vid so that the next vid.read() returns frame frame_number. current_frame_number is
+    # the frame that the next vid.read() would have returned. The returned vid may be a different
+    # cv2.VideoCapture than the given one.
+    if (index is not None and
+            frame_number - current_frame_number >= MIN_FRAMES_TO_SEEK and
+            frame_number <= len(index['frame_timestamps_ms'])):
+        # Seek to the frame before frame_number and grab it, then use its timestamp to find out
+        # which frame we actually landed on.
+        landed_frame_number = __seek_with_index(vid, frame_number - 1, index)
+        if landed_frame_number is not None:
+            current_frame_number = landed_frame_number + 1
+        else:
+            # We don't know where we are. Start over from the beginning.
+            current_frame_number = frame_number + 1
+
+    if current_frame_number > frame_number:
+        # Back up to the beginning of the video. Setting the CAP_PROP_POS_FRAMES property is not
+        # reliable. Instead, we release vid and open it again.
+        vid.release()
+        vid = cv2.VideoCapture(video_filename)
+        current_frame_number = 0
+
+    # Skip through frames using vid.grab(), which is faster than vid.read().
+    while current_frame_number < frame_number:
+        if not vid.grab():
+            # We've reached the end of the video.
+            break
+        current_frame_number += 1
+    return vid
+
+
+def __seek_with_index(vid, target_frame_number, index):
+    frame_timestamps_ms = index['frame_timestamps_ms']
+    fps = index['fps']
+    # Frames are considered the same if their timestamps are within half a frame of each other.
+    tolerance_ms = 500 / fps if fps > 0 else 1
+    vid.set(cv2.CAP_PROP_POS_MSEC, frame_timestamps_ms[target_frame_number])
+    if not vid.grab():
+        return None
+    landed_ms = vid.get(cv2.CAP_PROP_POS_MSEC)
+    i = bisect.bisect_left(frame_timestamps_ms, landed_ms - tolerance_ms)
+    if i < len(frame_timestamps_ms) and abs(frame_timestamps_ms[i] - landed_ms) <= tolerance_ms:
+        return i
+    logging.warning('Seek to %f ms landed on unknown timestamp %f ms' %
+        (frame_timestamps_ms[target_frame_number], landed_ms))
+    return None
@@ -125,8 +125,12 @@ resource "google_cloudfunctions_function" "perform-action" {
 
   environment_variables = {
     PROJECT_ID = var.project_id
+    REDIS_IP_ADDR = google_redis_instance.ml-redis-dev.host
   }
 
+  # The tracker uses redis to exchange notifications with app engine.
+  vpc_connector = "projects/${var.project_id}/locations/${var.region}/connectors/central-serverless"
+
   timeouts {
     create = "60m"
     update = "60m"
@@ -136,6 +140,8 @@ resource "google_cloudfunctions_function" "perform-action" {
     event_type  = "google.storage.object.finalize"
     resource    = google_storage_bucket.fmltc-action-parameters.name
   }
+
+  depends_on = [module.serverless-connector]
 }
 
 #
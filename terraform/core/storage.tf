@@ -11,6 +11,17 @@ resource "google_storage_bucket" "fmltc-blobs" {
   location      = "US"
   force_destroy = true
 
+  # Delete dataset zips that haven't been used for longer than DATASET_ZIP_CACHE_TIME (7 days) in
+  # server/app_engine/dataset_zipper.py. Only dataset zips have a custom time.
+  lifecycle_rule {
+    condition {
+      days_since_custom_time = 8
+    }
+    action {
+      type = "Delete"
+    }
+  }
+
   depends_on = [google_project_service.gcp_services]
 }
 